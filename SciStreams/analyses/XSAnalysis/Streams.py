@@ -16,6 +16,7 @@ import numpy as np
 from dask.delayed import delayed
 
 from collections import ChainMap
+from uuid import uuid4
 from SciAnalysis.data.Singlet import Singlet
 
 # Sources
@@ -34,9 +35,9 @@ from SciAnalysis.analyses.XSAnalysis.DataRQconv \
         import CalibrationRQconv as Calibration
 
 from SciAnalysis.interfaces.StreamDoc import StreamDoc
-from SciAnalysis.interfaces.streams import Stream
+from SciAnalysis.interfaces.streams import Stream, same_group
 
-from collections import deque
+from SciAnalysis.interfaces.memory import ManagedDeque
 
 
 def add_attributes(sdoc, **attr):
@@ -46,7 +47,7 @@ def add_attributes(sdoc, **attr):
 
 # cache for qmaps
 # TODO : clean this up
-QMAP_CACHE = deque(maxlen=1000)
+QMAP_CACHE = ManagedDeque(maxlen=1000, stream_name="QMAP_CACHE")
 
 
 # Calibration for SAXS data
@@ -659,6 +660,29 @@ def ImageStitchingStream(return_intermediate=False):
     return sin, swinout
 
 
+def stitch_group_key(sdoc):
+    ''' The stitch group of a scan, for partition_by (see close_stitch).
+        A scan which isn't stitched back starts a group, named by its uid.
+    '''
+    if sdoc['kwargs'].get('stitchback', False) is True:
+        return same_group
+    uid = sdoc['attributes'].get('uid')
+    if uid is None:
+        uid = str(uuid4())
+    return uid
+
+
+def close_stitch(sdoc):
+    ''' The element closing the stitch group of sdoc (its last scan): a
+        copy not stitched back, so the ImageStitchingStream emits the
+        complete stitch.
+    '''
+    kwargs = dict(sdoc['kwargs'])
+    kwargs['stitchback'] = False
+    return StreamDoc(args=sdoc['args'], kwargs=kwargs,
+                     attributes=sdoc['attributes'])
+
+
 
 def ThumbStream(blur=None, crop=None, resize=None):
     ''' Thumbnail stream
@@ -3,6 +3,7 @@
     layer should reside. Conversions from other interfaces to StreamDoc are
     found in corresponding interface folders.
 '''
+from collections import deque
 from functools import wraps, singledispatch
 import time
 import sys
@@ -16,6 +17,10 @@ from dask.base import normalize_token
 
 from .streams import stream_map, stream_accumulate
 
+# the (uid, function name, error message) of the recent failures of functions
+# run through parse_streamdoc (bounded, the oldest are dropped)
+failure_log = deque(maxlen=1000)
+
 # this class is used to wrap outputs to inputs
 # for ex, if a function returns Arguments(12,34, g=23,h=20)
 # will assume the output will serve as input f(12,34, g=23, h=20)
@@ -50,6 +55,30 @@ def parse_args_Arguments(res):
     return Arguments(*res.args, **res.kwargs)
 
 
+class LazyValue:
+    ''' A placeholder for a value that is only loaded when first needed.
+
+        StreamDoc args/kwargs may hold these (for ex. references to detector
+        images in filestore). Functions run on StreamDocs always see the
+        loaded value, so branches that never use a field never load it.
+
+        Subclasses implement load, and token (a hashable, cheap to compute
+        identifier for dask tokenizing).
+    '''
+    def load(self):
+        raise NotImplementedError
+
+    def token(self):
+        raise NotImplementedError
+
+
+def resolve(val):
+    ''' Return the value, loading it if it's a LazyValue.'''
+    if isinstance(val, LazyValue):
+        return val.load()
+    return val
+
+
 class StreamDoc(dict):
     def __init__(self, streamdoc=None, args=(), kwargs={}, attributes={},
                  wrapper=None):
@@ -142,15 +171,16 @@ class StreamDoc(dict):
                 if a string : get that kwarg
         '''
         if isinstance(elem, int):
-            res = self['args'][elem]
+            res = resolve(self['args'][elem])
         elif isinstance(elem, str):
-            res = self['kwargs'][elem]
+            res = resolve(self['kwargs'][elem])
         elif elem is None:
             # return general expected function output
             if len(self['args']) == 0 and len(self['kwargs']) > 0:
-                res = dict(self['kwargs'])
+                res = {key: resolve(val)
+                       for key, val in self['kwargs'].items()}
             elif len(self['args']) > 0 and len(self['kwargs']) == 0:
-                res = self['args']
+                res = [resolve(arg) for arg in self['args']]
                 if len(res) == 1:
                     # a function with one arg normally returns this way
                     res = res[0]
@@ -329,9 +359,10 @@ def parse_streamdoc(name):
             # print("Running in {}".format(f.__name__))
             if x2 is None:
                 if _is_streamdoc(x):
-                    # extract the args and kwargs
-                    args = x.args
-                    kwargs = x.kwargs
+                    # extract the args and kwargs, loading lazy values
+                    args = [resolve(arg) for arg in x.args]
+                    kwargs = {key: resolve(val)
+                              for key, val in x.kwargs.items()}
                     attributes = x.attributes
                 else:
                     args = (x,)
@@ -379,8 +410,11 @@ def parse_streamdoc(name):
                 _cleanexit(f, statistics)
 
             t2 = time.time()
-            statistics['runtime'] = t1 - t2
+            statistics['runtime'] = t2 - t1
             statistics['runstart'] = t1
+            if statistics['status'] == "Failure":
+                failure_log.append((attributes.get('uid'), f.__name__,
+                                    str(statistics['error_message'])))
 
             if 'function_list' not in attributes:
                 attributes['function_list'] = list()
@@ -398,7 +432,8 @@ def parse_streamdoc(name):
             arguments_obj = parse_args(result)
             # print("StreamDoc, parse_streamdoc : parsed args :
             # {}".format(arguments_obj.args))
-            streamdoc.add(args=arguments_obj.args, kwargs=arguments_obj.kwargs)
+            streamdoc.add(args=arguments_obj.args, kwargs=arguments_obj.kwargs,
+                          statistics=statistics)
 
             return streamdoc
 
@@ -439,10 +474,21 @@ def _cleanexit(f, statistics):
 # uses dispatch in dask delayed to define hash function
 # for the StreamDoc object
 @normalize_token.register(StreamDoc)
-def tokenize_sdoc(sdoc):
+def tokenize_sdoc(sdoc, attributes=False):
+    ''' Tokenize the args and kwargs of a StreamDoc (and its attributes if
+        attributes is True, like for the result store).'''
+    if attributes:
+        return normalize_token((sdoc['args'], sdoc['kwargs'],
+                                sdoc['attributes']))
     return normalize_token((sdoc['args'], sdoc['kwargs']))
 
 
+# lazy values are hashed from their reference, without loading them
+@normalize_token.register(LazyValue)
+def tokenize_lazyvalue(val):
+    return normalize_token((type(val).__name__, val.token()))
+
+
 def delayed_wrapper(name):
     def decorator(f):
         @delayed(pure=True)
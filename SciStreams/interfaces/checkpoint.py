@@ -0,0 +1,238 @@
+''' Checkpoint and restore the state of the stateful nodes of a pipeline.
+
+    The nodes with state (scan, partition, sliding_window, reorder, collect,
+    and the replicas of partition_by) are found by walking the pipeline from
+    its sources, including the streams fed by map(sin.emit). A snapshot
+    saves their states, with the uid (and time) of the last element
+    processed, so the source can resume right after it:
+
+    >>> checkpointer = Checkpointer("/GPFS/pipeline/checkpoint", [sin])
+    >>> last = checkpointer.restore()
+    >>> try:
+    ...     for sdoc in sdocs_after(last):
+    ...         checkpointer.started(sdoc)
+    ...         sin.emit(sdoc)
+    ...         checkpointer.processed(sdoc)
+    ... finally:
+    ...     checkpointer.close()
+
+    Nodes are named by the order they're found in, so a checkpoint can only
+    be restored to the same pipeline.
+'''
+from collections import OrderedDict
+import os
+import pickle
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+from SciAnalysis.interfaces.streams import Stream, partition_by
+
+
+def _emit_target(node):
+    ''' The stream a map or sink node emits to (map(sin.emit)), if any.'''
+    func = getattr(node, 'func', None)
+    target = getattr(func, '__self__', None)
+    if isinstance(target, Stream) and \
+            getattr(func, '__name__', None) == 'emit':
+        return target
+    return None
+
+
+def stateful_nodes(sources):
+    ''' Find the stateful nodes downstream of sources.
+
+        Returns an OrderedDict of name -> node. partition_by nodes are
+        included, their replicas are walked by Checkpointer.
+    '''
+    nodes = OrderedDict()
+    _walk(sources, "", nodes, set())
+    return nodes
+
+
+def _walk(sources, prefix, nodes, visited):
+    stack = list(reversed(sources))
+    index = 0
+    while stack:
+        node = stack.pop()
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        if isinstance(node, partition_by) or \
+                type(node).get_state is not Stream.get_state:
+            nodes["{}{}_{}".format(prefix, index,
+                                   type(node).__name__)] = node
+            index += 1
+        downstream = list(node.parents)
+        target = _emit_target(node)
+        if target is not None:
+            downstream.append(target)
+        stack.extend(reversed(downstream))
+
+
+class _ArrayPickler(pickle.Pickler):
+    ''' Pickle numpy arrays to .npy files of dirname.'''
+    def __init__(self, f, dirname):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.dirname = dirname
+        self.count = 0
+
+    def persistent_id(self, obj):
+        if type(obj) is np.ndarray and obj.dtype != object:
+            fname = "arr_{:05d}.npy".format(self.count)
+            self.count += 1
+            np.save(os.path.join(self.dirname, fname), obj)
+            return fname
+        return None
+
+
+class _ArrayUnpickler(pickle.Unpickler):
+    def __init__(self, f, dirname):
+        super().__init__(f)
+        self.dirname = dirname
+
+    def persistent_load(self, fname):
+        return np.load(os.path.join(self.dirname, fname))
+
+
+class Checkpointer:
+    ''' Save and restore the state of a pipeline.
+
+        Parameters
+        ----------
+        dirname : str
+            the checkpoint directory
+
+        sources : list of Stream
+            the sources of the pipeline
+
+        every : int, optional
+            save a snapshot every this many elements processed (see
+            processed)
+
+        keep : int, optional
+            the number of snapshots kept
+
+        Notes
+        -----
+        A snapshot is a directory with the states (state.pkl, the arrays as
+        .npy files). It's written, then the LATEST file is replaced to point
+        to it, so an interrupted snapshot is never restored.
+    '''
+    def __init__(self, dirname, sources, every=10, keep=2):
+        self.dirname = dirname
+        self.sources = list(sources)
+        self.every = every
+        self.keep = keep
+        self.last_uid = None
+        self.last_time = None
+        self._count = 0
+        # if an element is being processed (the states are partly updated)
+        self._processing = False
+        os.makedirs(dirname, exist_ok=True)
+
+    def _states(self, nodes, prefix=""):
+        states = OrderedDict()
+        for name, node in nodes.items():
+            if isinstance(node, partition_by):
+                # wait for the elements being processed (the open group
+                # stays open)
+                node.flush(close=False)
+                keys = list(node.replicas)
+                states[prefix + name] = dict(keys=keys,
+                                             group=node.get_state())
+                for i, key in enumerate(keys):
+                    replica = stateful_nodes([node.replicas[key]])
+                    states.update(self._states(
+                        replica, "{}{}/{}/".format(prefix, name, i)))
+            else:
+                states[prefix + name] = node.get_state()
+        return states
+
+    def _set_states(self, nodes, states, prefix=""):
+        for name, node in nodes.items():
+            if prefix + name not in states:
+                print("checkpoint : Warning, no state for node " +
+                      "{}".format(prefix + name))
+                continue
+            state = states[prefix + name]
+            if isinstance(node, partition_by):
+                if 'group' in state:
+                    node.set_state(state['group'])
+                for i, key in enumerate(state['keys']):
+                    replica = stateful_nodes([node._replica(key)])
+                    self._set_states(replica, states,
+                                     "{}{}/{}/".format(prefix, name, i))
+            else:
+                node.set_state(state)
+
+    def save(self):
+        ''' Save a snapshot. Returns its directory.'''
+        states = self._states(stateful_nodes(self.sources))
+        snapname = "snap-{:.6f}-{}".format(time.time(), uuid.uuid4().hex[:8])
+        snapdir = os.path.join(self.dirname, snapname)
+        os.makedirs(snapdir)
+        with open(os.path.join(snapdir, "state.pkl"), "wb") as f:
+            _ArrayPickler(f, snapdir).dump(dict(uid=self.last_uid,
+                                                time=self.last_time,
+                                                states=states))
+        latest = os.path.join(self.dirname, "LATEST")
+        with open(latest + ".tmp", "w") as f:
+            f.write(snapname)
+        os.replace(latest + ".tmp", latest)
+
+        snapshots = sorted(fname for fname in os.listdir(self.dirname)
+                           if fname.startswith("snap-"))
+        for fname in snapshots[:-self.keep]:
+            if fname != snapname:
+                shutil.rmtree(os.path.join(self.dirname, fname),
+                              ignore_errors=True)
+        return snapdir
+
+    def restore(self):
+        ''' Restore the latest snapshot, if any.
+
+            Returns a dict with the uid and time of the last element
+            processed, None if there's no snapshot.
+        '''
+        latest = os.path.join(self.dirname, "LATEST")
+        if not os.path.isfile(latest):
+            return None
+        with open(latest) as f:
+            snapdir = os.path.join(self.dirname, f.read().strip())
+        with open(os.path.join(snapdir, "state.pkl"), "rb") as f:
+            snapshot = _ArrayUnpickler(f, snapdir).load()
+        self._set_states(stateful_nodes(self.sources), snapshot['states'])
+        self.last_uid = snapshot['uid']
+        self.last_time = snapshot['time']
+        print("checkpoint : restored {} ".format(snapdir) +
+              "(last uid {})".format(self.last_uid))
+        return dict(uid=self.last_uid, time=self.last_time)
+
+    def started(self, sdoc):
+        ''' Record that a StreamDoc is being processed, until processed.'''
+        self._processing = True
+
+    def processed(self, sdoc):
+        ''' Record that a StreamDoc was processed (its uid and time
+            attributes), saving a snapshot every self.every of them.'''
+        self._processing = False
+        attrs = sdoc['attributes']
+        self.last_uid = attrs.get('uid')
+        self.last_time = attrs.get('time')
+        self._count += 1
+        if self._count % self.every == 0:
+            self.save()
+
+    def close(self):
+        ''' Save a snapshot at the end of a run, if it stopped between
+            elements. A run interrupted while processing an element isn't
+            saved (the states are partly updated by it), it resumes from
+            the last snapshot.'''
+        if self._processing:
+            print("checkpoint : Warning, interrupted while processing an "
+                  "element, not saved (the last snapshot is kept)")
+            return None
+        return self.save()
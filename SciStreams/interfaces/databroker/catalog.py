@@ -0,0 +1,234 @@
+''' A local index of start documents, for fast searches.
+
+    databroker's search goes through every header of a time range in Python.
+    The catalog keeps the fields we search on in a SQLite file (with a full
+    text index), filled incrementally from the headers of a database. Searches
+    return uids; the data is only pulled for the uids wanted, for ex:
+
+    >>> catalog = Catalog()
+    >>> catalog.sync("cms:data")
+    >>> uids = catalog.search(sample_savename="AgBH", start_time=t0)
+    >>> for sdoc in pullfromuids("cms:data", uids):
+    ...     sin.emit(sdoc)
+'''
+import os
+import sqlite3
+import time
+
+import SciAnalysis.config as config
+
+
+# the start document fields indexed (the uid and time always are)
+CATALOG_FIELDS = ['sample_savename', 'experiment_alias_directory',
+                  'detector_name', 'protocol_name']
+# fields matched exactly, the others are matched as substrings
+CATALOG_EXACT_FIELDS = ['scan_id']
+
+_TIME_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"]
+
+
+def _to_timestamp(t):
+    ''' Convert a time (timestamp or "YYYY-mm-dd[ HH:MM[:SS]]") to a
+        timestamp.'''
+    if t is None or isinstance(t, (int, float)):
+        return t
+    for fmt in _TIME_FORMATS:
+        try:
+            return time.mktime(time.strptime(t, fmt))
+        except ValueError:
+            continue
+    raise ValueError("Time not understood : {}".format(t))
+
+
+def _fts_module(conn):
+    ''' Get the best full text search module available.'''
+    for module in ['fts5', 'fts4']:
+        try:
+            conn.execute("CREATE VIRTUAL TABLE temp.fts_test "
+                         "USING {}(a)".format(module))
+        except sqlite3.OperationalError:
+            continue
+        conn.execute("DROP TABLE temp.fts_test")
+        return module
+    return None
+
+
+class Catalog:
+    ''' A local SQLite catalog of start documents.
+
+        Parameters
+        ----------
+        filename : str, optional
+            the catalog file (default is catalog.sqlite in the storage
+            directory). ':memory:' for an in memory catalog.
+    '''
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(config.storagedir, "catalog.sqlite")
+        if filename != ':memory:':
+            dirname = os.path.dirname(filename)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+        self.filename = filename
+        self._conn = sqlite3.connect(filename)
+        self.fts = _fts_module(self._conn)
+        self._create_tables()
+
+    def _create_tables(self):
+        columns = ", ".join("{} TEXT".format(field)
+                            for field in CATALOG_FIELDS)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS headers "
+                               "(uid TEXT PRIMARY KEY, time REAL, "
+                               "scan_id INTEGER, {})".format(columns))
+            self._conn.execute("CREATE INDEX IF NOT EXISTS headers_time "
+                               "ON headers (time)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS headers_scan_id "
+                               "ON headers (scan_id)")
+            if self.fts is not None:
+                self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS "
+                                   "headers_fts USING {}({})"
+                                   .format(self.fts,
+                                           ", ".join(CATALOG_FIELDS)))
+
+    def add(self, start_docs):
+        ''' Add (or update) start documents to the catalog.
+
+            start_docs : a start document, or a list of them
+        '''
+        if isinstance(start_docs, dict):
+            start_docs = [start_docs]
+        rows = list()
+        for doc in start_docs:
+            row = [doc['uid'], doc['time'], doc.get('scan_id')]
+            for field in CATALOG_FIELDS:
+                val = doc.get(field)
+                row.append(None if val is None else str(val))
+            rows.append(row)
+
+        placeholders = ", ".join("?"*(len(CATALOG_FIELDS) + 3))
+        fts_placeholders = ", ".join("?"*(len(CATALOG_FIELDS) + 1))
+        with self._conn:
+            for row in rows:
+                # replace by hand, to keep the fts entry in sync
+                cur = self._conn.execute("SELECT rowid FROM headers "
+                                         "WHERE uid = ?", (row[0],))
+                old = cur.fetchone()
+                if old is not None:
+                    self._delete(old[0])
+                cur = self._conn.execute("INSERT INTO headers VALUES "
+                                         "({})".format(placeholders), row)
+                if self.fts is not None:
+                    self._conn.execute("INSERT INTO headers_fts "
+                                       "(rowid, {}) VALUES ({})"
+                                       .format(", ".join(CATALOG_FIELDS),
+                                               fts_placeholders),
+                                       [cur.lastrowid] + row[3:])
+
+    def _delete(self, rowid):
+        self._conn.execute("DELETE FROM headers WHERE rowid = ?", (rowid,))
+        if self.fts is not None:
+            self._conn.execute("DELETE FROM headers_fts WHERE rowid = ?",
+                               (rowid,))
+
+    def search(self, start_time=None, stop_time=None, text=None, limit=None,
+               **kwargs):
+        ''' Search the catalog.
+
+            Parameters
+            ----------
+            start_time, stop_time : float or str, optional
+                the time range (timestamps or "YYYY-mm-dd HH:MM:SS")
+
+            text : str, optional
+                a full text query, on all the indexed fields
+                (for ex: "AgBH*", "sample_savename:AgBH")
+
+            limit : int, optional
+                the maximum number of uids returned
+
+            kwargs : indexed fields to search for. scan_id is matched
+                exactly, the others as substrings (like search)
+
+            Returns
+            -------
+            the uids found, oldest first
+        '''
+        query = "SELECT headers.uid FROM headers"
+        conditions = list()
+        params = list()
+        if text is not None:
+            if self.fts is None:
+                raise ValueError("Full text search not available in this "
+                                 "version of SQLite")
+            query += " JOIN headers_fts ON headers_fts.rowid = headers.rowid"
+            conditions.append("headers_fts MATCH ?")
+            params.append(text)
+        start_time = _to_timestamp(start_time)
+        stop_time = _to_timestamp(stop_time)
+        if start_time is not None:
+            conditions.append("headers.time >= ?")
+            params.append(start_time)
+        if stop_time is not None:
+            conditions.append("headers.time <= ?")
+            params.append(stop_time)
+        for key, val in kwargs.items():
+            if key in CATALOG_EXACT_FIELDS:
+                conditions.append("headers.{} = ?".format(key))
+            elif key in CATALOG_FIELDS:
+                # instr is case sensitive, like search
+                conditions.append("instr(headers.{}, ?) > 0".format(key))
+            else:
+                raise ValueError("{} is not indexed, choose from "
+                                 "{}".format(key, CATALOG_FIELDS +
+                                             CATALOG_EXACT_FIELDS))
+            params.append(val)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY headers.time, headers.uid"
+        if limit is not None:
+            query += " LIMIT {:d}".format(limit)
+        return [row[0] for row in self._conn.execute(query, params)]
+
+    def last_time(self):
+        ''' The time of the latest header in the catalog (None if empty).'''
+        cur = self._conn.execute("SELECT max(time) FROM headers")
+        return cur.fetchone()[0]
+
+    def sync(self, dbname, start_time=None, wait=None, page_size=1000):
+        ''' Add the new headers of a database to the catalog.
+
+            dbname : the database name, for ex "cms:data"
+
+            start_time : index from this time on (default is from the latest
+                header in the catalog, or the beginning if empty)
+
+            wait : if None, return once caught up. Else, keep tailing the
+                database, polling every wait seconds.
+
+            Returns the number of headers added
+        '''
+        from SciAnalysis.interfaces.databroker.databroker import HeaderCursor
+        if start_time is None:
+            start_time = self.last_time()
+        if start_time is None:
+            start_time = 0
+        cursor = HeaderCursor(dbname, start_time=_to_timestamp(start_time),
+                              page_size=page_size)
+        nadded = 0
+        while True:
+            page = cursor.next_page()
+            if page:
+                self.add([header['start'] for header in page])
+                nadded += len(page)
+            elif wait is None:
+                return nadded
+            else:
+                time.sleep(wait)
+
+    def __len__(self):
+        cur = self._conn.execute("SELECT count(*) FROM headers")
+        return cur.fetchone()[0]
+
+    def close(self):
+        self._conn.close()
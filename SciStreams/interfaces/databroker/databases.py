@@ -10,9 +10,9 @@ import SciAnalysis.config as config
 
 # some handlers
 from filestore.handlers import DATHandler, NpyHandler
-from .handlers_custom import PNGHandler
+from .handlers_custom import PNGHandler, HDF5RowsHandler
 from SciAnalysis.interfaces.databroker.handlers_custom \
-        import AreaDetectorTiffHandler
+        import MemmapTiffHandler
 
 '''
     # register some handlers
@@ -30,10 +30,11 @@ analysis_handlers = {
     'JPG': PNGHandler,
     'DAT': DATHandler,
     'npy': NpyHandler,
+    'HDF5_ROWS': HDF5RowsHandler,
 }
 
 data_handlers = {
-    'AD_TIFF': AreaDetectorTiffHandler,
+    'AD_TIFF': MemmapTiffHandler,
 }
 
 
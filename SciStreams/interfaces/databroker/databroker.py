@@ -2,8 +2,14 @@
 ##################################################################
 # add to results for filestore to handle
 # see saveschematic.txt for deails
+import atexit
 import time
 from uuid import uuid4
+from functools import lru_cache, partial
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Event, Semaphore, Thread
 import numpy as np
 import matplotlib
 
@@ -12,7 +18,7 @@ import json
 
 from SciAnalysis.interfaces.databroker.writers_custom \
         import writers_dict as _writers_dict
-from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.StreamDoc import StreamDoc, LazyValue
 from metadatastore.core import NoEventDescriptors
 
 matplotlib.use("Agg")
@@ -26,11 +32,67 @@ _ANALYSIS_STORE_VERSION = 'beta-v2'
 # others not
 
 
-def Header2StreamDoc(header, dbname="cms:data", fill=True):
+# number of filestore datums kept in memory (per process) once loaded
+DATUM_CACHE_SIZE = 16
+
+
+@lru_cache(maxsize=DATUM_CACHE_SIZE)
+def _retrieve_datum(dbname, datum_id):
+    ''' Retrieve a datum. Arrays are made read only: the cached array is
+        shared by all its readers, so it must not be changed in place.'''
+    from SciAnalysis.interfaces.databroker.databases import databases
+    datum = databases[dbname].fs.retrieve(datum_id)
+    if isinstance(datum, np.ndarray):
+        datum.flags.writeable = False
+    return datum
+
+
+class DatumRef(LazyValue):
+    ''' Reference to a filestore datum, retrieved on first access.
+
+        Only the database name and datum id are kept, so this is cheap to
+        copy and pickle. Retrieved datums are kept in a per process LRU
+        cache (of DATUM_CACHE_SIZE entries), shared by all the references,
+        so arrays are read only (copy them to change them).
+    '''
+    def __init__(self, datum_id, dbname):
+        self.datum_id = datum_id
+        self.dbname = dbname
+
+    def load(self):
+        return _retrieve_datum(self.dbname, self.datum_id)
+
+    def token(self):
+        return self.dbname, self.datum_id
+
+    def __repr__(self):
+        return "DatumRef({!r}, {!r})".format(self.datum_id, self.dbname)
+
+
+def _external_keys(header, event):
+    ''' Get the data keys of an event stored in filestore.'''
+    descriptor = event.get('descriptor')
+    if not isinstance(descriptor, dict):
+        descriptor = header['descriptors'][0]
+    return set(key for key, val in descriptor['data_keys'].items()
+               if val.get('external'))
+
+
+def Header2StreamDoc(header, dbname="cms:data", fill=True, lazy=True):
     ''' Convert a header to a StreamDoc.
 
         Note: This assumes header contains only one event.
             Need to add to function if dealing with multiple events.
+
+        Parameters
+        ----------
+        fill : bool or list of str, optional
+            the external (filestore) fields to fill. True fills all of
+            them, False leaves datum ids.
+
+        lazy : bool, optional
+            if True, filled fields are DatumRefs, only retrieved when a
+            function uses them. Else, they're retrieved now.
     '''
     sdoc = StreamDoc()
     attributes = header['start'].copy()
@@ -41,17 +103,30 @@ def Header2StreamDoc(header, dbname="cms:data", fill=True):
 
     db = databases[dbname]
 
-    # Assume first event
+    # Assume first event, only read that one
     try:
-        event = list(db.get_events(header, fill=fill))[0]
-        eventdata = event['data']
-    except IndexError:
+        event = next(iter(db.get_events(header, fill=False)))
+        eventdata = dict(event['data'])
+        external_keys = _external_keys(header, event)
+    except StopIteration:
         # there are no events
         print("Found no events")
-        eventdata = []
+        eventdata = {}
+        external_keys = set()
     except KeyError:
         print("Event was corrupt")
-        eventdata = []
+        eventdata = {}
+        external_keys = set()
+
+    if fill is True:
+        fill = external_keys
+    elif fill is False:
+        fill = []
+    for key in external_keys.intersection(fill):
+        if lazy:
+            eventdata[key] = DatumRef(eventdata[key], dbname)
+        else:
+            eventdata[key] = _retrieve_datum(dbname, eventdata[key])
 
     sdoc.add(kwargs=eventdata)
 
@@ -99,7 +174,7 @@ def pullrecent(dbname, protocol_name=None, **kwargs):
     return sdoc
 
 
-def pullfromuid(uid, dbname=None):
+def pullfromuid(uid, dbname=None, fill=True, lazy=True):
     ''' Pull from a databroker database from a uid
 
         Parameters
@@ -113,6 +188,8 @@ def pullfromuid(uid, dbname=None):
 
         uid : the uid of dataset
 
+        fill, lazy : how to fill external fields, see Header2StreamDoc
+
         Returns
         -------
         StreamDoc of data
@@ -135,17 +212,294 @@ def pullfromuid(uid, dbname=None):
     # serializable)
     header = dict(db[uid])
 
-    scires = Header2StreamDoc(header, dbname)
+    scires = Header2StreamDoc(header, dbname, fill=fill, lazy=lazy)
 
     return scires
 
 
-def pullfromuids(dbname, uids):
+def _header_key(header):
+    ''' Sort key for headers, (time, uid) so that ties are ordered.'''
+    return header['start']['time'], header['start']['uid']
+
+
+def _safe_Header2StreamDoc(header, dbname, **kwargs):
+    ''' Header2StreamDoc, returning None for headers that can't be read.'''
+    try:
+        return Header2StreamDoc(header, dbname=dbname, **kwargs)
+    except FileNotFoundError:
+        print('Warning (databroker) : File not found')
+    except NoEventDescriptors:
+        print('Warning (databroker) : no event desc')
+    except IndexError:  # no events
+        print('Warning (databroker) : index error')
+    return None
+
+
+def read_ahead(items, load, depth=4):
+    ''' Load the next items in background threads, yielding them in order.
+
+        items is iterated and load(item) run on up to depth items ahead
+        of the one being consumed, so that I/O overlaps with the processing
+        of the current result. Items for which load returns None are
+        skipped.
+
+        Parameters
+        ----------
+        items : iterable
+            iterated in a background thread (so a source that waits for
+            new items, like HeaderCursor.headers, is fine)
+
+        load : callable
+            the function to run on each item
+
+        depth : int, optional
+            the maximum number of results loaded ahead
+
+        Examples
+        --------
+        >>> for sdoc in read_ahead(uids, partial(pullfromuid, dbname=dbname,
+        ...                                      lazy=False)):
+        ...     sin.emit(sdoc)
+    '''
+    if depth < 1:
+        raise ValueError("depth must be at least 1 (got {})".format(depth))
+    # futures of the loaded items, in order, then None when done
+    results = Queue()
+    slots = Semaphore(depth)
+    stopped = Event()
+    executor = ThreadPoolExecutor(max_workers=depth)
+
+    def feed():
+        try:
+            for item in items:
+                # wait for a free slot, but notice if the consumer left
+                while not slots.acquire(timeout=.1):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                results.put(executor.submit(load, item))
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    feeder = Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            future = results.get()
+            if future is None:
+                break
+            if isinstance(future, Exception):
+                raise future
+            res = future.result()
+            slots.release()
+            if res is not None:
+                yield res
+    finally:
+        stopped.set()
+        executor.shutdown(wait=False)
+
+
+def _load_header(header, dbname, read_ahead_fields=None, **kwargs):
+    ''' Header2StreamDoc, loading the data of read_ahead_fields now (all
+        the external fields if None), for read ahead.
+
+        The StreamDoc keeps its DatumRefs, the data loaded ahead is in the
+        datum cache (see _retrieve_datum) for when the pipeline uses it.
+    '''
+    sdoc = _safe_Header2StreamDoc(header, dbname, **kwargs)
+    if sdoc is None:
+        return None
+    for key, val in sdoc['kwargs'].items():
+        if not isinstance(val, DatumRef):
+            continue
+        if read_ahead_fields is not None and key not in read_ahead_fields:
+            continue
+        try:
+            val.load()
+        except Exception as e:
+            # the pipeline gets the error when it uses the field
+            print("Warning (databroker) : could not read ahead " +
+                  "{} ({})".format(key, e))
+    return sdoc
+
+
+def pullfromuids(dbname, uids, read_ahead_depth=0, **kwargs):
+    ''' Pull a batch of uids from a databroker database.
+
+        The headers are looked up in one query. StreamDocs are yielded in the
+        order of uids; uids not found are skipped with a warning.
+
+        read_ahead_depth : if not 0, load this many StreamDocs (with their
+            data) ahead in background threads, see read_ahead
+
+        read_ahead_fields : the fields whose data is loaded ahead (default,
+            all the external fields)
+
+        kwargs are passed to Header2StreamDoc (fill, lazy)
+    '''
+    from SciAnalysis.interfaces.databroker.databases import databases
+    db = databases[dbname]
+    uids = list(uids)
+    headers = dict()
+    for header in db(uid={'$in': uids}):
+        headers[header['start']['uid']] = header
+    found = list()
     for uid in uids:
-        yield pullfromuid(dbname, uid)
+        if uid not in headers:
+            print("Warning (databroker) : uid {} not found".format(uid))
+            continue
+        found.append(headers[uid])
+    yield from _headers2sdocs(found, dbname, read_ahead_depth, **kwargs)
+
+
+def _headers2sdocs(headers, dbname, read_ahead_depth=0,
+                   read_ahead_fields=None, **kwargs):
+    ''' Convert headers to StreamDocs, skipping those that can't be read.'''
+    if read_ahead_depth:
+        load = partial(_load_header, dbname=dbname,
+                       read_ahead_fields=read_ahead_fields, **kwargs)
+        yield from read_ahead(headers, load, depth=read_ahead_depth)
+        return
+    for header in headers:
+        sdoc = _safe_Header2StreamDoc(header, dbname, **kwargs)
+        if sdoc is not None:
+            yield sdoc
+
+
+class HeaderCursor:
+    ''' Incremental feed of the new headers of a database.
+
+        The cursor keeps a watermark of the time of the last header returned
+        along with the uids returned at that time, so no header is skipped or
+        repeated, even for headers with the same time. The database is
+        queried a time range (of page_span seconds) at a time, the headers
+        past the watermark are then handed out oldest first, page_size at a
+        time, before the next query. The last range is open ended (up to
+        now).
+
+        Parameters
+        ----------
+        dbname : str
+            the database name, for ex "cms:data"
+
+        start_time : float, optional
+            only return headers from this time on (default is now)
 
+        page_size : int, optional
+            the maximum number of headers returned by next_page
 
-def pull(dbname, protocol_name=None, **kwargs):
+        page_span : float, optional
+            the time range (in seconds) of a query (None for a single open
+            ended query)
+
+        seen : list of str, optional
+            the uids at start_time already processed (to resume after them,
+            see checkpoint.py)
+
+        Examples
+        --------
+        >>> cursor = HeaderCursor("cms:data", start_time=time.time()-3600)
+        >>> for sdoc in cursor.sdocs(wait=1):
+        ...     sin.emit(sdoc)
+    '''
+    def __init__(self, dbname, start_time=None, page_size=100, seen=(),
+                 page_span=24*3600):
+        if start_time is None:
+            start_time = time.time()
+        self.dbname = dbname
+        self.page_size = page_size
+        self.page_span = page_span
+        # watermark
+        self.time = start_time
+        self._seen = set(seen)
+        # the time ranges before this were queried and are empty
+        self._query_time = start_time
+        # headers fetched but not handed out yet
+        self._fetched = deque()
+
+    def _after_watermark(self, header):
+        t, uid = _header_key(header)
+        return t > self.time or (t == self.time and uid not in self._seen)
+
+    def _fetch(self):
+        ''' Query the time ranges from the watermark on, until one has new
+            headers or the open ended range (up to now) is reached.'''
+        from SciAnalysis.interfaces.databroker.databases import databases
+        db = databases[self.dbname]
+        start_time = max(self.time, self._query_time)
+        while True:
+            query = dict(start_time=start_time)
+            stop_time = None
+            if self.page_span is not None and \
+                    start_time + self.page_span < time.time():
+                stop_time = start_time + self.page_span
+                query['stop_time'] = stop_time
+            headers = [header for header in db(**query)
+                       if self._after_watermark(header)]
+            if headers or stop_time is None:
+                break
+            start_time = stop_time
+            # don't query empty ranges again, unless they're recent (the
+            # headers of a run may be inserted a bit after its start time)
+            if stop_time < time.time() - self.page_span:
+                self._query_time = stop_time
+        headers.sort(key=_header_key)
+        self._fetched.extend(headers)
+
+    def next_page(self):
+        ''' Get the next (at most page_size) new headers, oldest first.
+
+            Returns an empty list if there are no new headers.
+        '''
+        if len(self._fetched) == 0:
+            self._fetch()
+        page = list()
+        while self._fetched and len(page) < self.page_size:
+            page.append(self._fetched.popleft())
+        for header in page:
+            t, uid = _header_key(header)
+            if t != self.time:
+                self.time = t
+                self._seen = set()
+            self._seen.add(uid)
+        return page
+
+    def headers(self, wait=None):
+        ''' Yield the new headers, in order.
+
+            wait : if None, return once caught up. Else, keep polling for new
+                headers, waiting this many seconds when there are none.
+        '''
+        while True:
+            page = self.next_page()
+            if not page:
+                if wait is None:
+                    return
+                time.sleep(wait)
+                continue
+            yield from page
+
+    def sdocs(self, wait=None, read_ahead_depth=0, **kwargs):
+        ''' Yield the StreamDocs of new headers, in order.
+
+            wait : see headers
+
+            read_ahead_depth : if not 0, load this many StreamDocs (with
+                their data) ahead in background threads, see read_ahead
+
+            read_ahead_fields : the fields whose data is loaded ahead
+                (default, all the external fields)
+
+            kwargs are passed to Header2StreamDoc (fill, lazy)
+        '''
+        return _headers2sdocs(self.headers(wait=wait), self.dbname,
+                              read_ahead_depth, **kwargs)
+
+
+def pull(dbname, protocol_name=None, read_ahead_depth=0, **kwargs):
     ''' Pull from a databroker database
         keeps yielding results until exhausted
 
@@ -160,6 +514,9 @@ def pull(dbname, protocol_name=None, **kwargs):
 
         protocol_name : the protocol name used (if analysis database)
 
+        read_ahead_depth : if not 0, load this many StreamDocs (with their
+            data) ahead in background threads, see read_ahead
+
         kwargs : entries in metadatabase to search for. searches for exact
         matches. See search for searching for substrings
 
@@ -178,30 +535,26 @@ def pull(dbname, protocol_name=None, **kwargs):
     # search and get latest
     headers = db(**kwargs)
 
-    for header in headers:
-        try:
-            sdoc = Header2StreamDoc(header, dbname=dbname)
-            # print('got item')
-        except FileNotFoundError:
-            print('Warning (databroker) : File not found')
-            continue
-        except NoEventDescriptors:
-            print('Warning (databroker) : no event desc')
-            continue
-        except IndexError:  # no events
-            print('Warning (databroker) : index error')
-            continue
-
-        yield sdoc
+    yield from _headers2sdocs(headers, dbname, read_ahead_depth)
 
 
-def search(dbname, start_time=None, stop_time=None, **kwargs):
+def search(dbname, start_time=None, stop_time=None, catalog=None,
+           **kwargs):
     ''' search database for a substring in one of the fields.
 
+        catalog : a Catalog (see catalog.py) of the database. If given, it's
+            searched instead of the headers (only for the fields it indexes)
+
         TODO : allow start and stop times to be numbers (number of seconds
         before now)
 
     '''
+    if catalog is not None:
+        uids = catalog.search(start_time=start_time, stop_time=stop_time,
+                              **kwargs)
+        # newest first, like databroker
+        yield from pullfromuids(dbname, reversed(uids))
+        return
     # Returns a StreamDoc Basically the StreamDoc constructor for databroker
     from SciAnalysis.interfaces.databroker.databases import databases
     # TODO : Remove the initialization when moving from sqlite to other
@@ -231,10 +584,83 @@ def search(dbname, start_time=None, stop_time=None, **kwargs):
                 yield StopIteration
 
 
+# arrays with more elements are not put in documents
+INLINE_ARRAY_MAX_SIZE = 1000
+# the writer of the arrays too big for the event documents
+AUTO_EXTERNAL_WRITER = 'hdf5'
+
+
+def encode_array(val):
+    ''' Encode a (small) numpy array as a typed list, see decode_array.
+
+        Complex arrays are encoded as (real, imag) pairs, object arrays as the
+        flat list of their (parsed) elements.
+    '''
+    if val.dtype.hasobject:
+        data = [safe_parse_databroker(v, nested=True) for v in val.ravel()]
+    elif val.dtype.kind == 'c':
+        data = np.stack((val.real, val.imag), axis=-1).tolist()
+    else:
+        data = val.tolist()
+    return dict(__ndarray__=data, dtype=val.dtype.str, shape=list(val.shape))
+
+
+def decode_array(val):
+    ''' Decode an array encoded by encode_array.'''
+    dtype = np.dtype(val['dtype'])
+    if dtype.hasobject:
+        data = val['__ndarray__']
+        arr = np.empty(len(data), dtype=object)
+        for i, v in enumerate(data):
+            arr[i] = _decode_nested(v)
+    elif dtype.kind == 'c':
+        pairs = np.array(val['__ndarray__'], dtype=float)
+        arr = (pairs[..., 0] + 1j*pairs[..., 1]).astype(dtype)
+    else:
+        arr = np.array(val['__ndarray__'], dtype=dtype)
+    return arr.reshape(val['shape'])
+
+
+def summarize_array(val):
+    ''' Summarize a (large) array : its shape, dtype and statistics.'''
+    summary = dict(shape=list(val.shape), dtype=val.dtype.str)
+    if val.size and val.dtype.kind in 'biuf':
+        summary.update(min=float(np.nanmin(val)), max=float(np.nanmax(val)),
+                       mean=float(np.nanmean(val)))
+    return summary
+
+
+def decode_databroker(val):
+    ''' Decode a value parsed by safe_parse_databroker.
+
+        Arrays are decoded back to numpy arrays (the summaries of arrays that
+        were too large are left as dicts).
+    '''
+    if isinstance(val, str):
+        try:
+            val = json.loads(val)
+        except ValueError:
+            return val
+    return _decode_nested(val)
+
+
+def _decode_nested(val):
+    if isinstance(val, dict):
+        if '__ndarray__' in val:
+            return decode_array(val)
+        return {key: _decode_nested(subval) for key, subval in val.items()}
+    elif isinstance(val, list):
+        return [_decode_nested(v) for v in val]
+    return val
+
+
 def safe_parse_databroker(val, nested=False):
     ''' Parse an arg, make sure it's safe for databroker.
-        Also, if it's a huge numpy array, it'll be truncated.
-            Big arrays shouldn't be here.
+
+        Numpy arrays of up to INLINE_ARRAY_MAX_SIZE elements, and object
+        arrays, are encoded as typed lists (see encode_array). Larger ones are
+        replaced by a summary (see summarize_array), they should go to
+        filestore instead.
     '''
     if isinstance(val, dict):
         for key, subval in val.items():
@@ -246,8 +672,13 @@ def safe_parse_databroker(val, nested=False):
         newval = list([safe_parse_databroker(v, nested=True) for v in val])
         val = newval
     elif isinstance(val, np.ndarray):
-        # don't print the full np array to databroker
-        val = repr(val)
+        if val.dtype.hasobject or val.size <= INLINE_ARRAY_MAX_SIZE:
+            val = encode_array(val)
+        else:
+            val = dict(__summary__=summarize_array(val))
+    elif isinstance(val, np.generic):
+        # numpy scalars, to their python type
+        val = val.item()
     elif np.isscalar(val):
         # convenient to check if it's a number
         pass
@@ -286,21 +717,40 @@ def make_descriptor(val):
 # a decorator
 
 
-def store_results_databroker(sdoc, dbname=None, external_writers={}):
+def store_results_databroker(sdoc, dbname=None, external_writers={},
+                             background=False):
     ''' Save results to a databroker instance.
         Takes a streamdoc instance.
+
+        background : if True, the results are written by the database's
+            DatabrokerWriter (see get_databroker_writer) and this returns
+            right away.
     '''
     if dbname is None:
         raise ValueError("No database selected. Cancelling.")
+    if background:
+        get_databroker_writer(dbname).submit(sdoc,
+                                             external_writers=external_writers)
+        return
     # TODO : change this when in mongodb
     from SciAnalysis.interfaces.databroker.databases import databases
     # TODO : check for time out on database access, return an erorr that makes
     # sense
     db = databases[dbname]
 
-    # saving to databroker
-    mds = db.mds  # metadatastore
+    docs, external = _make_documents(sdoc, external_writers)
+    # reuse the writers, some append to open files
+    writers = _writers.setdefault(dbname, dict())
+    _write_external(db.fs, docs, external, writers)
+    _insert_run(db.mds, docs, set())
+
+
+def _make_documents(sdoc, external_writers):
+    ''' Make the start, descriptor, event and stop documents of a result.
 
+        The data of external keys isn't written, it's returned as a list of
+        (key, writer key, data) for _write_external.
+    '''
     # Store in databroker, make the documents
     start_doc = dict()
 
@@ -330,6 +780,7 @@ def store_results_databroker(sdoc, dbname=None, external_writers={}):
     event_doc['descriptor'] = descriptor_doc['uid']
     event_doc['seq_num'] = 1
 
+    external = list()
     # then parse remaining data
     for key, val in sdoc['kwargs'].items():
         if key[0] == '_':
@@ -338,22 +789,14 @@ def store_results_databroker(sdoc, dbname=None, external_writers={}):
         descriptor_doc['data_keys'][key] = make_descriptor(val)
         # save to filestore
         if key in external_writers:
-            writer_key = external_writers[key]
-            if writer_key not in _writers_dict:
-                print("Databroker writer : Error, " +
-                      "key {} ".format(writer_key) +
-                      "not present in writers dict." +
-                      " Allowed keys : {}".format(_writers_dict.keys()))
-                event_doc['data'][key] = 'Error'
-            writer = _writers_dict[writer_key](db.fs)
-            # TODO : Move this assumption of file path elsewhere?
-            time_now = time.localtime()
-            subpath = "/{:04}/{:02}/{:02}".format(time_now.tm_year,
-                                                  time_now.tm_mon,
-                                                  time_now.tm_mday)
-            new_id = writer.write(val, subpath=subpath)
-            event_doc['data'][key] = new_id
+            external.append((key, external_writers[key], val))
             descriptor_doc['data_keys'][key].update(external="FILESTORE:")
+        elif isinstance(val, np.ndarray) and not val.dtype.hasobject \
+                and val.size > INLINE_ARRAY_MAX_SIZE:
+            # too large for the event, goes to filestore with a summary
+            external.append((key, AUTO_EXTERNAL_WRITER, val))
+            descriptor_doc['data_keys'][key].update(
+                external="FILESTORE:", summary=summarize_array(val))
         else:
             event_doc['data'][key] = safe_parse_databroker(val)
         event_doc['timestamps'][key] = time.time()
@@ -364,7 +807,228 @@ def store_results_databroker(sdoc, dbname=None, external_writers={}):
     stop_doc['run_start'] = start_doc['uid']
     stop_doc['exit_status'] = 'success'
 
-    mds.insert('start', start_doc)
-    mds.insert('descriptor', descriptor_doc)
-    mds.insert('event', event_doc)
-    mds.insert('stop', stop_doc)
+    docs = dict(start=start_doc, descriptor=descriptor_doc, event=event_doc,
+                stop=stop_doc)
+    return docs, external
+
+
+def _write_external(fs, docs, external, writers):
+    ''' Write external data to filestore, putting the datum ids in the event.
+
+        writers : the writer instances, by writer key. Missing ones are
+            created (and added).
+    '''
+    for key, writer_key, val in external:
+        if writer_key not in _writers_dict:
+            print("Databroker writer : Error, " +
+                  "key {} ".format(writer_key) +
+                  "not present in writers dict." +
+                  " Allowed keys : {}".format(_writers_dict.keys()))
+            docs['event']['data'][key] = 'Error'
+            continue
+        if writer_key not in writers:
+            writers[writer_key] = _writers_dict[writer_key](fs)
+        writer = writers[writer_key]
+        # TODO : Move this assumption of file path elsewhere?
+        time_now = time.localtime()
+        subpath = "/{:04}/{:02}/{:02}".format(time_now.tm_year,
+                                              time_now.tm_mon,
+                                              time_now.tm_mday)
+        new_id = writer.write(val, subpath=subpath, key=key)
+        docs['event']['data'][key] = new_id
+
+
+def _insert_run(mds, docs, inserted):
+    ''' Insert the documents of a result (a run) not inserted yet.
+
+        inserted is the set of the names of the documents already inserted,
+        updated as they are. The stop document is inserted last, so a run
+        without a stop in the database is one that was partly inserted. It
+        can be retried by calling this again with the same inserted set.
+    '''
+    for name in ['start', 'descriptor', 'event', 'stop']:
+        if name not in inserted:
+            mds.insert(name, docs[name])
+            inserted.add(name)
+
+
+class DatabrokerWriter:
+    ''' Write results to a databroker database in a background thread.
+
+        submit queues a result and returns; a thread writes the external
+        data (reusing one writer per writer key) and inserts the documents
+        of up to batch_size queued results at a time. The documents are made
+        when submitted, so they're the same as with store_results_databroker.
+
+        Parameters
+        ----------
+        dbname : str
+            the database name, for ex "cms:analysis"
+
+        maxsize : int, optional
+            the maximum number of results queued. submit blocks when full.
+
+        batch_size : int, optional
+            the maximum number of results inserted together
+
+        max_retries : int, optional
+            the number of times the insertion of a run that failed part way
+            is retried (every retry_interval seconds, and with each batch)
+
+        Notes
+        -----
+        Runs are inserted one at a time, stop document last. A run which
+        failed part way is retried from the first document not inserted,
+        so it isn't inserted twice. Runs still incomplete after max_retries
+        are given up on (counted as failed, their uids printed).
+    '''
+    def __init__(self, dbname, maxsize=100, batch_size=16, max_retries=3,
+                 retry_interval=1.):
+        self.dbname = dbname
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self._queue = Queue(maxsize=maxsize)
+        self._writers = dict()
+        self._closed = False
+        # [submit time, docs, names inserted, number of tries] of the runs
+        # partly inserted
+        self._partial = deque()
+        # metrics
+        self.nwritten = 0
+        self.nfailed = 0
+        self.latencies = deque(maxlen=1000)
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, sdoc, external_writers={}):
+        ''' Queue a result (a StreamDoc) to be saved.'''
+        if self._closed:
+            raise RuntimeError('This writer has been closed.')
+        docs, external = _make_documents(sdoc, external_writers)
+        # copy arrays, the pipeline may reuse them
+        external = [(key, writer_key, np.array(val, copy=True))
+                    if isinstance(val, np.ndarray) else
+                    (key, writer_key, val)
+                    for key, writer_key, val in external]
+        self._queue.put((time.time(), docs, external))
+
+    def _insert(self, mds, runs):
+        ''' Insert runs ([submit time, docs, names inserted, tries]), in
+            order. The ones that fail are kept to be retried.'''
+        for run in runs:
+            t0, docs, inserted, tries = run
+            try:
+                _insert_run(mds, docs, inserted)
+            except Exception as e:
+                run[3] += 1
+                uid = docs['start']['uid']
+                if run[3] > self.max_retries:
+                    print("Databroker writer : Error, giving up on run "
+                          "{} ({}), inserted : {}".format(uid, e,
+                                                          sorted(inserted)))
+                    self.nfailed += 1
+                else:
+                    print("Databroker writer : Error inserting run "
+                          "{} ({}), will retry".format(uid, e))
+                    self._partial.append(run)
+                continue
+            self.nwritten += 1
+            self.latencies.append(time.time() - t0)
+
+    def _run(self):
+        from SciAnalysis.interfaces.databroker.databases import databases
+        db = databases[self.dbname]
+        done = False
+        while not done:
+            try:
+                if self._partial:
+                    items = [self._queue.get(timeout=self.retry_interval)]
+                else:
+                    items = [self._queue.get()]
+            except Empty:
+                items = list()
+            while items and len(items) < self.batch_size and \
+                    items[-1] is not None:
+                try:
+                    items.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if items and items[-1] is None:
+                done = True
+            # the runs partly inserted are retried first, to keep the order
+            runs = list(self._partial)
+            self._partial.clear()
+            for item in items:
+                if item is None:
+                    continue
+                t0, docs, external = item
+                try:
+                    _write_external(db.fs, docs, external, self._writers)
+                except Exception as e:
+                    print("Databroker writer : Error writing external "
+                          "data ({})".format(e))
+                    self.nfailed += 1
+                    continue
+                runs.append([t0, docs, set(), 0])
+            self._insert(db.mds, runs)
+            for item in items:
+                self._queue.task_done()
+        # closed, retry the runs partly inserted before stopping
+        while self._partial:
+            time.sleep(self.retry_interval)
+            runs = list(self._partial)
+            self._partial.clear()
+            self._insert(db.mds, runs)
+
+    def flush(self):
+        ''' Wait for all the queued results to be written (the runs which
+            are retried may not be).'''
+        self._queue.join()
+
+    def close(self):
+        ''' Write the queued results and stop the writer thread.'''
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        for writer in self._writers.values():
+            writer.close()
+
+    def metrics(self):
+        ''' Get the backlog, counts and write latencies (in seconds).'''
+        latencies = list(self.latencies)
+        return dict(backlog=self._queue.qsize(), written=self.nwritten,
+                    failed=self.nfailed, retrying=len(self._partial),
+                    latency_mean=np.mean(latencies) if latencies else None,
+                    latency_max=max(latencies) if latencies else None)
+
+
+# the background writers, by database name
+_databroker_writers = dict()
+# the filestore writers of store_results_databroker, by database name
+_writers = dict()
+
+
+def get_databroker_writer(dbname, **kwargs):
+    ''' Get the background writer of a database (created if needed).
+
+        The writers are flushed and closed at exit.
+        kwargs are passed to DatabrokerWriter when created.
+    '''
+    if dbname not in _databroker_writers:
+        _databroker_writers[dbname] = DatabrokerWriter(dbname, **kwargs)
+    return _databroker_writers[dbname]
+
+
+@atexit.register
+def close_databroker_writers():
+    ''' Flush and close all the background and filestore writers.'''
+    while _databroker_writers:
+        _, writer = _databroker_writers.popitem()
+        writer.close()
+    while _writers:
+        _, writers = _writers.popitem()
+        for writer in writers.values():
+            writer.close()
@@ -0,0 +1,222 @@
+''' Live ingest of documents from a bluesky RunEngine.
+
+    Rather than polling databroker for new headers, subscribe to the
+    documents the RunEngine publishes over ZeroMQ (bluesky's Publisher,
+    usually through a 0MQ proxy). The documents of each run are assembled
+    into a StreamDoc as soon as its stop document arrives.
+
+    Messages are expected in the Publisher format:
+        b"<prefix> <document name> <serialized document>"
+'''
+from collections import OrderedDict
+import json
+import time
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+
+
+def documents2StreamDoc(start, descriptors, event, stop=None, dbname=None):
+    ''' Make a StreamDoc from the documents of a run.
+
+        This follows Header2StreamDoc: attributes come from the start
+        document, kwargs from the (first) event.
+
+        Parameters
+        ----------
+        start : dict
+            the start document
+
+        descriptors : dict
+            the descriptor documents of the run, by uid
+
+        event : dict or None
+            the first event of the run
+
+        stop : dict, optional
+            the stop document (currently unused)
+
+        dbname : str, optional
+            the database the run's external data is registered in. If given,
+            external fields are DatumRefs to this database. Else, they are
+            left as datum ids.
+    '''
+    sdoc = StreamDoc()
+    attributes = dict(start)
+    attributes['data_uid'] = attributes['uid']
+    sdoc.add(attributes=attributes)
+
+    if event is None:
+        print("Found no events")
+        return sdoc
+
+    eventdata = dict(event['data'])
+    descriptor = descriptors.get(event['descriptor'], {})
+    if dbname is not None:
+        from SciAnalysis.interfaces.databroker.databroker import DatumRef
+        for key, val in descriptor.get('data_keys', {}).items():
+            if val.get('external') and key in eventdata:
+                eventdata[key] = DatumRef(eventdata[key], dbname)
+
+    sdoc.add(kwargs=eventdata)
+
+    return sdoc
+
+
+class RunAssembler:
+    ''' Collect the documents of runs, by run start uid.
+
+        update(name, doc) returns the StreamDoc of a run when its stop
+        document is received, else None. Only the first event of each run
+        is kept.
+
+        Runs whose stop document never comes (the RunEngine died, messages
+        were lost) are dropped with a warning, once more than max_runs
+        runs are in progress or max_age seconds after their start document
+        was received (None for no limit).
+    '''
+    def __init__(self, dbname=None, max_runs=100, max_age=24*3600):
+        self.dbname = dbname
+        self.max_runs = max_runs
+        self.max_age = max_age
+        # run start uid -> run, oldest first
+        self._runs = OrderedDict()
+        # descriptor uid -> run start uid
+        self._descriptors = dict()
+        # number of runs dropped
+        self.ndropped = 0
+
+    def _drop(self, uid):
+        run = self._runs.pop(uid)
+        for desc_uid in run['descriptors']:
+            self._descriptors.pop(desc_uid, None)
+        return run
+
+    def _drop_stale(self):
+        now = time.time()
+        while self._runs:
+            uid, run = next(iter(self._runs.items()))
+            too_many = self.max_runs is not None and \
+                len(self._runs) > self.max_runs
+            too_old = self.max_age is not None and \
+                now - run['received'] > self.max_age
+            if not too_many and not too_old:
+                break
+            print("Document listener : Warning, dropping run {} ".format(uid) +
+                  "(no stop document received)")
+            self._drop(uid)
+            self.ndropped += 1
+
+    def update(self, name, doc):
+        if name == 'start':
+            self._runs[doc['uid']] = dict(start=doc, descriptors=dict(),
+                                          event=None, received=time.time())
+            self._drop_stale()
+        elif name == 'descriptor':
+            run = self._runs.get(doc['run_start'])
+            if run is not None:
+                run['descriptors'][doc['uid']] = doc
+                self._descriptors[doc['uid']] = doc['run_start']
+        elif name == 'event':
+            run = self._runs.get(self._descriptors.get(doc['descriptor']))
+            if run is not None and run['event'] is None:
+                run['event'] = doc
+        elif name == 'stop':
+            if doc['run_start'] not in self._runs:
+                # started before we subscribed (or dropped)
+                return None
+            run = self._drop(doc['run_start'])
+            return documents2StreamDoc(run['start'], run['descriptors'],
+                                       run['event'], stop=doc,
+                                       dbname=self.dbname)
+        return None
+
+    def __len__(self):
+        ''' number of runs in progress.'''
+        return len(self._runs)
+
+
+def parse_message(message, deserializer=json.loads):
+    ''' Split a Publisher message into the document name and document.'''
+    prefix, name, doc = message.split(b' ', 2)
+    return name.decode(), deserializer(doc)
+
+
+class DocumentListener:
+    ''' Subscribe to a RunEngine document stream and emit StreamDocs.
+
+        Parameters
+        ----------
+        address : str
+            the 0MQ address to connect to, for ex: "tcp://localhost:5578"
+            (the out port of the 0MQ proxy)
+
+        callback : callable
+            called with each run's StreamDoc, usually a stream's emit
+
+        prefix : bytes, optional
+            only listen to messages with this prefix
+
+        dbname : str, optional
+            the database external data is registered in,
+            see documents2StreamDoc
+
+        deserializer : callable, optional
+            to decode documents (json.loads by default, pickle.loads for
+            newer bluesky Publishers)
+    '''
+    def __init__(self, address, callback, prefix=b'', dbname=None,
+                 deserializer=json.loads):
+        import zmq
+        self.address = address
+        self.callback = callback
+        self.deserializer = deserializer
+        self.assembler = RunAssembler(dbname=dbname)
+        self._context = zmq.Context()
+        self._socket = self._context.socket(zmq.SUB)
+        self._socket.connect(address)
+        self._socket.setsockopt(zmq.SUBSCRIBE, prefix)
+        self._poller = zmq.Poller()
+        self._poller.register(self._socket, zmq.POLLIN)
+        self._running = False
+
+    def run(self, max_runs=None, timeout=None):
+        ''' Listen and dispatch until stopped.
+
+            max_runs : stop after this many runs were emitted
+            timeout : stop if no message came for this many seconds
+        '''
+        nruns = 0
+        self._running = True
+        last_message = time.time()
+        while self._running:
+            # poll so that stop() is noticed while waiting
+            events = dict(self._poller.poll(100))
+            if self._socket not in events:
+                if timeout is not None and \
+                        time.time() - last_message > timeout:
+                    break
+                continue
+            last_message = time.time()
+            message = self._socket.recv()
+            try:
+                name, doc = parse_message(message,
+                                          deserializer=self.deserializer)
+                sdoc = self.assembler.update(name, doc)
+            except (ValueError, KeyError) as e:
+                print("Document listener : could not parse "
+                      "message ({})".format(e))
+                continue
+            if sdoc is not None:
+                self.callback(sdoc)
+                nruns += 1
+                if max_runs is not None and nruns >= max_runs:
+                    break
+        self._running = False
+        return nruns
+
+    def stop(self):
+        self._running = False
+
+    def close(self):
+        self._socket.close()
+        self._context.term()
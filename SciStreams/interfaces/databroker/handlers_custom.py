@@ -2,10 +2,26 @@ from filestore.handlers import AreaDetectorTiffHandler  # noqa
 from PIL import Image
 import re
 import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import numpy as np
 import h5py
 from pims import FramesSequence, Frame
 
+# optional, for the raw chunk decompression of the Eiger readers
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
 
 # create quick handler
 class PNGHandler:
@@ -24,9 +40,560 @@ class DICTHandler:
     def __call__(self, **kwargs):
         return np.array(Image.open(self.fpath))
 
+
+class HDF5RowsHandler:
+    ''' Read the rows written by HDF5RowsWriter.
+
+        The file is opened once (in SWMR mode, it may still be appended to)
+        and kept open, so reading a row only reads its chunk.
+    '''
+    def __init__(self, fpath, **kwargs):
+        self.fpath = fpath
+        self._file = None
+        self._dset = None
+
+    def _open(self):
+        if self._file is None:
+            self._file = h5py.File(self.fpath, "r", swmr=True)
+            self._dset = self._file["data"]
+        return self._dset
+
+    def __call__(self, row, **kwargs):
+        dset = self._open()
+        if row >= dset.shape[0]:
+            # written since opened
+            dset.refresh()
+        return dset[row]
+
+    def get_rows(self, rows):
+        ''' Read several rows at once (in one hdf5 read).'''
+        dset = self._open()
+        rows = np.asarray(rows)
+        if len(rows) and rows.max() >= dset.shape[0]:
+            dset.refresh()
+        # hdf5 needs sorted, unique indices
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        return dset[unique_rows][inverse]
+
+    def get_file_list(self, datum_kwarg_gen):
+        return [self.fpath]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._dset = None
+
+
+# TIFF tags needed to locate the pixel data
+_TIFF_TAGS = {
+    256: 'width',
+    257: 'height',
+    258: 'bits_per_sample',
+    259: 'compression',
+    273: 'strip_offsets',
+    277: 'samples_per_pixel',
+    279: 'strip_byte_counts',
+    339: 'sample_format',
+}
+# TIFF field type : struct format
+_TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I'}
+# SampleFormat : dtype kind
+_TIFF_SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+
+
+def tiff_memmap_layout(filename):
+    ''' Find where the pixels of a TIFF file are, if they can be memory
+        mapped.
+
+        This only reads the first image directory. Returns the (offset, dtype,
+        shape) of the pixel data, or None if the image is compressed, has
+        several samples per pixel or non contiguous strips.
+    '''
+    with open(filename, "rb") as f:
+        header = f.read(8)
+        byteorder = {b'II': '<', b'MM': '>'}.get(header[:2])
+        if byteorder is None:
+            return None
+        magic, ifd_offset = struct.unpack(byteorder + 'HI', header[2:8])
+        if magic != 42:
+            # BigTIFF or not a TIFF
+            return None
+        f.seek(ifd_offset)
+        ntags, = struct.unpack(byteorder + 'H', f.read(2))
+        entries = f.read(12*ntags)
+        tags = dict()
+        for i in range(ntags):
+            code, ftype, count = struct.unpack(byteorder + 'HHI',
+                                               entries[12*i:12*i + 8])
+            if code not in _TIFF_TAGS or ftype not in _TIFF_TYPES:
+                continue
+            fmt = byteorder + _TIFF_TYPES[ftype]*count
+            size = struct.calcsize(fmt)
+            if size <= 4:
+                values = struct.unpack(fmt,
+                                       entries[12*i + 8:12*i + 8 + size])
+            else:
+                pos = f.tell()
+                offset, = struct.unpack(byteorder + 'I',
+                                        entries[12*i + 8:12*i + 12])
+                f.seek(offset)
+                values = struct.unpack(fmt, f.read(size))
+                f.seek(pos)
+            tags[_TIFF_TAGS[code]] = values
+
+    if tags.get('compression', (1,))[0] != 1 or \
+            tags.get('samples_per_pixel', (1,))[0] != 1:
+        return None
+    offsets = tags['strip_offsets']
+    counts = tags['strip_byte_counts']
+    for i in range(len(offsets) - 1):
+        if offsets[i] + counts[i] != offsets[i + 1]:
+            return None
+    kind = _TIFF_SAMPLE_FORMATS.get(tags.get('sample_format', (1,))[0])
+    if kind is None:
+        return None
+    dtype = np.dtype(byteorder + kind + str(tags['bits_per_sample'][0]//8))
+    shape = tags['height'][0], tags['width'][0]
+    if sum(counts) < shape[0]*shape[1]*dtype.itemsize:
+        return None
+    return offsets[0], dtype, shape
+
+
+class MemmapTiffHandler(AreaDetectorTiffHandler):
+    ''' Area detector TIFF handler returning memory mapped images.
+
+        Uncompressed single sample TIFFs (the Pilatus default) are not read
+        but memory mapped. The images returned are read only views with the
+        native dtype (int32 for the Pilatus), so nothing is read or
+        allocated until the pixels are used. Other TIFFs are read normally.
+    '''
+    def _read_frame(self, filename):
+        layout = tiff_memmap_layout(filename)
+        if layout is None:
+            return np.array(Image.open(filename))
+        offset, dtype, shape = layout
+        return np.memmap(filename, dtype=dtype, mode='r', offset=offset,
+                         shape=shape)
+
+    def __call__(self, point_number):
+        frames = [self._read_frame(filename)
+                  for filename in self._fnames_for_point(point_number)]
+        if len(frames) == 1:
+            # no copy for the usual one frame per point
+            return frames[0]
+        return np.stack(frames)
+
+
 # EIGER Image reader
 
 
+class HDF5FilePool:
+    ''' A small pool of open (read only) hdf5 file handles.
+
+        Opening an hdf5 file costs more than reading a compressed frame from
+        it, so handles are kept open and reused. Once more than maxsize
+        files are open, the least recently used handles are closed. Handles
+        that are currently borrowed are never closed.
+
+        Usage:
+            with pool.borrow(filename) as f:
+                data = f['entry/data/data'][0]
+    '''
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._handles = OrderedDict()
+        self._borrowed = dict()
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def borrow(self, filename):
+        with self._lock:
+            if filename in self._handles:
+                self._handles.move_to_end(filename)
+            else:
+                self._handles[filename] = h5py.File(filename, "r")
+            fhandle = self._handles[filename]
+            self._borrowed[filename] = self._borrowed.get(filename, 0) + 1
+        try:
+            yield fhandle
+        finally:
+            with self._lock:
+                self._borrowed[filename] -= 1
+                if self._borrowed[filename] == 0:
+                    del self._borrowed[filename]
+                self._evict()
+
+    def _evict(self):
+        for filename in list(self._handles.keys()):
+            if len(self._handles) <= self.maxsize:
+                break
+            if filename not in self._borrowed:
+                self._handles.pop(filename).close()
+
+    def close(self):
+        ''' Close all handles not currently borrowed.'''
+        with self._lock:
+            for filename in list(self._handles.keys()):
+                if filename not in self._borrowed:
+                    self._handles.pop(filename).close()
+
+    def __len__(self):
+        return len(self._handles)
+
+
+# shared by all the Eiger readers of this process
+hdf5_pool = HDF5FilePool()
+
+# thread pools shared by the Eiger readers of this process, by (use,
+# number of threads), so readers which are never closed don't leak threads
+_executors = dict()
+_executors_lock = threading.Lock()
+# number of threads decoding chunks ahead of time
+_PREFETCH_THREADS = 2
+
+
+def _get_executor(use, max_workers):
+    ''' Get a shared thread pool.'''
+    with _executors_lock:
+        key = use, max_workers
+        if key not in _executors:
+            _executors[key] = ThreadPoolExecutor(max_workers=max_workers)
+        return _executors[key]
+
+
+# HDF5 filter ids understood by _decode_chunk
+_H5Z_DEFLATE = 1
+_H5Z_SHUFFLE = 2
+_H5Z_LZ4 = 32004
+_H5Z_BSHUF = 32008
+
+
+def _get_filters(dset):
+    ''' Get the (filter id, filter values) pipeline of an hdf5 dataset.'''
+    plist = dset.id.get_create_plist()
+    filters = list()
+    for i in range(plist.get_nfilters()):
+        code, flags, values, name = plist.get_filter(i)
+        filters.append((code, values))
+    return filters
+
+
+def _check_filters(filters):
+    ''' Raise an error if _decode_chunk can't undo this filter pipeline.'''
+    for code, values in filters:
+        if code == _H5Z_LZ4 and lz4_block is None:
+            raise ImportError("Decompressing LZ4 chunks requires the lz4 "
+                              "library (pip install lz4)")
+        elif code == _H5Z_BSHUF and bitshuffle is None:
+            raise ImportError("Decompressing bitshuffle chunks requires "
+                              "the bitshuffle library")
+        elif code not in (_H5Z_DEFLATE, _H5Z_SHUFFLE, _H5Z_LZ4, _H5Z_BSHUF):
+            raise ValueError("Error, HDF5 filter {} not supported "
+                             "for raw chunk reads".format(code))
+
+
+def _unshuffle(buf, itemsize):
+    ''' Undo the HDF5 byte shuffle filter.'''
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    nelems = len(arr)//itemsize
+    res = arr.copy()
+    res[:nelems*itemsize] = \
+        arr[:nelems*itemsize].reshape(itemsize, nelems).T.ravel()
+    return res
+
+
+def _lz4_decompress(buf):
+    ''' Undo the Dectris LZ4 filter (hdf5-lz4).
+
+        Format : total size (int64), block size (int32), then for each block
+        its compressed size (int32) and data, all big endian. Blocks which
+        did not compress are stored as is.
+    '''
+    buf = memoryview(buf)
+    nbytes, block_size = struct.unpack('>qi', buf[:12])
+    res = bytearray()
+    pos = 12
+    while len(res) < nbytes:
+        csize, = struct.unpack('>i', buf[pos:pos + 4])
+        pos += 4
+        bsize = min(block_size, nbytes - len(res))
+        block = buf[pos:pos + csize]
+        pos += csize
+        if csize == bsize:
+            res += block
+        else:
+            res += lz4_block.decompress(block, uncompressed_size=bsize)
+    return res
+
+
+def _bshuf_decompress(buf, values, dtype):
+    ''' Undo the bitshuffle filter (with or without LZ4 compression).
+
+        Format : total size (uint64), block size in bytes (uint32), both big
+        endian, then the data.
+    '''
+    dtype = np.dtype(dtype)
+    arr = np.frombuffer(buf, dtype=np.uint8)
+    # 5th filter value is the compression, 2 for LZ4
+    if len(values) > 4 and values[4] == 2:
+        nbytes, block_size = struct.unpack('>QI', arr[:12].tobytes())
+        nelems = nbytes//dtype.itemsize
+        return bitshuffle.decompress_lz4(arr[12:], (nelems,), dtype,
+                                         block_size//dtype.itemsize)
+    return bitshuffle.bitunshuffle(arr.view(dtype))
+
+
+def _decode_chunk(raw, filter_mask, filters, dtype):
+    ''' Decode a raw chunk (from read_direct_chunk) to a flat array.
+
+        Filters are undone in reverse order, skipping those flagged in
+        filter_mask. zlib, lz4 and bitshuffle release the GIL, so this can
+        run in several threads at once.
+    '''
+    buf = raw
+    for i in reversed(range(len(filters))):
+        if filter_mask & (1 << i):
+            continue
+        code, values = filters[i]
+        if code == _H5Z_DEFLATE:
+            buf = zlib.decompress(buf)
+        elif code == _H5Z_SHUFFLE:
+            buf = _unshuffle(buf, np.dtype(dtype).itemsize)
+        elif code == _H5Z_LZ4:
+            buf = _lz4_decompress(buf)
+        elif code == _H5Z_BSHUF:
+            buf = _bshuf_decompress(buf, values, dtype)
+    return np.frombuffer(buf, dtype=dtype)
+
+
+class _EigerChunkReader:
+    ''' Frame access shared by the Eiger readers.
+
+        Frames are read from the data files (rather than through the master
+        file links) one HDF5 chunk at a time, using handles from hdf5_pool.
+        The last few decoded chunks are cached, and the chunk following the
+        last one read is decoded ahead of time, by a thread pool shared by
+        the readers.
+
+        If decompress_threads is set, h5py is bypassed for the decompression:
+        raw chunks are read with read_direct_chunk and decompressed by that
+        many threads, straight into the output array. The HDF5 filters
+        otherwise run one chunk at a time under the HDF5 global lock.
+
+        The class inheriting this must call _init_chunk_reader and set
+        imgthresh.
+    '''
+    # number of chunks decoded ahead of the last one read
+    prefetch = 1
+    # number of decoded chunks kept in memory
+    chunk_cache_size = 2
+    # if set, number of threads decompressing raw chunks
+    decompress_threads = None
+
+    def _init_chunk_reader(self, entry, lengths):
+        ''' entry is the (open) master file group containing the data
+            links, lengths the number of frames in each data file.'''
+        head = os.path.dirname(self.master_filepath)
+        self._sources = list()
+        self._chunk_rows = list()
+        self._filters = list()
+        for key in self.keys:
+            link = entry.get(key, getlink=True)
+            if isinstance(link, h5py.ExternalLink):
+                source = os.path.join(head, link.filename), link.path
+            else:
+                source = self.master_filepath, entry[key].name
+            dset = entry[key]
+            self._sources.append(source)
+            if dset.chunks is not None:
+                self._chunk_rows.append(dset.chunks[0])
+            else:
+                self._chunk_rows.append(1)
+            self._frame_dtype = dset.dtype
+            self._frame_shape = dset.shape[1:]
+            self._filters.append(_get_filters(dset))
+            if self.decompress_threads:
+                if dset.chunks is None or \
+                        tuple(dset.chunks[1:]) != tuple(dset.shape[1:]):
+                    raise ValueError("Raw chunk reads need data chunked "
+                                     "by whole frames")
+                _check_filters(self._filters[-1])
+        self._lengths = lengths
+        self._chunks = OrderedDict()
+        self._pending = dict()
+        self._chunk_lock = threading.Lock()
+
+    def _read_rows(self, key_number, start, stop, out=None):
+        if self.decompress_threads:
+            return self._read_rows_direct(key_number, start, stop, out=out)
+        filename, path = self._sources[key_number]
+        with hdf5_pool.borrow(filename) as f:
+            dset = f[path]
+            if out is None:
+                return dset[start:stop]
+            dset.read_direct(out, source_sel=np.s_[start:stop])
+            return out
+
+    def _read_rows_direct(self, key_number, start, stop, out=None):
+        ''' Read rows by decompressing the raw chunks in a thread pool.'''
+        if out is None:
+            out = np.empty((stop - start,) + tuple(self._frame_shape),
+                           dtype=self._frame_dtype)
+        executor = _get_executor("decompress", self.decompress_threads)
+        rows = self._chunk_rows[key_number]
+        filters = self._filters[key_number]
+        filename, path = self._sources[key_number]
+        futures = list()
+        # reading is sequential (HDF5 lock), decompressing is not
+        with hdf5_pool.borrow(filename) as f:
+            dsetid = f[path].id
+            for chunk_number in range(start//rows, (stop - 1)//rows + 1):
+                cstart = chunk_number*rows
+                lo, hi = max(cstart, start), min(cstart + rows, stop)
+                offset = (cstart,) + (0,)*len(self._frame_shape)
+                filter_mask, raw = dsetid.read_direct_chunk(offset)
+                futures.append(executor.submit(
+                    self._decode_into, raw, filter_mask, filters,
+                    out[lo - start:hi - start], lo - cstart))
+        for future in futures:
+            future.result()
+        return out
+
+    def _decode_into(self, raw, filter_mask, filters, out, offset):
+        chunk = _decode_chunk(raw, filter_mask, filters, self._frame_dtype)
+        chunk = chunk.reshape((-1,) + tuple(self._frame_shape))
+        out[:] = chunk[offset:offset + len(out)]
+
+    def _chunk_bounds(self, key_number, chunk_number):
+        rows = self._chunk_rows[key_number]
+        start = chunk_number*rows
+        stop = min(start + rows, self._lengths[key_number])
+        return start, stop
+
+    def _read_chunk(self, key_number, chunk_number):
+        start, stop = self._chunk_bounds(key_number, chunk_number)
+        return self._read_rows(key_number, start, stop)
+
+    def _get_chunk(self, key_number, chunk_number):
+        ''' Get a decoded chunk, from cache if possible.'''
+        chunk_key = key_number, chunk_number
+        with self._chunk_lock:
+            if chunk_key in self._chunks:
+                self._chunks.move_to_end(chunk_key)
+                return self._chunks[chunk_key]
+            future = self._pending.pop(chunk_key, None)
+        if future is not None:
+            chunk = future.result()
+        else:
+            chunk = self._read_chunk(key_number, chunk_number)
+        with self._chunk_lock:
+            self._chunks[chunk_key] = chunk
+            while len(self._chunks) > self.chunk_cache_size:
+                self._chunks.popitem(last=False)
+        return chunk
+
+    def _next_chunk(self, key_number, chunk_number):
+        start, stop = self._chunk_bounds(key_number, chunk_number + 1)
+        if start < self._lengths[key_number]:
+            return key_number, chunk_number + 1
+        if key_number + 1 < len(self.keys):
+            return key_number + 1, 0
+        return None
+
+    def _schedule_prefetch(self, key_number, chunk_number):
+        ''' Decode the chunks after this one in the background.'''
+        if self.prefetch < 1:
+            return
+        executor = _get_executor("prefetch", _PREFETCH_THREADS)
+        chunk_key = key_number, chunk_number
+        for i in range(self.prefetch):
+            chunk_key = self._next_chunk(*chunk_key)
+            if chunk_key is None:
+                break
+            with self._chunk_lock:
+                if chunk_key in self._chunks or chunk_key in self._pending:
+                    continue
+                self._pending[chunk_key] = \
+                    executor.submit(self._read_chunk, *chunk_key)
+
+    def _threshold(self, img):
+        if self.imgthresh is not None:
+            img *= (img < self.imgthresh)
+        return img
+
+    def get_frame(self, i):
+        key_number, elem_number = self._toc[i]
+        chunk_number = elem_number//self._chunk_rows[key_number]
+        chunk = self._get_chunk(key_number, chunk_number)
+        start, stop = self._chunk_bounds(key_number, chunk_number)
+        self._schedule_prefetch(key_number, chunk_number)
+        # copy, the chunk is shared with the cache
+        img = np.array(chunk[elem_number - start])
+        return Frame(self._threshold(img), frame_no=i)
+
+    def get_frames(self, start, stop):
+        ''' Read frames start to stop (exclusive) as one stacked array.
+
+            Whole chunks in the range are read as one hyperslab per data file
+            straight into the result. Partially covered chunks at the edges
+            go through the chunk cache, so that reading consecutive ranges
+            decodes each chunk only once.
+        '''
+        toc = self._toc[start:stop]
+        result = np.empty((len(toc),) + tuple(self._frame_shape),
+                          dtype=self._frame_dtype)
+        if len(toc) == 0:
+            return result
+        pos = 0
+        last_chunk = None
+        for key_number in np.unique(toc[:, 0]):
+            elems = toc[toc[:, 0] == key_number, 1]
+            first, last = elems[0], elems[-1] + 1
+            rows = self._chunk_rows[key_number]
+            # direct read run, in rows of the data file
+            run_start = None
+            for chunk_number in range(first//rows, (last - 1)//rows + 1):
+                cstart, cstop = self._chunk_bounds(key_number, chunk_number)
+                lo, hi = max(cstart, first), min(cstop, last)
+                covered = lo == cstart and hi == cstop
+                cached = (key_number, chunk_number) in self._chunks or \
+                    (key_number, chunk_number) in self._pending
+                if covered and not cached:
+                    if run_start is None:
+                        run_start = lo
+                    continue
+                if run_start is not None:
+                    nrows = lo - run_start
+                    self._read_rows(key_number, run_start, lo,
+                                    out=result[pos:pos + nrows])
+                    pos += nrows
+                    run_start = None
+                chunk = self._get_chunk(key_number, chunk_number)
+                result[pos:pos + hi - lo] = chunk[lo - cstart:hi - cstart]
+                pos += hi - lo
+            if run_start is not None:
+                nrows = last - run_start
+                self._read_rows(key_number, run_start, last,
+                                out=result[pos:pos + nrows])
+                pos += nrows
+            last_chunk = key_number, (last - 1)//rows
+        self._schedule_prefetch(*last_chunk)
+        return self._threshold(result)
+
+    def close(self):
+        ''' Cancel the chunks being decoded ahead, and drop the decoded
+            chunks.'''
+        with self._chunk_lock:
+            pending = list(self._pending.values())
+            self._chunks.clear()
+            self._pending.clear()
+        for future in pending:
+            if not future.cancel():
+                # already running, wait for it
+                future.exception()
+
+
 """
 #ref - taken from Yugang chxtools
 https://github.com/yugangzhang/chxtools/blob/master/chxtools/pims_readers/eiger.py
@@ -41,14 +608,16 @@ conda install -c danielballan hdf5-lz4
 """
 
 
-class EigerImages2(FramesSequence):
+class EigerImages2(_EigerChunkReader, FramesSequence):
     pattern = re.compile('(.*)master.*')
 
-    def __init__(self, master_filepath, imgthresh=None):
+    def __init__(self, master_filepath, imgthresh=None,
+                 decompress_threads=None):
         # The 'master' file points to data in other files.
         # Construct a list of those filepaths and check that they exist.
         self.master_filepath = master_filepath
         self.imgthresh = imgthresh
+        self.decompress_threads = decompress_threads
 
         ndatafiles = 0
         m = self.pattern.match(os.path.basename(master_filepath))
@@ -65,7 +634,8 @@ class EigerImages2(FramesSequence):
             if pattern_data in files:
                 ndatafiles += 1
 
-        with h5py.File(master_filepath, "r") as f:
+        # opened once, the handle stays in hdf5_pool for the frame reads
+        with hdf5_pool.borrow(master_filepath) as f:
             try:
                 entry = f['entry']['data']  # Eiger firmware v1.3.0 and onwards
             except KeyError:
@@ -74,48 +644,49 @@ class EigerImages2(FramesSequence):
                                 if k.startswith('data')])[:ndatafiles]
 
             lengths = [entry[key].shape[0] for key in self.keys]
-        for k in self.keys:
-            filename = prefix + k + '.h5'
-            filepath = os.path.join(os.path.dirname(master_filepath), filename)
-            if not os.path.isfile(filepath):
-                raise IOError("Cannot locate expected data file: {0}".format(
-                        filepath))
-        # Table of Contents return a tuple:
-        # self._toc[5] -> [which file, which element in that file]
-        self._toc = np.concatenate(
-                [list(zip(i*np.ones(length, dtype=int),
-                      np.arange(length, dtype=int)))
-                 for i, length in enumerate(lengths)])
-
-        # Read in some of the detector experimental parameters
-        f = h5py.File(master_filepath, "r")
-        dbeam = f['entry']['instrument']['beam']
-        ddet = f['entry']['instrument']['detector']
-        ddetS = f['entry']['instrument']['detector']['detectorSpecific']
-
-        self.wavelength = np.array(dbeam['incident_wavelength'])
-
-        self.pxdimx = np.array(ddet['x_pixel_size'])
-        self.pxdimy = np.array(ddet['y_pixel_size'])
-        self.threshold_energy = np.array(ddet['threshold_energy'])
-        self.det_distance = np.array(ddet['detector_distance'])
-        self.beamx0 = np.array(ddet['beam_center_x'])
-        self.beamy0 = np.array(ddet['beam_center_y'])
-        self.sensor_thickness = np.array(ddet['sensor_thickness'])
-
-        self.photon_energy = np.array(ddetS['photon_energy'])
-        self.exposuretime = np.array(ddet['count_time'])
-        self.timeperframe = np.array(ddet['frame_time'])
-        self.nframes = np.array(ddetS['nimages'])
-        self.version = np.array(ddetS['software_version'])
-        self.date = np.array(ddetS['data_collection_date'])
-        dimx = np.array(ddetS['x_pixels_in_detector'])
-        dimy = np.array(ddetS['y_pixels_in_detector'])
-        # dims from reader are flipped so I keep this notation (matrix indexing
-        # versus image indexing)
-        self.dims = (dimy, dimx)
-
-        f.close()
+
+            for k in self.keys:
+                filename = prefix + k + '.h5'
+                filepath = os.path.join(os.path.dirname(master_filepath),
+                                        filename)
+                if not os.path.isfile(filepath):
+                    raise IOError("Cannot locate expected data file: "
+                                  "{0}".format(filepath))
+            # Table of Contents return a tuple:
+            # self._toc[5] -> [which file, which element in that file]
+            self._toc = np.concatenate(
+                    [list(zip(i*np.ones(length, dtype=int),
+                          np.arange(length, dtype=int)))
+                     for i, length in enumerate(lengths)])
+
+            self._init_chunk_reader(entry, lengths)
+
+            # Read in some of the detector experimental parameters
+            dbeam = f['entry']['instrument']['beam']
+            ddet = f['entry']['instrument']['detector']
+            ddetS = f['entry']['instrument']['detector']['detectorSpecific']
+
+            self.wavelength = np.array(dbeam['incident_wavelength'])
+
+            self.pxdimx = np.array(ddet['x_pixel_size'])
+            self.pxdimy = np.array(ddet['y_pixel_size'])
+            self.threshold_energy = np.array(ddet['threshold_energy'])
+            self.det_distance = np.array(ddet['detector_distance'])
+            self.beamx0 = np.array(ddet['beam_center_x'])
+            self.beamy0 = np.array(ddet['beam_center_y'])
+            self.sensor_thickness = np.array(ddet['sensor_thickness'])
+
+            self.photon_energy = np.array(ddetS['photon_energy'])
+            self.exposuretime = np.array(ddet['count_time'])
+            self.timeperframe = np.array(ddet['frame_time'])
+            self.nframes = np.array(ddetS['nimages'])
+            self.version = np.array(ddetS['software_version'])
+            self.date = np.array(ddetS['data_collection_date'])
+            dimx = np.array(ddetS['x_pixels_in_detector'])
+            dimy = np.array(ddetS['y_pixels_in_detector'])
+            # dims from reader are flipped so I keep this notation (matrix
+            # indexing versus image indexing)
+            self.dims = (dimy, dimx)
 
         # Quick check for version change, if not a tested version, warn user.
         if((self.version != b'1.3.0')*(self.version != b'1.5.0')):
@@ -126,35 +697,20 @@ class EigerImages2(FramesSequence):
             errormsg += "version difference will not affect your reading."
             print(errormsg)
 
-    def get_frame(self, i):
-        key_number, elem_number = self._toc[i]
-        key = self.keys[key_number]
-        with h5py.File(self.master_filepath, "r") as f:
-            try:
-                # Eiger firmware v1.3.0 and onwards
-                img = f['entry']['data'][key][elem_number]
-            except KeyError:
-                img = f['entry'][key][elem_number]          # Older firmwares
-        if(self.imgthresh is not None):
-            img *= (img < self.imgthresh)
-        return Frame(img, frame_no=i)
-
     # def get_avg(self,frms=None):
 
     def get_flatfield(self):
         '''EIGER specific routine to obtain the flatfield correction.'''
-        f = h5py.File(self.master_filepath, "r")
-        ddetS = f['entry']['instrument']['detector']['detectorSpecific']
-        flatfield = np.array(ddetS['flatfield'])
-        f.close()
+        with hdf5_pool.borrow(self.master_filepath) as f:
+            ddetS = f['entry']['instrument']['detector']['detectorSpecific']
+            flatfield = np.array(ddetS['flatfield'])
         return flatfield
 
     def get_pixel_mask(self):
         ''' Get the pixel mask reported by the EIGER.'''
-        f = h5py.File(self.master_filepath, "r")
-        ddetS = f['entry']['instrument']['detector']['detectorSpecific']
-        pxmsk = np.array(ddetS['pixel_mask'])
-        f.close()
+        with hdf5_pool.borrow(self.master_filepath) as f:
+            ddetS = f['entry']['instrument']['detector']['detectorSpecific']
+            pxmsk = np.array(ddetS['pixel_mask'])
         return pxmsk
 
     def __len__(self):
@@ -184,13 +740,15 @@ conda install -c danielballan hdf5-lz4
 """
 
 
-class EigerImages(FramesSequence):
+class EigerImages(_EigerChunkReader, FramesSequence):
     pattern = re.compile('(.*)master.*')
+    imgthresh = None
 
-    def __init__(self, master_filepath):
+    def __init__(self, master_filepath, decompress_threads=None):
         # The 'master' file points to data in other files.
         # Construct a list of those filepaths and check that they exist.
         self.master_filepath = master_filepath
+        self.decompress_threads = decompress_threads
 
         ndatafiles = 0
         m = self.pattern.match(os.path.basename(master_filepath))
@@ -207,7 +765,8 @@ class EigerImages(FramesSequence):
             if pattern_data in files:
                 ndatafiles += 1
 
-        with h5py.File(master_filepath, "r") as f:
+        # opened once, the handle stays in hdf5_pool for the frame reads
+        with hdf5_pool.borrow(master_filepath) as f:
             try:
                 entry = f['entry']['data']  # Eiger firmware v1.3.0 and onwards
             except KeyError:
@@ -217,48 +776,48 @@ class EigerImages(FramesSequence):
 
             lengths = [entry[key].shape[0] for key in self.keys]
 
-        for k in self.keys:
-            filename = prefix + k + '.h5'
-            filepath = os.path.join(os.path.dirname(master_filepath), filename)
-            if not os.path.isfile(filepath):
-                raise IOError("Cannot locate expected data file: {0}".format(
-                        filepath))
-        # Table of Contents return a tuple:
-        # self._toc[5] -> [which file, which element in that file]
-        self._toc = np.concatenate(
-                [list(zip(i*np.ones(length, dtype=int),
-                      np.arange(length, dtype=int)))
-                 for i, length in enumerate(lengths)])
-
-        # Read in some of the detector experimental parameters
-        f = h5py.File(master_filepath, "r")
-        dbeam = f['entry']['instrument']['beam']
-        ddet = f['entry']['instrument']['detector']
-        ddetS = f['entry']['instrument']['detector']['detectorSpecific']
-
-        self.wavelength = np.array(dbeam['incident_wavelength'])
-
-        self.pxdimx = np.array(ddet['x_pixel_size'])
-        self.pxdimy = np.array(ddet['y_pixel_size'])
-        self.threshold_energy = np.array(ddet['threshold_energy'])
-        self.det_distance = np.array(ddet['detector_distance'])
-        self.beamx0 = np.array(ddet['beam_center_x'])
-        self.beamy0 = np.array(ddet['beam_center_y'])
-        self.sensor_thickness = np.array(ddet['sensor_thickness'])
-
-        self.photon_energy = np.array(ddetS['photon_energy'])
-        self.exposuretime = np.array(ddet['count_time'])
-        self.timeperframe = np.array(ddet['frame_time'])
-        self.nframes = np.array(ddetS['nimages'])
-        self.version = np.array(ddetS['software_version'])
-        self.date = np.array(ddetS['data_collection_date'])
-        dimx = np.array(ddetS['x_pixels_in_detector'])
-        dimy = np.array(ddetS['y_pixels_in_detector'])
-        # dims from reader are flipped so I keep this notation (matrix indexing
-        # versus image indexing)
-        self.dims = (dimy, dimx)
-
-        f.close()
+            for k in self.keys:
+                filename = prefix + k + '.h5'
+                filepath = os.path.join(os.path.dirname(master_filepath),
+                                        filename)
+                if not os.path.isfile(filepath):
+                    raise IOError("Cannot locate expected data file: "
+                                  "{0}".format(filepath))
+            # Table of Contents return a tuple:
+            # self._toc[5] -> [which file, which element in that file]
+            self._toc = np.concatenate(
+                    [list(zip(i*np.ones(length, dtype=int),
+                          np.arange(length, dtype=int)))
+                     for i, length in enumerate(lengths)])
+
+            self._init_chunk_reader(entry, lengths)
+
+            # Read in some of the detector experimental parameters
+            dbeam = f['entry']['instrument']['beam']
+            ddet = f['entry']['instrument']['detector']
+            ddetS = f['entry']['instrument']['detector']['detectorSpecific']
+
+            self.wavelength = np.array(dbeam['incident_wavelength'])
+
+            self.pxdimx = np.array(ddet['x_pixel_size'])
+            self.pxdimy = np.array(ddet['y_pixel_size'])
+            self.threshold_energy = np.array(ddet['threshold_energy'])
+            self.det_distance = np.array(ddet['detector_distance'])
+            self.beamx0 = np.array(ddet['beam_center_x'])
+            self.beamy0 = np.array(ddet['beam_center_y'])
+            self.sensor_thickness = np.array(ddet['sensor_thickness'])
+
+            self.photon_energy = np.array(ddetS['photon_energy'])
+            self.exposuretime = np.array(ddet['count_time'])
+            self.timeperframe = np.array(ddet['frame_time'])
+            self.nframes = np.array(ddetS['nimages'])
+            self.version = np.array(ddetS['software_version'])
+            self.date = np.array(ddetS['data_collection_date'])
+            dimx = np.array(ddetS['x_pixels_in_detector'])
+            dimy = np.array(ddetS['y_pixels_in_detector'])
+            # dims from reader are flipped so I keep this notation (matrix
+            # indexing versus image indexing)
+            self.dims = (dimy, dimx)
 
         # Quick check for version change, if not a tested version, warn user.
         if((self.version != b'1.3.0')*(self.version != b'1.5.0')):
@@ -269,34 +828,20 @@ class EigerImages(FramesSequence):
             errormsg += "version difference will not affect your reading."
             print(errormsg)
 
-    def get_frame(self, i):
-        key_number, elem_number = self._toc[i]
-        key = self.keys[key_number]
-        with h5py.File(self.master_filepath, "r") as f:
-            try:
-                # Eiger firmware v1.3.0 and onwards
-                img = f['entry']['data'][key][elem_number]
-            except KeyError:
-                # Older firmwares
-                img = f['entry'][key][elem_number]
-        return Frame(img, frame_no=i)
-
     # def get_avg(self,frms=None):
 
     def get_flatfield(self):
         '''EIGER specific routine to obtain the flatfield correction.'''
-        f = h5py.File(self.master_filepath, "r")
-        ddetS = f['entry']['instrument']['detector']['detectorSpecific']
-        flatfield = np.array(ddetS['flatfield'])
-        f.close()
+        with hdf5_pool.borrow(self.master_filepath) as f:
+            ddetS = f['entry']['instrument']['detector']['detectorSpecific']
+            flatfield = np.array(ddetS['flatfield'])
         return flatfield
 
     def get_pixel_mask(self):
         ''' Get the pixel mask reported by the EIGER.'''
-        f = h5py.File(self.master_filepath, "r")
-        ddetS = f['entry']['instrument']['detector']['detectorSpecific']
-        pxmsk = np.array(ddetS['pixel_mask'])
-        f.close()
+        with hdf5_pool.borrow(self.master_filepath) as f:
+            ddetS = f['entry']['instrument']['detector']['detectorSpecific']
+            pxmsk = np.array(ddetS['pixel_mask'])
         return pxmsk
 
     def __len__(self):
@@ -1,8 +1,10 @@
 # TODO : change this to some global analysis directory
 # and make sure it works in a GLOBAL filesystem for distributed environment
 import os
+import threading
 import uuid
 import numpy as np
+import h5py
 from PIL import Image
 
 _ROOTDIR = "/home/lhermitte/sqlite/fs-tmp-data"
@@ -23,9 +25,10 @@ class NpyWriter:
         self._fs = fs
         # Open and stash a file handle (e.g., h5py.File) if applicable.
 
-    def write(self, data, subpath=""):
+    def write(self, data, subpath="", key=None):
         """
         Save data to file, generate and insert new resource and datum.
+        (key, the data key, is not used: there's one file per datum)
         """
         if self._closed:
             raise RuntimeError('This writer has been closed.')
@@ -64,9 +67,10 @@ class PILWriter:
         self._fs = fs
         # Open and stash a file handle (e.g., h5py.File) if applicable.
 
-    def write(self, data, subpath=""):
+    def write(self, data, subpath="", key=None):
         """
         Save data to file, generate and insert new resource and datum.
+        (key, the data key, is not used: there's one file per datum)
         """
         if self._closed:
             raise RuntimeError('This writer has been closed.')
@@ -116,7 +120,90 @@ class PNGWriter(PILWriter):
         self.ext = 'png'
 
 
+class HDF5RowsWriter:
+    """
+    Each call to the ``write`` method appends the data as a row of a chunked
+    hdf5 dataset and creates a new filestore datum record (with the row
+    number as datum kwarg).
+
+    There is one file (and filestore resource) per subpath (day), data key
+    and data shape/dtype, for each writer instance. Files are written in
+    SWMR mode so that rows can be read back while the file is still being
+    appended to.
+
+    A writer can be shared by several threads (rows are appended under a
+    lock).
+    """
+    SPEC = 'HDF5_ROWS'
+    # target size of a chunk, in bytes
+    chunk_bytes = 2**20
+
+    def __init__(self, fs, root=_ROOTDIR):
+        ''' the rood directory can be overwritten.'''
+        self._root = root
+        self._closed = False
+        self._fs = fs
+        # (subpath, key, shape, dtype) -> (file, dataset, resource)
+        self._containers = dict()
+        self._lock = threading.Lock()
+
+    def _get_container(self, data, subpath, key):
+        ckey = (subpath, key, data.shape, data.dtype.str)
+        if ckey not in self._containers:
+            dirpath = '{}{}'.format(self._root, subpath)
+            fp = '{}/{}_{}.h5'.format(dirpath, key, str(uuid.uuid4()))
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            chunk_rows = max(1, self.chunk_bytes // max(1, data.nbytes))
+            f = h5py.File(fp, "w", libver='latest')
+            dset = f.create_dataset("data", shape=(0,) + data.shape,
+                                    maxshape=(None,) + data.shape,
+                                    chunks=(chunk_rows,) + data.shape,
+                                    dtype=data.dtype)
+            f.swmr_mode = True
+            resource = self._fs.insert_resource(self.SPEC, fp,
+                                                resource_kwargs={})
+            self._containers[ckey] = (f, dset, resource)
+        return self._containers[ckey]
+
+    def write(self, data, subpath="", key="data"):
+        """
+        Append data to its container, insert a new datum.
+        """
+        if self._closed:
+            raise RuntimeError('This writer has been closed.')
+
+        data = np.asarray(data)
+        if data.dtype.hasobject:
+            raise ValueError("Can't write objects to hdf5 "
+                             "(key {})".format(key))
+        with self._lock:
+            f, dset, resource = self._get_container(data, subpath, key)
+            row = dset.shape[0]
+            dset.resize(row + 1, axis=0)
+            dset[row] = data
+            # make the row visible to readers
+            dset.flush()
+        datum_id = str(uuid.uuid4())
+        self._fs.insert_datum(resource=resource, datum_id=datum_id,
+                              datum_kwargs={'row': row})
+        return datum_id
+
+    def close(self):
+        with self._lock:
+            for f, dset, resource in self._containers.values():
+                f.close()
+            self._containers = dict()
+            self._closed = True
+
+    def __enter__(self): return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 # TODO : Add a BlankWriter, basically takes a filename but outputs nothing.
 #   It also writes in the correct file handler (which should be an input)
 
-writers_dict = {'npy': NpyWriter, 'jpg': JPGWriter, 'png': PNGWriter}
+writers_dict = {'npy': NpyWriter, 'jpg': JPGWriter, 'png': PNGWriter,
+                'hdf5': HDF5RowsWriter}
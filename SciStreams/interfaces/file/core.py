@@ -1,6 +1,9 @@
 # core functions that are not classes
 # classes in this hierarchy will inherit them etc
 # stuff for reading/writing files
+# writers append their extension to filename, and return the file name
+from collections import defaultdict
+import threading
 from PIL import Image
 import h5py
 import numpy as np
@@ -18,6 +21,7 @@ def npywriter(data=None, filename=None):
     else:
         filename = filename + ".npz"
         np.savez(filename, data=data)
+    return filename
 
 
 def datwriter(data=None, filename=None):
@@ -36,6 +40,7 @@ def datwriter(data=None, filename=None):
         np.savetxt(filename, res, delimiter=" ", header=header)
     else:
         raise ValueError("Should be a dictionary")
+    return filename
 
 
 def pngwriter(data=None, filename=None):
@@ -52,6 +57,7 @@ def pngwriter(data=None, filename=None):
     data = Image.fromarray(data.astype(np.uint8))
     print(filename)
     data.save(filename)
+    return filename
 
 
 def jpegwriter(data=None, filename=None):
@@ -68,6 +74,71 @@ def jpegwriter(data=None, filename=None):
     data = Image.fromarray(data.astype(np.uint8))
     print(filename)
     data.save(filename)
+    return filename
+
+
+# locks of the hdf5 containers, by file name
+_container_locks = defaultdict(threading.Lock)
+
+
+def hdf5writer(data=None, filename=None):
+    ''' Append data to a per sample hdf5 container.
+
+        filename is <base>_<scan_id> (see file._make_fname_from_attrs): the
+        data goes to the group <scan_id> of <base>.h5, a chunked and
+        compressed dataset per key. Writing a scan_id again replaces it.
+    '''
+    if data is None:
+        raise ValueError("Error, data not specified")
+    if not isinstance(data, dict):
+        data = dict(data=data)
+    base, scan_id = filename.rsplit("_", 1)
+    filename = base + ".h5"
+    with _container_locks[filename]:
+        with h5py.File(filename, "a") as f:
+            if scan_id in f:
+                del f[scan_id]
+            group = f.create_group(scan_id)
+            for key, val in data.items():
+                val = np.asarray(val)
+                if val.dtype.kind == 'U':
+                    val = val.astype('S')
+                if val.ndim == 0:
+                    group.create_dataset(key, data=val)
+                else:
+                    group.create_dataset(key, data=val, chunks=True,
+                                         compression='gzip', shuffle=True)
+    return filename
+
+
+# appends to a container, so can't be written to a temporary file first
+hdf5writer.appends = True
+
+
+def hdf5containerloader(filename=None, scan_ids=None, keys=None):
+    ''' Read results from a container written by hdf5writer.
+
+        scan_ids : the scan ids to read (all by default)
+        keys : the keys to read (all by default)
+
+        Returns a dict of {scan_id : {key : data}}. Missing scan ids and keys
+        are skipped.
+    '''
+    if filename is None:
+        raise ValueError("Did not receive a filename")
+    res = dict()
+    with h5py.File(filename, "r") as f:
+        if scan_ids is None:
+            scan_ids = list(f.keys())
+        for scan_id in scan_ids:
+            scan_id = str(scan_id)
+            if scan_id not in f:
+                continue
+            group = f[scan_id]
+            res[scan_id] = {key: group[key][()] for key in
+                            (group.keys() if keys is None else keys)
+                            if key in group}
+    return res
 
 
 def jpegloader(filename=None):
@@ -99,4 +170,4 @@ def npyloader(filename=None):
 
 
 writers_dict = {'npy': npywriter, 'jpg': jpegwriter, 'png': pngwriter,
-                'dat': datwriter}
+                'dat': datwriter, 'hdf5': hdf5writer}
@@ -0,0 +1,215 @@
+''' A columnar store of 1D curves (circular averages), across samples.
+
+    Rather than one file per curve, all the curves are interpolated on a
+    common q grid and appended as rows of a 2D array (one raw binary file
+    per field, memory mapped for reading). A SQLite table keeps the metadata
+    of each row, so a query returns the (N, nq) curves in one read:
+
+    >>> store = CurveStore("/GPFS/pipeline/curves", qgrid=np.linspace(0, .1))
+    >>> sout_circavg.map(store.append, raw=True)
+    ...
+    >>> rows = store.query(sample_savename="AgBH")
+    >>> sqy = store.get(rows)
+'''
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+# the fields stored (the q values are the grid)
+CURVE_FIELDS = ['sqy', 'sqyerr']
+# the metadata columns (the other attributes are stored as json)
+CURVE_META = ['uid', 'sample_savename', 'scan_id', 'time']
+
+
+class CurveStore:
+    ''' Append curves on a common q grid, and query them.
+
+        Parameters
+        ----------
+        dirname : str
+            the directory of the store. It's created if it doesn't exist.
+
+        qgrid : array, optional
+            the q grid. Needed when creating a store, else the grid of the
+            store is used.
+
+        dtype : dtype, optional
+            the dtype the curves are stored as (for new stores)
+
+        Notes
+        -----
+        Curves are interpolated on the grid. q values outside of a curve's
+        q range are NaN.
+    '''
+    def __init__(self, dirname, qgrid=None, dtype=np.float32):
+        self.dirname = dirname
+        qfile = os.path.join(dirname, "qgrid.npy")
+        if os.path.exists(qfile):
+            self.qgrid = np.load(qfile)
+            if qgrid is not None and not np.allclose(qgrid, self.qgrid):
+                raise ValueError("The q grid differs from the store's "
+                                 "({})".format(qfile))
+            with open(os.path.join(dirname, "dtype")) as f:
+                self.dtype = np.dtype(f.read())
+        else:
+            if qgrid is None:
+                raise ValueError("A q grid is needed for a new store")
+            os.makedirs(dirname, exist_ok=True)
+            self.qgrid = np.asarray(qgrid, dtype=float)
+            self.dtype = np.dtype(dtype)
+            with open(os.path.join(dirname, "dtype"), "w") as f:
+                f.write(self.dtype.str)
+            np.save(qfile, self.qgrid)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(dirname, "curves.sqlite"),
+                                     check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS curves "
+                               "(row INTEGER PRIMARY KEY, uid TEXT, "
+                               "sample_savename TEXT, scan_id INTEGER, "
+                               "time REAL, attributes TEXT)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS curves_sample "
+                               "ON curves (sample_savename)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS curves_time "
+                               "ON curves (time)")
+        self._rows = self._count()
+        # rows may have been written without their metadata (interrupted)
+        for field in CURVE_FIELDS:
+            with open(self._fieldfile(field), "ab") as f:
+                f.truncate(self._rows*self._rowbytes)
+        self._memmaps = dict()
+
+    def _fieldfile(self, field):
+        return os.path.join(self.dirname, field + ".bin")
+
+    @property
+    def _rowbytes(self):
+        return len(self.qgrid)*self.dtype.itemsize
+
+    def _count(self):
+        cur = self._conn.execute("SELECT count(*) FROM curves")
+        return cur.fetchone()[0]
+
+    def append(self, sdoc):
+        ''' Append a curve (the sqx, sqy and sqyerr kwargs of a StreamDoc,
+            sqyerr is optional).
+
+            Returns the row of the curve.
+        '''
+        kwargs = sdoc['kwargs']
+        attrs = sdoc['attributes']
+        sqx = np.asarray(kwargs['sqx'])
+        order = np.argsort(sqx)
+        rows = dict()
+        for field in CURVE_FIELDS:
+            if field not in kwargs:
+                rows[field] = np.full(len(self.qgrid), np.nan, self.dtype)
+                continue
+            val = np.asarray(kwargs[field])[order]
+            rows[field] = np.interp(self.qgrid, sqx[order], val,
+                                    left=np.nan,
+                                    right=np.nan).astype(self.dtype)
+
+        meta = [attrs.get('uid'), attrs.get('sample_savename'),
+                attrs.get('scan_id'), attrs.get('time', time.time())]
+        other = {key: val for key, val in attrs.items()
+                 if key not in CURVE_META}
+        meta.append(json.dumps(other, default=repr))
+        with self._lock:
+            row = self._rows
+            for field in CURVE_FIELDS:
+                with open(self._fieldfile(field), "ab") as f:
+                    f.write(rows[field].tobytes())
+            # the metadata last, the row only exists once it's written
+            with self._conn:
+                self._conn.execute("INSERT INTO curves VALUES "
+                                   "(?, ?, ?, ?, ?, ?)", [row] + meta)
+            self._rows += 1
+        return row
+
+    def __len__(self):
+        return self._rows
+
+    def query(self, sample_savename=None, scan_ids=None, uids=None,
+              start_time=None, stop_time=None):
+        ''' Find the rows of curves.
+
+            sample_savename : matched as a substring
+            scan_ids, uids : lists of scan ids, uids to match
+            start_time, stop_time : the time range (timestamps)
+
+            Returns the rows, in the order they were appended
+        '''
+        conditions = list()
+        params = list()
+        if sample_savename is not None:
+            conditions.append("instr(sample_savename, ?) > 0")
+            params.append(sample_savename)
+        for column, vals in [('scan_id', scan_ids), ('uid', uids)]:
+            if vals is not None:
+                vals = list(vals)
+                conditions.append("{} IN ({})".format(
+                    column, ", ".join("?"*len(vals))))
+                params.extend(vals)
+        if start_time is not None:
+            conditions.append("time >= ?")
+            params.append(start_time)
+        if stop_time is not None:
+            conditions.append("time <= ?")
+            params.append(stop_time)
+        query = "SELECT row FROM curves"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY row"
+        with self._lock:
+            return [r[0] for r in self._conn.execute(query, params)]
+
+    def metadata(self, rows):
+        ''' Get the metadata of rows, as a list of dicts.'''
+        rows = list(rows)
+        query = ("SELECT * FROM curves WHERE row IN "
+                 "({})".format(", ".join("?"*len(rows))))
+        with self._lock:
+            res = {r[0]: r for r in self._conn.execute(query, rows)}
+        metadata = list()
+        for row in rows:
+            r = res[row]
+            meta = json.loads(r[5])
+            meta.update(zip(CURVE_META, r[1:5]))
+            meta['row'] = row
+            metadata.append(meta)
+        return metadata
+
+    def _memmap(self, field):
+        nrows = self._rows
+        mm = self._memmaps.get(field)
+        if mm is None or mm.shape[0] < nrows:
+            # (re)map, the file grew
+            mm = np.memmap(self._fieldfile(field), dtype=self.dtype,
+                           mode='r', shape=(nrows, len(self.qgrid)))
+            self._memmaps[field] = mm
+        return mm
+
+    def get(self, rows=None, field='sqy'):
+        ''' Get the curves of rows (all by default) as a (N, nq) array.
+
+            A slice is returned as a (read only) memory mapped view, a
+            list of rows is read at once.
+        '''
+        if self._rows == 0:
+            return np.empty((0, len(self.qgrid)), dtype=self.dtype)
+        mm = self._memmap(field)[:self._rows]
+        if rows is None:
+            return mm
+        if isinstance(rows, slice):
+            return mm[rows]
+        return mm[np.asarray(rows, dtype=int)]
+
+    def close(self):
+        self._memmaps = dict()
+        self._conn.close()
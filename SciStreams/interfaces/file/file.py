@@ -1,6 +1,11 @@
 from collections import OrderedDict
-from SciAnalysis.interfaces.file.core import writers_dict
+from concurrent.futures import ThreadPoolExecutor
+from SciAnalysis.interfaces.file.core import writers_dict, \
+    hdf5containerloader
+import atexit
 import os
+import threading
+import uuid
 import SciAnalysis.config as config
 from SciAnalysis.interfaces.file.reading import FileDesc  # noqa
 
@@ -8,10 +13,25 @@ _ROOTDIR = config.resultsroot
 _ROOTMAP = config.resultsrootmap
 
 
+# directories known to exist, to not check them on every write
+_known_dirs = set()
+
+
 def make_dir(directory):
-    ''' Creates directory if doesn't exist.'''
+    ''' Creates directory if doesn't exist.
+
+        Directories found or created are cached, see forget_dir.
+    '''
+    if directory in _known_dirs:
+        return
     if not os.path.isdir(directory):
-        os.makedirs(directory)
+        os.makedirs(directory, exist_ok=True)
+    _known_dirs.add(directory)
+
+
+def forget_dir(directory):
+    ''' Remove a directory from the cache of make_dir.'''
+    _known_dirs.discard(directory)
 
 # store results decorator
 
@@ -37,10 +57,8 @@ def _cleanup_str(string):
     return string
 
 
-def _make_fname_from_attrs(attrs):
-    ''' make filename from attributes.
-        This will likely be copied among a few interfaces.
-    '''
+def _make_outdir_from_attrs(attrs):
+    ''' make the output directory and sample name from attributes.'''
     if 'experiment_alias_directory' not in attrs:
         raise ValueError("Error cannot find experiment_alias_directory" +
                          " in attributes. Not saving.")
@@ -71,25 +89,67 @@ def _make_fname_from_attrs(attrs):
     else:
         stream_name = _cleanup_str(attrs['stream_name'])
 
+    outdir = rootdir + "/" + detector_name + "/" + stream_name + "/files"
+    return outdir, sample_savename
+
+
+def _make_fname_from_attrs(attrs):
+    ''' make filename from attributes.
+        This will likely be copied among a few interfaces.
+    '''
+    outdir, sample_savename = _make_outdir_from_attrs(attrs)
+
     if 'scan_id' not in attrs:
         raise ValueError("Error cannot find scan_id in attributes")
     else:
         scan_id = _cleanup_str(str(attrs['scan_id']))
 
-    outdir = rootdir + "/" + detector_name + "/" + stream_name + "/files"
     make_dir(outdir)
     outfile = outdir + "/" + sample_savename + "_" + scan_id
 
     return outfile
 
 
-def store_results_file(results, writers={}):
+def load_results_file(attrs, scan_ids=None, keys=None):
+    ''' Load results saved with the 'hdf5' writer.
+
+        attrs : the attributes of the results (the scan_id is not needed)
+        scan_ids, keys : the scan ids and keys to read (default is all)
+
+        Returns a dict of {scan_id : {key : data}}
+    '''
+    outdir, sample_savename = _make_outdir_from_attrs(attrs)
+    filename = outdir + "/" + sample_savename + ".h5"
+    return hdf5containerloader(filename=filename, scan_ids=scan_ids,
+                               keys=keys)
+
+
+def store_results_file(results, writers={}, background=False):
     ''' Store the results to a numpy file.
         This saves to numpy format by default.
         May raise an error if it doesn't understand data.
 
         For images, you'll need to use a plotting/image interface (not
         implemented yet).
+
+        background : if True, the files are written by the shared
+            FileWriteQueue (see get_file_write_queue) and this returns once
+            the writes are queued.
+    '''
+    writes = _prepare_writes(results, writers)
+    if background:
+        queue = get_file_write_queue()
+        for writer, outfile, data in writes:
+            queue.submit(writer, outfile, data)
+    else:
+        for writer, outfile, data in writes:
+            _write_atomic(writer, outfile, data)
+
+
+def _prepare_writes(results, writers):
+    ''' Get the (writer, outfile, data) of each write of the results.
+
+        The data is not copied.
     '''
     if 'kwargs' not in results:
         raise ValueError("kwargs not in the sciresults. " +
@@ -106,6 +166,7 @@ def store_results_file(results, writers={}):
 
     if not isinstance(writers, list):
         writers = [writers]
+    writes = list()
     for writer_entry in writers:
         # go through each writing instruction
         writer_key = writer_entry['writer']
@@ -119,4 +180,114 @@ def store_results_file(results, writers={}):
             keys = [keys]
         for key in keys:
             data.update({key: results_dict[key]})
-        writer(filename=outfile, data=data)
+        writes.append((writer, outfile, data))
+    return writes
+
+
+def _write_atomic(writer, outfile, data):
+    ''' Write to a temporary file, then rename it.
+
+        Readers never see a partially written file. Returns the file name.
+        Writers appending to a container are called directly.
+    '''
+    if getattr(writer, 'appends', False):
+        return writer(filename=outfile, data=data)
+    outdir, basename = os.path.split(outfile)
+    tag = uuid.uuid4().hex
+    tmpbase = os.path.join(outdir, ".{}.{}.tmp".format(basename, tag))
+    try:
+        tmpfile = writer(filename=tmpbase, data=data)
+    except FileNotFoundError:
+        # the directory was removed since it was cached
+        forget_dir(outdir)
+        make_dir(outdir)
+        tmpfile = writer(filename=tmpbase, data=data)
+    filename = outfile + tmpfile[len(tmpbase):]
+    os.replace(tmpfile, filename)
+    return filename
+
+
+class FileWriteQueue:
+    ''' Write files in background threads.
+
+        submit queues a write and returns; when maxsize writes are pending,
+        it blocks until one is done. Writes are atomic (see _write_atomic).
+
+        Parameters
+        ----------
+        max_workers : int, optional
+            the number of writing threads
+
+        maxsize : int, optional
+            the maximum number of pending writes
+    '''
+    def __init__(self, max_workers=4, maxsize=64):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._slots = threading.Semaphore(maxsize)
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._closed = False
+        # (filename, exception) of the failed writes
+        self.errors = list()
+
+    def submit(self, writer, outfile, data):
+        ''' Queue writer(filename=outfile, data=data).'''
+        if self._closed:
+            raise RuntimeError('This writer has been closed.')
+        self._slots.acquire()
+        with self._cond:
+            self._pending += 1
+        self._executor.submit(self._write, writer, outfile, data)
+
+    def _write(self, writer, outfile, data):
+        try:
+            _write_atomic(writer, outfile, data)
+        except Exception as e:
+            print("File writer : Error writing {} ({})".format(outfile, e))
+            self.errors.append((outfile, e))
+        finally:
+            self._slots.release()
+            with self._cond:
+                self._pending -= 1
+                self._cond.notify_all()
+
+    def __len__(self):
+        ''' the number of pending writes.'''
+        return self._pending
+
+    def flush(self):
+        ''' Wait for the pending writes to be done.'''
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        ''' Wait for the pending writes, and stop the threads.'''
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._executor.shutdown()
+
+
+_file_write_queue = None
+
+
+def get_file_write_queue(**kwargs):
+    ''' Get the shared FileWriteQueue (created if needed).
+
+        It's flushed and closed at exit.
+        kwargs are passed to FileWriteQueue when created.
+    '''
+    global _file_write_queue
+    if _file_write_queue is None:
+        _file_write_queue = FileWriteQueue(**kwargs)
+    return _file_write_queue
+
+
+@atexit.register
+def close_file_write_queue():
+    ''' Flush and close the shared FileWriteQueue.'''
+    global _file_write_queue
+    if _file_write_queue is not None:
+        _file_write_queue.close()
+        _file_write_queue = None
@@ -0,0 +1,388 @@
+''' Account and bound the memory held by the buffers of a pipeline.
+
+    Buffered nodes (zip, merge, partition, sliding_window, reorder, collect,
+    the queues of partition_by) and caches (ManagedDeque) hold their elements
+    through the memory manager, if one is set. It counts the bytes of the
+    numpy arrays held, per node, and when the total is over its budget, the
+    arrays of the coldest (or largest) elements are spilled to disk. They're
+    loaded back when the node uses the element again, so nodes always see
+    the original values:
+
+    >>> manager = MemoryManager(4*2**30, spilldir="/tmp")
+    >>> set_memory_manager(manager)
+    ...
+    >>> print(manager.report())
+
+    Arrays are found in StreamDocs (and dicts, lists and tuples). Other
+    objects are held as they are, and not counted.
+'''
+import atexit
+from collections import OrderedDict, deque
+import copy
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+
+import numpy as np
+
+# the memory manager of the buffers (see set_memory_manager)
+_memory_manager = None
+
+
+def set_memory_manager(manager):
+    ''' Hold the elements buffered from now on through manager (a
+        MemoryManager). None disables it.'''
+    global _memory_manager
+    _memory_manager = manager
+
+
+def get_memory_manager():
+    return _memory_manager
+
+
+@atexit.register
+def close_memory_manager():
+    ''' Remove the files spilled by the memory manager.'''
+    if _memory_manager is not None:
+        _memory_manager.close()
+
+
+def hold(node, x):
+    ''' Hold x in a buffer of node. Returns what the node should buffer
+        (x itself if there's no memory manager), see held_value and
+        release.'''
+    if _memory_manager is None:
+        return x
+    return _memory_manager.hold(node, x)
+
+
+def held_value(h):
+    ''' The value of a buffered element (loaded if it was spilled).'''
+    if isinstance(h, Held):
+        return h.manager.get(h)
+    return h
+
+
+def release(h):
+    ''' The value of an element leaving its buffer, which is no longer
+        accounted for.'''
+    if isinstance(h, Held):
+        return h.manager.release(h)
+    return h
+
+
+def _is_array(x):
+    return type(x) is np.ndarray and x.dtype != object
+
+
+def _children(x):
+    if isinstance(x, dict):
+        return x.values()
+    if type(x) in (list, tuple, deque):
+        return x
+    return ()
+
+
+def nbytes(x):
+    ''' The number of bytes of the numpy arrays in x (a StreamDoc, dict,
+        list or tuple of them), each array counted once.'''
+    total = 0
+    seen = set()
+    stack = [x]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if _is_array(obj):
+            total += obj.nbytes
+        else:
+            stack.extend(_children(obj))
+    return total
+
+
+def _map_arrays(x, func, memo):
+    ''' Copy the containers of x, with the leaves (arrays, SpilledArrays)
+        replaced by func(leaf). Containers without leaves are kept.'''
+    if id(x) in memo:
+        return memo[id(x)]
+    if _is_array(x) or isinstance(x, SpilledArray):
+        res = func(x)
+    elif isinstance(x, dict):
+        items = [(key, _map_arrays(val, func, memo))
+                 for key, val in x.items()]
+        if all(new is x[key] for key, new in items):
+            res = x
+        else:
+            # keeps the type (and attributes) of StreamDocs
+            res = copy.copy(x)
+            res.update(items)
+    elif type(x) in (list, tuple, deque):
+        items = [_map_arrays(val, func, memo) for val in x]
+        if all(new is old for new, old in zip(items, x)):
+            res = x
+        else:
+            res = type(x)(items)
+    else:
+        res = x
+    memo[id(x)] = res
+    return res
+
+
+class SpilledArray:
+    ''' A numpy array spilled to a .npy file.'''
+    __slots__ = ('fname', 'nbytes')
+
+    def __init__(self, fname, nbytes):
+        self.fname = fname
+        self.nbytes = nbytes
+
+    def load(self):
+        ''' Load the array, and remove its file.'''
+        arr = np.load(self.fname)
+        os.remove(self.fname)
+        return arr
+
+
+class Held:
+    ''' An element held in a buffer, through a MemoryManager.
+
+        value is the element, with its arrays replaced by SpilledArrays if
+        they were spilled. nbytes is the number of bytes it holds in memory,
+        spilled_nbytes the number of bytes it has on disk.
+    '''
+    __slots__ = ('manager', 'name', 'value', 'nbytes', 'spilled_nbytes')
+
+    def __init__(self, manager, name, value):
+        self.manager = manager
+        self.name = name
+        self.value = value
+        self.nbytes = nbytes(value)
+        self.spilled_nbytes = 0
+
+
+def _node_name(node):
+    ''' The name elements held by node are accounted under.'''
+    name = getattr(node, 'stream_name', None)
+    if name is None or name == "N/A":
+        name = type(node).__name__
+    return name
+
+
+class MemoryManager:
+    ''' Account for the memory held by buffers, and spill to disk over a
+        budget.
+
+        Parameters
+        ----------
+        budget : int
+            the number of bytes the buffers may hold in memory
+
+        spilldir : str, optional
+            the directory the arrays are spilled to (in a temporary
+            subdirectory, removed by close). Default, the temporary
+            directory of the system.
+
+        policy : {'lru', 'largest'}, optional
+            spill the least recently used elements first, or the largest
+
+        min_nbytes : int, optional
+            arrays smaller than this are never spilled
+
+        Notes
+        -----
+        An element accessed (see held_value) is loaded back if it was
+        spilled, and becomes the most recently used. It isn't spilled to
+        make room for itself, so the budget can be exceeded by one element.
+
+        Spills and loads are counted (nspilled, nloaded), and the bytes in
+        memory and on disk are counted per node (usage, see report).
+    '''
+    def __init__(self, budget, spilldir=None, policy='lru',
+                 min_nbytes=2**16):
+        if budget < 0:
+            raise ValueError("The memory budget can't be negative")
+        if policy not in ('lru', 'largest'):
+            raise ValueError("Unknown spill policy {} ".format(policy) +
+                             "(choose 'lru' or 'largest')")
+        self.budget = budget
+        self.spilldir = spilldir
+        self.policy = policy
+        self.min_nbytes = min_nbytes
+        # the directory of the spilled arrays (made when first needed)
+        self.dirname = None
+        self._lock = threading.RLock()
+        # the elements held
+        self._held = dict()
+        # the elements held which may be spilled (in memory, not tried yet),
+        # least recently used first
+        self._resident = OrderedDict()
+        # the bytes held in memory
+        self.nbytes = 0
+        # node name -> [bytes in memory, bytes spilled]
+        self.usage = OrderedDict()
+        self.nspilled = 0
+        self.nloaded = 0
+
+    def __len__(self):
+        return len(self._held)
+
+    def _account(self, h, sign):
+        usage = self.usage.setdefault(h.name, [0, 0])
+        usage[0] += sign*h.nbytes
+        usage[1] += sign*h.spilled_nbytes
+        self.nbytes += sign*h.nbytes
+
+    def hold(self, node, x):
+        ''' Hold x, for node. Returns its Held element.'''
+        h = Held(self, _node_name(node), x)
+        with self._lock:
+            self._held[h] = None
+            if h.nbytes > 0:
+                self._resident[h] = None
+            self._account(h, 1)
+            self._enforce(h)
+        return h
+
+    def get(self, h):
+        ''' The value of a held element, loaded if it was spilled.'''
+        with self._lock:
+            if h in self._held:
+                if h.spilled_nbytes:
+                    self._load(h)
+                    self._resident[h] = None
+                    self._enforce(h)
+                elif h in self._resident:
+                    self._resident.move_to_end(h)
+            return h.value
+
+    def release(self, h):
+        ''' The value of a held element, which isn't held anymore.'''
+        with self._lock:
+            if h in self._held:
+                del self._held[h]
+                self._resident.pop(h, None)
+                if h.spilled_nbytes:
+                    self._load(h)
+                self._account(h, -1)
+            return h.value
+
+    def _enforce(self, keep):
+        ''' Spill elements (other than keep) until under the budget.
+
+            The elements spilled (or with nothing large enough to spill)
+            leave the resident elements until they're loaded again, so each
+            is looked at once, rather than all of them at each call.'''
+        if self.nbytes <= self.budget:
+            return
+        if self.policy == 'largest':
+            candidates = sorted(self._resident, key=lambda h: h.nbytes,
+                                reverse=True)
+            for h in candidates:
+                if self.nbytes <= self.budget:
+                    break
+                if h is not keep:
+                    del self._resident[h]
+                    self._spill(h)
+            return
+        # least recently used first
+        while self.nbytes > self.budget and self._resident:
+            h = next(iter(self._resident))
+            if h is keep:
+                # the only one left (keep is the most recently used)
+                break
+            del self._resident[h]
+            self._spill(h)
+
+    def _spill_array(self, arr):
+        if arr.nbytes < self.min_nbytes:
+            return arr
+        if self.dirname is None:
+            if self.spilldir is not None:
+                os.makedirs(self.spilldir, exist_ok=True)
+            self.dirname = tempfile.mkdtemp(prefix="spill-",
+                                            dir=self.spilldir)
+        fname = os.path.join(self.dirname, uuid.uuid4().hex + ".npy")
+        np.save(fname, arr)
+        return SpilledArray(fname, arr.nbytes)
+
+    def _spill(self, h):
+        def spill(leaf):
+            return leaf if isinstance(leaf, SpilledArray) \
+                else self._spill_array(leaf)
+        value = _map_arrays(h.value, spill, dict())
+        if value is h.value:
+            # nothing large enough to spill
+            return
+        self._account(h, -1)
+        h.value = value
+        resident = nbytes(value)
+        h.spilled_nbytes += h.nbytes - resident
+        h.nbytes = resident
+        self._account(h, 1)
+        self.nspilled += 1
+
+    def _load(self, h):
+        def load(leaf):
+            return leaf.load() if isinstance(leaf, SpilledArray) else leaf
+        self._account(h, -1)
+        h.value = _map_arrays(h.value, load, dict())
+        h.nbytes += h.spilled_nbytes
+        h.spilled_nbytes = 0
+        self._account(h, 1)
+        self.nloaded += 1
+
+    def report(self):
+        ''' The memory used per node, as a table (a string).'''
+        lines = ["{:30s} {:>12s} {:>12s}".format("node", "memory (MB)",
+                                                 "spilled (MB)")]
+        with self._lock:
+            for name, (resident, spilled) in self.usage.items():
+                lines.append("{:30s} {:12.1f} {:12.1f}".format(
+                    str(name), resident/2**20, spilled/2**20))
+            lines.append("total {:.1f} MB of {:.1f} MB, ".format(
+                self.nbytes/2**20, self.budget/2**20) +
+                "{} spills, {} loads".format(self.nspilled, self.nloaded))
+        return "\n".join(lines)
+
+    def close(self):
+        ''' Remove the spilled arrays (the elements still spilled can't be
+            loaded anymore).'''
+        with self._lock:
+            if self.dirname is not None:
+                shutil.rmtree(self.dirname, ignore_errors=True)
+                self.dirname = None
+
+
+class ManagedDeque:
+    ''' A deque of at most maxlen items, held through the memory manager
+        (like the buffers of streams). For caches of results.
+
+        Items are accounted for under stream_name. Only their numpy arrays
+        are counted (not what futures pin on dask workers, for ex).
+    '''
+    def __init__(self, maxlen=None, stream_name="N/A"):
+        self.maxlen = maxlen
+        self.stream_name = stream_name
+        self._items = deque()
+
+    def append(self, x):
+        if self.maxlen is not None and len(self._items) >= self.maxlen:
+            release(self._items.popleft())
+        self._items.append(hold(self, x))
+
+    def clear(self):
+        while self._items:
+            release(self._items.popleft())
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getitem__(self, i):
+        return held_value(self._items[i])
+
+    def __iter__(self):
+        for h in list(self._items):
+            yield held_value(h)
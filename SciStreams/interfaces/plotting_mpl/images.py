@@ -0,0 +1,133 @@
+''' Write false color images directly, without matplotlib figures.
+
+    For image only outputs (thumbnails, stitched images, q-phi maps), the
+    image is mapped through a 256 entry lookup table (LUT) of a colormap and
+    saved with PIL, which is much faster than rendering a figure.
+'''
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+import matplotlib
+import matplotlib.cm
+from SciAnalysis.interfaces.plotting_mpl import colormaps
+
+
+def _get_cmap(cmap):
+    ''' Get a colormap from its name (one of colormaps.py, or matplotlib's).
+    '''
+    if not isinstance(cmap, str):
+        return cmap
+    if hasattr(colormaps, cmap):
+        return getattr(colormaps, cmap)
+    try:
+        return matplotlib.colormaps[cmap]
+    except AttributeError:
+        # matplotlib < 3.5
+        return matplotlib.cm.get_cmap(cmap)
+
+
+@lru_cache(maxsize=32)
+def get_lut(cmap='viridis', n=256):
+    ''' Get the (n, 3) uint8 RGB lookup table of a colormap.'''
+    cmap = _get_cmap(cmap)
+    lut = cmap(np.linspace(0, 1, n))[:, :3]
+    lut = np.round(lut*255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def find_clims(image, low=1., high=99., max_samples=2**16, minval=1.):
+    ''' Find reasonable color limits for an image, from percentiles.
+
+        Like findLowHigh, values below minval (zeros, masked pixels) and non
+        finite values are ignored. Large images are sampled (every n-th
+        pixel) and the percentiles found with np.partition, rather than
+        histogramming the whole image.
+
+        Returns (vmin, vmax)
+    '''
+    vals = np.asarray(image).ravel()
+    if vals.size > max_samples:
+        vals = vals[::vals.size//max_samples]
+    vals = vals[np.isfinite(vals)]
+    vals = vals[vals >= minval]
+    if vals.size == 0:
+        # some arbitrary values (like findLowHigh)
+        return 1, 10
+    klow = int(low/100.*(vals.size - 1))
+    khigh = int(high/100.*(vals.size - 1))
+    vals = np.partition(vals, [klow, khigh])
+    vmin, vmax = vals[klow], vals[khigh]
+    if vmax <= vmin:
+        vmax = vmin + 1
+    return vmin, vmax
+
+
+def _lut_indices(image, vmin, vmax, n):
+    ''' Map an image to indices (uint8) of an n entry LUT.'''
+    image = np.asarray(image)
+    if vmin is None or vmax is None:
+        fvmin, fvmax = find_clims(image)
+        vmin = fvmin if vmin is None else vmin
+        vmax = fvmax if vmax is None else vmax
+    scale = (n - 1)/(vmax - vmin) if vmax > vmin else 0.
+    idx = np.asarray((image - vmin)*scale, dtype=float)
+    # +-inf are clipped, nan get the lowest color
+    # (np.nan_to_num(nan=, posinf=, neginf=) needs numpy >= 1.17)
+    idx = np.clip(idx, 0, n - 1)
+    idx[np.isnan(idx)] = 0
+    return idx.astype(np.uint8)
+
+
+def colorize(image, vmin=None, vmax=None, cmap='viridis'):
+    ''' Map an image to RGB through the LUT of a colormap.
+
+        vmin, vmax : the color limits (default from find_clims)
+
+        Returns a (..., 3) uint8 array. Non finite values get the lowest
+        color.
+    '''
+    lut = get_lut(cmap)
+    return lut[_lut_indices(image, vmin, vmax, len(lut))]
+
+
+@lru_cache(maxsize=32)
+def _colorbar_strip(height, n, width=20):
+    ''' A vertical (height, width) strip of LUT indices, max on top.'''
+    strip = np.linspace(n - 1, 0, height).astype(np.uint8)
+    strip = np.repeat(strip[:, None], width, axis=1)
+    strip.flags.writeable = False
+    return strip
+
+
+def write_image(filename, image, vmin=None, vmax=None, cmap='viridis',
+                colorbar=False):
+    ''' Write a false color image (PNG, JPEG, from the filename).
+
+        PNGs are written as palette images (one byte per pixel), which is
+        faster to encode.
+
+        colorbar : if True, a colorbar strip is added on the right
+    '''
+    image = np.asarray(image)
+    if image.ndim != 2:
+        raise ValueError("Can only write 2D images "
+                         "(got shape {})".format(image.shape))
+    # the last palette entry is kept for the white background
+    lut = get_lut(cmap, n=255)
+    idx = _lut_indices(image, vmin, vmax, len(lut))
+    if colorbar:
+        height = idx.shape[0]
+        gap = np.full((height, 5), 255, dtype=np.uint8)
+        idx = np.concatenate([idx, gap, _colorbar_strip(height, len(lut))],
+                             axis=1)
+    palette = np.concatenate([lut, [[255, 255, 255]]]).astype(np.uint8)
+    if filename.lower().endswith(".png"):
+        img = Image.fromarray(idx, mode='P')
+        img.putpalette(palette.ravel().tolist())
+    else:
+        img = Image.fromarray(palette[idx])
+    img.save(filename)
+    return filename
@@ -1,11 +1,21 @@
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+import threading
+
 import matplotlib
 matplotlib.use("Agg")  # noqa
+from matplotlib.figure import Figure  # noqa
+from matplotlib.backends.backend_agg import FigureCanvasAgg  # noqa
 import SciAnalysis.config as config
 import os.path
 
 import numpy as np
 
-from collections import deque
+from collections import deque, OrderedDict
+
+from SciAnalysis.interfaces.plotting_mpl.images import write_image  # noqa
 
 _ROOTDIR = config.resultsroot
 _ROOTMAP = config.resultsrootmap
@@ -19,8 +29,8 @@ fig_buffer = deque()
 # TODO move to general tools
 def make_dir(directory):
     ''' Creates directory if doesn't exist.'''
-    if not os.path.isdir(directory):
-        os.makedirs(directory)
+    # exist_ok : plots may be rendered from several threads
+    os.makedirs(directory, exist_ok=True)
 
 
 def _cleanup_str(string):
@@ -79,7 +89,7 @@ def _make_fname_from_attrs(attrs):
     return outfile
 
 
-def store_results(results, **plot_opts):
+def store_results(results, background=False, **plot_opts):
     ''' Store the results to a numpy file.
         This saves to numpy format by default.
         May raise an error if it doesn't understand data.
@@ -88,6 +98,9 @@ def store_results(results, **plot_opts):
         For images, you'll need to use a plotting/image interface (not
         implemented yet).
 
+        background : if True, the plot is rendered by the shared RenderPool
+            (see get_render_pool) and this returns once it's queued.
+
         plot_opts : plot options forwarded to matplotlib
             images : keys of images
             lines : keys of lines to plot (on top of images)
@@ -98,11 +111,6 @@ def store_results(results, **plot_opts):
             ylabel
             title
     '''
-    import matplotlib.pyplot as plt
-    # TODO : move some of the plotting into a general object
-
-    plot_kws = plot_opts.pop('plot_kws', {})
-
     data = results['kwargs']
 
     if 'attributes' not in results:
@@ -113,73 +121,189 @@ def store_results(results, **plot_opts):
     outfile = _make_fname_from_attrs(attrs) + ".png"
     print("writing to {}".format(outfile))
 
-    if 'images' in plot_opts:
-        images = plot_opts['images']
+    if background:
+        get_render_pool().submit(outfile, data, plot_opts)
     else:
-        images = []
-    if 'lines' in plot_opts:
-        lines = plot_opts['lines']
-    else:
-        lines = []
+        _get_renderer().render(outfile, data, plot_opts)
 
-    xlims = None
-    ylims = None
-    # plt.ioff()
-    '''
-    timeout = 100# in seconds
-    t_start = time.time()
-    while(len(fig_queue) == 0):
-        if time.time() - t_start > timeout:
-            raise Exception("Timed out when waiting for a figure to be
-                released")
-        time.sleep(1)
+
+def store_results_image(results, images=[], vmin=None, vmax=None,
+                        cmap='viridis', colorbar=True, ext='png',
+                        **plot_opts):
+    ''' Store images of the results as false color images.
+
+        This maps the images through a colormap lookup table and writes
+        them with PIL (see images.py) rather than rendering a figure, so
+        there are no axes or labels. Other plot_opts of store_results (like
+        hideaxes) are ignored.
+
+        images : the keys of the (2D) images. If there are several, the key
+            is added to the file names.
+        vmin, vmax : the color limits (default from percentiles)
+        cmap : the colormap (name of one of colormaps.py, or matplotlib's)
+        colorbar : add a colorbar strip (default, like store_results)
+        ext : the file extension (format), 'png' or 'jpg'
     '''
+    data = results['kwargs']
+
+    if 'attributes' not in results:
+        raise ValueError("attributes not in the sciresults. " +
+                         "(Is this a valid SciResult object?)")
+    attrs = results['attributes']
 
-    # grab fig from queue. do some cleanup (if a fig
-    # has not been released for some time, release it)
-    fig = plt.figure(0)  # int(np.random.random()*MAXFIGNUM))
-    fig.clf()
-    ax = fig.gca()
+    outfile = _make_fname_from_attrs(attrs)
     for key in images:
-        # find some reasonable color scale
-        if key in data:
-            image = data[key]
-            vmin, vmax = findLowHigh(image)
-            if 'vmin' in plot_opts:
-                vmin = plot_opts['vmin']
-            if 'vmax' in plot_opts:
-                vmax = plot_opts['vmax']
-            if image.ndim == 2:
-                if isinstance(image, np.ndarray):
-                    plt.imshow(image, vmin=vmin, vmax=vmax, **plot_kws)
-                    plt.colorbar()
-            elif image.ndim == 3:
-                nimgs = image.shape[0]
-                dim = int(np.ceil(np.sqrt(nimgs)))
-                fig, axes = plt.subplots(dim, dim)
-                axes = np.array(axes).ravel()
-                for j in range(len(image)):
-                    if isinstance(image, np.ndarray):
-                        axes[j].imshow(image[j], **plot_kws)
-        else:
+        if key not in data:
             print("Warning : key {} not found ".format(key) +
                   "in data for plotting(mpl)")
+            continue
+        if len(images) > 1:
+            filename = "{}_{}.{}".format(outfile, key, ext)
+        else:
+            filename = "{}.{}".format(outfile, ext)
+        print("writing to {}".format(filename))
+        write_image(filename, data[key], vmin=vmin, vmax=vmax, cmap=cmap,
+                    colorbar=colorbar)
+
+
+class FigureRenderer:
+    ''' Render plots without pyplot, reusing figures and artists.
+
+        There's one Figure (with its own Agg canvas) per plot layout: the
+        plot options and the keys and shapes of the data plotted. When a
+        layout was rendered before, its artists are updated (set_data) rather
+        than drawn again. Renderers are not thread safe, use one per thread
+        (see _get_renderer).
+
+        Parameters
+        ----------
+        maxfigures : int, optional
+            the maximum number of figures kept (least recently used ones are
+            dropped)
+    '''
+    def __init__(self, maxfigures=16):
+        self.maxfigures = maxfigures
+        # layout key -> (figure, artists)
+        self._figures = OrderedDict()
+
+    def render(self, outfile, data, plot_opts):
+        ''' Render data (a dict) with the options of store_results, save it
+            to outfile.'''
+        plot_opts = dict(plot_opts)
+        plot_kws = plot_opts.pop('plot_kws', {})
+        images = [key for key in plot_opts.get('images', [])
+                  if self._has_image(data, key)]
+        lines = [line for line in plot_opts.get('lines', [])
+                 if self._line_data(data, line) is not None]
+        for key in plot_opts.get('images', []):
+            if key not in data:
+                print("Warning : key {} not found ".format(key) +
+                      "in data for plotting(mpl)")
+
+        layout = (repr(sorted(plot_opts.items())), repr(plot_kws),
+                  tuple((key, data[key].shape) for key in images),
+                  tuple(lines))
+        if layout in self._figures:
+            self._figures.move_to_end(layout)
+            fig, artists = self._figures[layout]
+            self._update(fig, artists, data, images, lines, plot_opts)
+        else:
+            fig = Figure()
+            FigureCanvasAgg(fig)
+            artists = self._draw(fig, data, images, lines, plot_opts,
+                                 plot_kws)
+            self._figures[layout] = fig, artists
+            while len(self._figures) > self.maxfigures:
+                self._figures.popitem(last=False)
+
+        # save
+        try:
+            fig.savefig(outfile)
+        except Exception:
+            print("Error in fig saving, ignoring... file : {}".format(outfile))
+
+    @staticmethod
+    def _has_image(data, key):
+        return key in data and isinstance(data[key], np.ndarray) and \
+            data[key].ndim in (2, 3)
 
-    for line in lines:
+    @staticmethod
+    def _line_data(data, line):
         if isinstance(line, tuple) and len(line) == 2:
             if line[0] in data and line[1] in data:
-                x = data[line[0]]
-                y = data[line[1]]
+                return data[line[0]], data[line[1]]
+        elif line in data:
+            y = data[line]
+            return np.arange(len(y)), y
+        return None
+
+    def _clims(self, image, plot_opts):
+        vmin, vmax = findLowHigh(image)
+        return plot_opts.get('vmin', vmin), plot_opts.get('vmax', vmax)
+
+    def _draw(self, fig, data, images, lines, plot_opts, plot_kws):
+        ''' Draw a new layout, return its artists.'''
+        ax = fig.add_subplot(111)
+        artists = dict(ax=ax, images=list(), lines=list())
+        for key in images:
+            image = data[key]
+            if image.ndim == 2:
+                vmin, vmax = self._clims(image, plot_opts)
+                im = ax.imshow(image, vmin=vmin, vmax=vmax, **plot_kws)
+                cbar = fig.colorbar(im, ax=ax)
+                artists['images'].append((key, None, im, cbar))
             else:
-                x, y = None, None
-        else:
-            if line in data:
-                y = data[line]
-                x = np.arange(len(y))
+                # a grid of images, on a new figure (like plt.subplots)
+                fig.clf()
+                nimgs = image.shape[0]
+                dim = int(np.ceil(np.sqrt(nimgs)))
+                axes = np.array(fig.subplots(dim, dim)).ravel()
+                for j in range(nimgs):
+                    im = axes[j].imshow(image[j], **plot_kws)
+                    artists['images'].append((key, j, im, None))
+                ax = axes[0]
+                artists['ax'] = ax
+
+        for line in lines:
+            x, y = self._line_data(data, line)
+            ln, = ax.plot(x, y, **plot_kws)
+            artists['lines'].append((line, ln))
+
+        # plotting the extra options
+        labelsize = plot_opts.get('labelsize', 20)
+        if 'xlabel' in plot_opts:
+            ax.set_xlabel(plot_opts['xlabel'], size=labelsize)
+        if 'ylabel' in plot_opts:
+            ax.set_ylabel(plot_opts['ylabel'], size=labelsize)
+        if 'title' in plot_opts:
+            ax.set_title(plot_opts['title'])
+        if plot_opts.get('hideaxes', False):
+            ax.get_xaxis().set_visible(False)
+            ax.get_yaxis().set_visible(False)
+
+        self._set_limits(ax, data, lines, plot_opts)
+        return artists
+
+    def _update(self, fig, artists, data, images, lines, plot_opts):
+        ''' Update the artists of a layout with new data.'''
+        for key, j, im, cbar in artists['images']:
+            image = data[key]
+            if j is None:
+                im.set_data(image)
+                im.set_clim(*self._clims(image, plot_opts))
+                cbar.update_normal(im)
             else:
-                x, y = None, None
-        if x is not None and y is not None:
-            plt.plot(x, y, **plot_kws)
+                im.set_data(image[j])
+                im.autoscale()
+        for line, ln in artists['lines']:
+            ln.set_data(*self._line_data(data, line))
+        self._set_limits(artists['ax'], data, lines, plot_opts)
+
+    def _set_limits(self, ax, data, lines, plot_opts):
+        xlims = None
+        ylims = None
+        for line in lines:
+            x, y = self._line_data(data, line)
             if xlims is None:
                 xlims = [np.min(x), np.max(x)]
             else:
@@ -191,63 +315,156 @@ def store_results(results, **plot_opts):
                 ylims[0] = np.min([np.min(y), ylims[0]])
                 ylims[1] = np.max([np.max(y), ylims[1]])
 
-    if xlims is not None:
-        plt.xlim(xlims[0], xlims[1])
-    if ylims is not None:
-        plt.ylim(ylims[0], ylims[1])
+        # linear scales first, the limits can't be set on log scales if the
+        # data has zeros
+        ax.set_xscale('linear')
+        ax.set_yscale('linear')
+        if xlims is not None:
+            ax.set_xlim(xlims[0], xlims[1])
+        if ylims is not None:
+            ax.set_ylim(ylims[0], ylims[1])
+
+        if 'scale' in plot_opts:
+            try:
+                scale = plot_opts['scale']
+                if scale == 'loglog':
+                    ax.set_xscale('log')
+                    ax.set_yscale('log')
+                    correct_ylimits(ax)
+                elif scale == 'semilogx':
+                    ax.set_xscale('log')
+                elif scale == 'semilogy':
+                    ax.set_yscale('log')
+                    correct_ylimits(ax)
+                # else ignore
+            except Exception:
+                print("plotting_mpl : Error in setting " +
+                      "scales (array is likely zeros)")
+
+
+# one renderer per thread (and process)
+_renderers = threading.local()
+
+
+def _get_renderer():
+    if not hasattr(_renderers, 'renderer'):
+        _renderers.renderer = FigureRenderer()
+    return _renderers.renderer
+
+
+def _render(outfile, data, plot_opts):
+    ''' Render in a worker process.'''
+    _get_renderer().render(outfile, data, plot_opts)
+
+
+def _plotted_data(data, plot_opts):
+    ''' The entries of data that are plotted (images, and x, y of lines).'''
+    keys = list(plot_opts.get('images', []))
+    for line in plot_opts.get('lines', []):
+        if isinstance(line, tuple):
+            keys.extend(line)
+        else:
+            keys.append(line)
+    return {key: data[key] for key in keys if key in data}
 
-    # plotting the extra options
-    if 'labelsize' in plot_opts:
-        labelsize = plot_opts['labelsize']
-    else:
-        labelsize = 20
 
-    if 'hideaxes' in plot_opts:
-        hideaxes = plot_opts['hideaxes']
-    else:
-        hideaxes = False
+class RenderPool:
+    ''' Render plots in worker processes.
 
-    if 'xlabel' in plot_opts:
-        xlabel = plot_opts['xlabel']
-        plt.xlabel(xlabel, size=labelsize)
+        submit queues a plot and returns; when maxsize plots are pending, it
+        blocks until one is done. Each process keeps its own FigureRenderer,
+        so figures and artists are reused across plots.
 
-    if 'ylabel' in plot_opts:
-        ylabel = plot_opts['ylabel']
-        plt.xlabel(xlabel, size=labelsize)
-        plt.ylabel(ylabel, size=labelsize)
+        Parameters
+        ----------
+        processes : int, optional
+            the number of worker processes
 
-    if 'title' in plot_opts:
-        title = plot_opts['title']
-        plt.title(title)
+        maxsize : int, optional
+            the maximum number of pending plots
 
-    if 'scale' in plot_opts:
-        try:
-            scale = plot_opts['scale']
-            if scale == 'loglog':
-                ax.set_xscale('log')
-                ax.set_yscale('log')
-                correct_ylimits(ax)
-            elif scale == 'semilogx':
-                ax.set_xscale('log')
-            elif scale == 'semilogy':
-                ax.set_yscale('log')
-                correct_ylimits(ax)
-            # else ignore
-        except Exception:
-            print("plotting_mpl : Error in setting " +
-                  "scales (array is likely zeros)")
-
-    if hideaxes:
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-
-    # save
-    try:
-        fig.savefig(outfile)
-    except Exception:
-        print("Error in fig saving, ignoring... file : {}".format(outfile))
-    # make sure no mem leaks, just close
-    plt.close(fig)
+        mp_context : str, optional
+            how the processes are started. The pipeline runs threads (file
+            writes, read ahead, partition_by workers), so they're spawned
+            rather than forked (a fork can copy a lock held by another
+            thread, and deadlock).
+    '''
+    def __init__(self, processes=4, maxsize=32, mp_context="spawn"):
+        context = multiprocessing.get_context(mp_context)
+        self._executor = ProcessPoolExecutor(max_workers=processes,
+                                             mp_context=context)
+        self._slots = threading.Semaphore(maxsize)
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._closed = False
+        # (filename, exception) of the failed plots
+        self.errors = list()
+
+    def submit(self, outfile, data, plot_opts):
+        ''' Queue the rendering of data (a dict) to outfile.
+
+            Only the entries that are plotted are sent to the worker.
+        '''
+        if self._closed:
+            raise RuntimeError('This render pool has been closed.')
+        self._slots.acquire()
+        with self._cond:
+            self._pending += 1
+        future = self._executor.submit(_render, outfile,
+                                       _plotted_data(data, plot_opts),
+                                       plot_opts)
+        future.add_done_callback(partial(self._done, outfile))
+
+    def _done(self, outfile, future):
+        e = future.exception()
+        if e is not None:
+            print("plotting_mpl : Error rendering {} ({})".format(outfile, e))
+            self.errors.append((outfile, e))
+        self._slots.release()
+        with self._cond:
+            self._pending -= 1
+            self._cond.notify_all()
+
+    def __len__(self):
+        ''' the number of pending plots.'''
+        return self._pending
+
+    def flush(self):
+        ''' Wait for the pending plots to be rendered.'''
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending == 0)
+
+    def close(self):
+        ''' Wait for the pending plots, and stop the processes.'''
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        self._executor.shutdown()
+
+
+_render_pool = None
+
+
+def get_render_pool(**kwargs):
+    ''' Get the shared RenderPool (created if needed).
+
+        It's flushed and closed at exit.
+        kwargs are passed to RenderPool when created.
+    '''
+    global _render_pool
+    if _render_pool is None:
+        _render_pool = RenderPool(**kwargs)
+    return _render_pool
+
+
+@atexit.register
+def close_render_pool():
+    ''' Flush and close the shared RenderPool.'''
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.close()
+        _render_pool = None
 
 
 def correct_ylimits(ax):
@@ -0,0 +1,195 @@
+''' A persistent, content addressed store of the results of map nodes.
+
+    Each result is stored under the dask token of the node's input (with its
+    attributes), the function (its name and code, or its __version__) and
+    the node's parameters. When reprocessing, a node whose key is in the
+    store reuses the stored result, rather than computing it again (or
+    rewriting its files). Only nodes with changed inputs or parameters, and
+    the ones downstream, do real work.
+
+    This is opt-in:
+
+    >>> from SciAnalysis.interfaces.streams import set_result_store
+    >>> store = ResultStore("/GPFS/pipeline/results")
+    >>> set_result_store(store)
+    ...
+    >>> print(store.report())
+'''
+import os
+import pickle
+import threading
+import types
+from collections import OrderedDict
+from functools import partial
+import uuid
+
+from dask.base import tokenize, normalize_token
+
+import SciAnalysis.config as config
+from SciAnalysis.interfaces.StreamDoc import StreamDoc, tokenize_sdoc
+
+
+def _code_token(code):
+    ''' Tokenize a code object (its bytecode, names and constants).'''
+    consts = tuple(_code_token(const) if isinstance(const, types.CodeType)
+                   else const for const in code.co_consts)
+    return (code.co_code, code.co_names, code.co_varnames, consts)
+
+
+def _deterministic_tokenize(*args):
+    ''' tokenize args, or None if their token isn't deterministic (dask gives
+        a random token to the objects it can't normalize).'''
+    token = tokenize(*args)
+    if token != tokenize(*args):
+        return None
+    return token
+
+
+def func_token(func):
+    ''' The identity of a function, as a token.
+
+        Functions are identified by their module and name, and by their
+        __version__ attribute if set, else their code (so editing a
+        function invalidates its results). Functions which aren't plain
+        python functions (bound methods like Stream.emit, builtins) return
+        None, their nodes are always run. So do functions whose defaults,
+        closure or partial arguments dask can't tokenize deterministically
+        (they would get a new key in each process).
+    '''
+    if isinstance(func, partial):
+        token = func_token(func.func)
+        if token is None:
+            return None
+        return _deterministic_tokenize(token, func.args, func.keywords)
+    func = getattr(func, '__wrapped__', func)
+    if not isinstance(func, types.FunctionType):
+        return None
+    version = getattr(func, '__version__', None)
+    if version is None:
+        closure = tuple(cell.cell_contents for cell in func.__closure__ or ())
+        version = (_code_token(func.__code__), func.__defaults__,
+                   func.__kwdefaults__, closure)
+    return _deterministic_tokenize(func.__module__, func.__qualname__, version)
+
+
+def input_token(x):
+    ''' Tokenize the input of a node. StreamDocs include their attributes
+        (see tokenize_sdoc).'''
+    if isinstance(x, StreamDoc):
+        return tokenize(tokenize_sdoc(x, attributes=True))
+    return tokenize(normalize_token(x))
+
+
+def _failed(result):
+    ''' If result is a StreamDoc of a function which raised (its statistics
+        status is "Failure").'''
+    if not isinstance(result, StreamDoc):
+        return False
+    statistics = result.get('statistics')
+    return isinstance(statistics, dict) and \
+        statistics.get('status') == "Failure"
+
+
+class ResultStore:
+    ''' Store the results of map nodes on disk, by key.
+
+        Parameters
+        ----------
+        dirname : str, optional
+            the directory of the store (default <storagedir>/results)
+
+        Notes
+        -----
+        Results are pickled, one file per key. Results which can't be
+        pickled aren't stored (their nodes are always run), nor are failed
+        results (StreamDocs with a "Failure" status, see parse_streamdoc),
+        so that their nodes are run again.
+
+        The number of hits (results reused) and misses (results computed) are
+        counted per stream (the stream_name attribute of the input, or the
+        function name). See report.
+    '''
+    def __init__(self, dirname=None):
+        if dirname is None:
+            dirname = os.path.join(config.storagedir, "results")
+        self.dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+        self._lock = threading.Lock()
+        # stream name -> [hits, misses]
+        self.stats = OrderedDict()
+
+    def key(self, func, x, args=(), kwargs={}, raw=False):
+        ''' The key of the result of a node, None if it can't be stored.'''
+        ftoken = func_token(func)
+        if ftoken is None:
+            return None
+        return _deterministic_tokenize(ftoken, input_token(x), args, kwargs,
+                                       raw)
+
+    def _fname(self, key):
+        return os.path.join(self.dirname, key[:2], key + ".pkl")
+
+    def __contains__(self, key):
+        return os.path.isfile(self._fname(key))
+
+    def get(self, key):
+        ''' Get a result. Raises KeyError if not found.'''
+        try:
+            with open(self._fname(key), "rb") as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            raise KeyError(key)
+
+    def put(self, key, result):
+        ''' Store a result (written to a temporary file, then renamed).
+
+            Returns False if the result can't be stored.
+        '''
+        try:
+            data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            print("resultstore : Warning, can't store result of type " +
+                  "{} ({})".format(type(result).__name__, e))
+            return False
+        fname = self._fname(key)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        tmpfile = "{}.{}.tmp".format(fname, uuid.uuid4().hex)
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+        os.replace(tmpfile, fname)
+        return True
+
+    def _count(self, name, hit):
+        with self._lock:
+            stats = self.stats.setdefault(name, [0, 0])
+            stats[0 if hit else 1] += 1
+
+    def call(self, apply, func, x, args=(), kwargs={}, raw=False):
+        ''' Get the result of a node from the store, else compute it with
+            apply(x) and store it.'''
+        key = self.key(func, x, args=args, kwargs=kwargs, raw=raw)
+        if key is None:
+            return apply(x)
+        name = None
+        if isinstance(x, dict) and isinstance(x.get('attributes'), dict):
+            name = x['attributes'].get('stream_name')
+        if name is None:
+            name = getattr(func, '__name__', type(func).__name__)
+        try:
+            result = self.get(key)
+            self._count(name, True)
+        except KeyError:
+            result = apply(x)
+            if not _failed(result):
+                self.put(key, result)
+            self._count(name, False)
+        return result
+
+    def report(self):
+        ''' The hits and misses per stream, as a table (a string).'''
+        lines = ["{:30s} {:>8s} {:>8s}".format("stream", "hits", "misses")]
+        with self._lock:
+            for name, (hits, misses) in self.stats.items():
+                line = "{:30s} {:8d} {:8d}".format(str(name), hits, misses)
+                lines.append(line)
+        return "\n".join(lines)
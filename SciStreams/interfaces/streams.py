@@ -1,5 +1,8 @@
-from collections import deque
+from collections import deque, OrderedDict
 from functools import singledispatch, partial, wraps
+from itertools import count
+import queue
+import threading
 from time import time
 
 import toolz
@@ -8,14 +11,40 @@ from tornado.locks import Condition
 from tornado.ioloop import IOLoop
 from tornado.queues import Queue
 
+from . import memory
+
 
 no_default = '--no-default--'
+# returned by the key of partition_by, for an element of the same group as
+# the previous one
+same_group = '--same-group--'
+
+# the store of the results of map nodes (see set_result_store)
+_result_store = None
+
+
+def set_result_store(store):
+    ''' Reuse the results of map nodes from a store, when their input and
+        parameters are unchanged (see interfaces/resultstore.py).
+        None disables it.
+    '''
+    global _result_store
+    _result_store = store
 
 
 def identity(x):
     return x
 
 
+def seq_num(x):
+    ''' The sequence number of an element: the seq_num attribute of a
+        StreamDoc, else its seq_num item.'''
+    if isinstance(x, dict) and isinstance(x.get('attributes'), dict) \
+            and 'seq_num' in x['attributes']:
+        return x['attributes']['seq_num']
+    return x['seq_num']
+
+
 class Stream(object):
     """ A Stream is an infinite sequence of data
 
@@ -127,6 +156,15 @@ class Stream(object):
     def validate_output(self, x):
         return True
 
+    # Override these for nodes with state (see interfaces/checkpoint.py)
+    def get_state(self):
+        ''' The state of the node (None if it has none).'''
+        return None
+
+    def set_state(self, state):
+        ''' Restore the state of the node, from get_state.'''
+        pass
+
     def map(self, func, *args, **kwargs):
         """ Apply a function to every element in the stream """
         return map(func, self, *args, **kwargs)
@@ -187,6 +225,48 @@ class Stream(object):
         """
         return partition(n, self)
 
+    def partition_by(self, key, n_workers, factory, threaded=True,
+                     maxsize=10, close=None, max_idle=None):
+        """ Route elements to replicas of a subgraph, by key
+
+        factory() makes a replica of the subgraph, it returns its (input,
+        output) streams (like ImageStitchingStream). There's a replica per
+        key(x), so each key keeps its own state. Elements whose key is None
+        are stateless, they're sent to the n_workers workers in turn. The
+        outputs of the replicas are merged into the returned stream.
+
+        If threaded, the replicas run in n_workers threads (a key always runs
+        in the same thread, so in order), see partition_by.flush.
+
+        close : if set, the keys are groups of consecutive elements (for
+            ex, the scans of a stitch). key(x) can return same_group for an
+            element of the group of the previous one. When a group ends
+            (another key arrives, or on flush), close(x) of its last element
+            is sent to its replica (to emit what it holds), and the replica
+            is removed.
+        max_idle : replicas which received no element for max_idle seconds
+            are closed (see close, else they're just removed)
+
+        Examples
+        --------
+        >>> source = Stream()
+        >>> def summer():
+        ...     sin = Stream()
+        ...     return sin, sin.accumulate(lambda acc, x: acc + x[1],
+        ...                                start=0, raw=True)
+        >>> sout = source.partition_by(lambda x: x[0], 2, summer,
+        ...                            threaded=False)
+        >>> sout.sink(print)
+        >>> for x in [('a', 1), ('b', 10), ('a', 2)]:
+        ...     source.emit(x)
+        1
+        10
+        3
+        """
+        return partition_by(key, n_workers, factory, self,
+                            threaded=threaded, maxsize=maxsize, close=close,
+                            max_idle=max_idle)
+
     def sliding_window(self, n):
         """ Produce overlapping tuples of size n
 
@@ -205,6 +285,36 @@ class Stream(object):
         """
         return sliding_window(n, self)
 
+    def reorder(self, key=seq_num, max_pending=100, timeout=None, start=0):
+        """ Release elements in the order of their sequence numbers
+
+        Elements are held until the ones before them have arrived, so
+        results of parallel stages can be fed to order sensitive ones (like
+        sliding_window, or scan). Missing sequence numbers are skipped when
+        more than max_pending elements are held, or when an element has been
+        held for timeout seconds (see reorder.flush). Elements arriving after
+        their sequence number was skipped are dropped.
+
+        With a timeout, the elements released after waiting are emitted by a
+        thread of the node, so downstream nodes may run off the caller's
+        thread (the results of these emits are returned by the next update).
+
+        key : the sequence number of an element (default: seq_num)
+        start : the first sequence number
+
+        Examples
+        --------
+        >>> source = Stream()
+        >>> source.reorder(key=lambda x: x).sink(print)
+        >>> for x in [1, 0, 2]:
+        ...     source.emit(x)
+        0
+        1
+        2
+        """
+        return reorder(self, key=key, max_pending=max_pending,
+                       timeout=timeout, start=start)
+
     def rate_limit(self, interval):
         """ Limit the flow of data
 
@@ -406,19 +516,34 @@ class Sink(Stream):
 
 @singledispatch
 class map(Stream):
-    def __init__(self, func, child, *args, raw=False, **kwargs):
+    ''' Apply a function to every element.
+
+        raw : if True, the function is called on the element itself (else
+            on its args and kwargs, see stream_map)
+        reuse : if False, the result store (see set_result_store) is not used
+            for this node (for functions with side effects)
+    '''
+    def __init__(self, func, child, *args, raw=False, reuse=True, **kwargs):
         self.func = func
         self.kwargs = kwargs
         self.raw = raw
+        self.reuse = reuse
         self.args = args
 
         Stream.__init__(self, child)
 
-    def update(self, x, who=None):
+    def _apply(self, x):
         if self.raw:
-            return self.emit(self.func(x, *self.args, **self.kwargs))
+            return self.func(x, *self.args, **self.kwargs)
+        return _stream_map(self.func, x, *self.args, **self.kwargs)
 
-        return self.emit(_stream_map(self.func, x, *self.args, **self.kwargs))
+    def update(self, x, who=None):
+        if self.reuse and _result_store is not None:
+            return self.emit(_result_store.call(self._apply, self.func, x,
+                                                args=self.args,
+                                                kwargs=self.kwargs,
+                                                raw=self.raw))
+        return self.emit(self._apply(x))
 
 
 class filter(Stream):
@@ -459,6 +584,12 @@ class scan(Stream):
         '''Flush the accumulator.'''
         self.state = self.start
 
+    def get_state(self):
+        return self.state
+
+    def set_state(self, state):
+        self.state = state
+
 
 class partition(Stream):
     def __init__(self, n, child):
@@ -467,13 +598,164 @@ class partition(Stream):
         Stream.__init__(self, child)
 
     def update(self, x, who=None):
-        self.buffer.append(x)
+        self.buffer.append(memory.hold(self, x))
         if len(self.buffer) == self.n:
             result, self.buffer = self.buffer, []
-            return self.emit(tuple(result))
+            return self.emit(tuple(memory.release(h) for h in result))
         else:
             return []
 
+    def get_state(self):
+        return [memory.held_value(h) for h in self.buffer]
+
+    def set_state(self, state):
+        for h in self.buffer:
+            memory.release(h)
+        self.buffer = [memory.hold(self, x) for x in state]
+
+
+class partition_by(Stream):
+    def __init__(self, key, n_workers, factory, child, threaded=True,
+                 maxsize=10, close=None, max_idle=None, max_errors=100):
+        if n_workers < 1:
+            raise ValueError("n_workers must be at least 1")
+        self.key = key
+        self.n_workers = n_workers
+        self.factory = factory
+        self.threaded = threaded
+        self.close = close
+        self.max_idle = max_idle
+        self._next = count()
+        # the outputs of the replicas are emitted one at a time
+        self._emit_lock = threading.RLock()
+        # (element, exception) of the last elements that failed in a thread
+        self.errors = deque(maxlen=max_errors)
+        self.nerrors = 0
+        # key -> input of its replica
+        self.replicas = dict()
+        # key -> time of its last element, least recent first
+        self._used = OrderedDict()
+        # the key and (held) last element of the open group (with close)
+        self._last_key = None
+        self._last = None
+        Stream.__init__(self, child)
+
+        self._queues = list()
+        if threaded:
+            for i in range(n_workers):
+                q = queue.Queue(maxsize=maxsize)
+                thread = threading.Thread(target=self._work, args=(q,),
+                                          daemon=True)
+                thread.start()
+                self._queues.append(q)
+
+    def _emit_output(self, x):
+        with self._emit_lock:
+            self.emit(x)
+
+    def _work(self, q):
+        while True:
+            sin, h = q.get()
+            x = memory.release(h)
+            try:
+                sin.emit(x)
+            except Exception as e:
+                print("partition_by : Error processing element ({})".format(e))
+                self.errors.append((x, e))
+                self.nerrors += 1
+            finally:
+                q.task_done()
+
+    def _replica(self, k):
+        if k not in self.replicas:
+            sin, sout = self.factory()
+            sout.sink(self._emit_output)
+            self.replicas[k] = sin
+        return self.replicas[k]
+
+    def _worker(self, k):
+        if isinstance(k, tuple) and k[0] == no_default:
+            return k[1]
+        return hash(k) % self.n_workers
+
+    def _send(self, k, x):
+        sin = self._replica(k)
+        if self.threaded:
+            # blocks if the worker is behind
+            self._queues[self._worker(k)].put((sin, memory.hold(self, x)))
+            return []
+        return sin.emit(x)
+
+    def _close_group(self, k):
+        ''' Close the replica of k (send it close(x) of its last element if
+            it's the open group) and remove it.'''
+        res = []
+        if k == self._last_key and self._last is not None:
+            x = memory.release(self._last)
+            self._last_key = self._last = None
+            res = self._send(k, self.close(x))
+        self.replicas.pop(k, None)
+        self._used.pop(k, None)
+        return res
+
+    def _evict_idle(self):
+        now = time()
+        res = []
+        while self._used:
+            k, t = next(iter(self._used.items()))
+            if now - t < self.max_idle:
+                break
+            res += self._close_group(k)
+        return res
+
+    def update(self, x, who=None):
+        res = []
+        k = self.key(x)
+        if k == same_group:
+            k = self._last_key
+            if k is None:
+                # the group started before the first element
+                k = (same_group, next(self._next))
+        if k is None:
+            # no state, one replica per worker, in turn
+            return self._send((no_default,
+                               next(self._next) % self.n_workers), x)
+        if self.close is not None:
+            if self._last_key is not None and k != self._last_key:
+                res += self._close_group(self._last_key)
+            if self._last is not None:
+                memory.release(self._last)
+            self._last_key = k
+            self._last = memory.hold(self, x)
+        if self.max_idle is not None:
+            self._used.pop(k, None)
+            self._used[k] = time()
+        res += self._send(k, x)
+        if self.max_idle is not None:
+            res += self._evict_idle()
+        return res
+
+    def flush(self, close=True):
+        ''' Wait for the replicas to process the elements received. The
+            open group is closed first (with close), unless close is
+            False.'''
+        if close and self.close is not None and self._last_key is not None:
+            self._close_group(self._last_key)
+        for q in self._queues:
+            q.join()
+
+    def get_state(self):
+        ''' The key and last element of the open group (the states of the
+            replicas are saved by the Checkpointer).'''
+        return [self._last_key, memory.held_value(self._last)
+                if self._last is not None else None]
+
+    def set_state(self, state):
+        if self._last is not None:
+            memory.release(self._last)
+        self._last_key, last = state
+        self._last = memory.hold(self, last) if last is not None else None
+
 
 class sliding_window(Stream):
     def __init__(self, n, child):
@@ -482,12 +764,130 @@ class sliding_window(Stream):
         Stream.__init__(self, child)
 
     def update(self, x, who=None):
-        self.buffer.append(x)
         if len(self.buffer) == self.n:
-            return self.emit(tuple(self.buffer))
+            # the oldest element leaves the window
+            memory.release(self.buffer[0])
+        self.buffer.append(memory.hold(self, x))
+        if len(self.buffer) == self.n:
+            return self.emit(tuple(memory.held_value(h)
+                                   for h in self.buffer))
         else:
             return []
 
+    def get_state(self):
+        return [memory.held_value(h) for h in self.buffer]
+
+    def set_state(self, state):
+        for h in self.buffer:
+            memory.release(h)
+        self.buffer = deque((memory.hold(self, x) for x in state),
+                            maxlen=self.n)
+
+
+class reorder(Stream):
+    def __init__(self, child, key=seq_num, max_pending=100, timeout=None,
+                 start=0):
+        self.key = key
+        self.max_pending = max_pending
+        self.timeout = timeout
+        # the next sequence number to release
+        self.next = start
+        # sequence number -> (element, time received), oldest first
+        self.pending = OrderedDict()
+        # the sequence numbers skipped
+        self.skipped = list()
+        self._lock = threading.RLock()
+        self._cond = threading.Condition(self._lock)
+        # the results of the emits of the checker thread
+        self._expired = list()
+        Stream.__init__(self, child)
+        if timeout is not None:
+            # skips the elements waited for too long
+            thread = threading.Thread(target=self._check, daemon=True)
+            thread.start()
+
+    def update(self, x, who=None):
+        seq = self.key(x)
+        with self._lock:
+            if seq < self.next or seq in self.pending:
+                print("reorder : Warning, dropping element with late or " +
+                      "repeated sequence number {}".format(seq))
+                return []
+            self.pending[seq] = memory.hold(self, x), time()
+            result, self._expired = self._expired, list()
+            result.extend(self._release())
+            while len(self.pending) > self.max_pending:
+                self._skip_to(min(self.pending))
+                result.extend(self._release())
+            self._cond.notify()
+        return result
+
+    def _release(self):
+        ''' Emit the pending elements which are next in sequence.'''
+        result = []
+        while self.next in self.pending:
+            h, _ = self.pending.pop(self.next)
+            x = memory.release(h)
+            self.next += 1
+            r = self.emit(x)
+            if type(r) is list:
+                result.extend(r)
+            else:
+                result.append(r)
+        return result
+
+    def _skip_to(self, seq):
+        if seq <= self.next:
+            return
+        print("reorder : Warning, skipping missing sequence numbers " +
+              "{} to {}".format(self.next, seq - 1))
+        self.skipped.extend(range(self.next, seq))
+        self.next = seq
+
+    def _check(self):
+        ''' Skip the missing elements that have been waited for too long
+            (runs in a thread, waiting until the oldest element expires).'''
+        with self._cond:
+            while True:
+                if not self.pending:
+                    self._cond.wait()
+                    continue
+                h, t = next(iter(self.pending.values()))
+                delay = t + self.timeout - time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                self._skip_to(min(self.pending))
+                self._expired.extend(self._release())
+
+    def get_state(self):
+        with self._lock:
+            pending = {seq: memory.held_value(h)
+                       for seq, (h, t) in self.pending.items()}
+            return dict(next=self.next, pending=pending,
+                        skipped=list(self.skipped))
+
+    def set_state(self, state):
+        with self._lock:
+            self.next = state['next']
+            now = time()
+            for h, t in self.pending.values():
+                memory.release(h)
+            self.pending = OrderedDict(
+                (seq, (memory.hold(self, x), now))
+                for seq, x in sorted(state['pending'].items()))
+            self.skipped = list(state['skipped'])
+            self._cond.notify()
+
+    def flush(self):
+        ''' Release all the pending elements, skipping the missing ones.'''
+        with self._lock:
+            result, self._expired = self._expired, list()
+            while self.pending:
+                self._skip_to(min(self.pending))
+                result.extend(self._release())
+        return result
+
 
 class timed_window(Stream):
     def __init__(self, interval, child, loop=None):
@@ -579,9 +979,9 @@ class zip(Stream):
 
     def update(self, x, who=None):
         L = self.buffers[self.children.index(who)]
-        L.append(x)
+        L.append(memory.hold(self, x))
         if len(L) == 1 and all(self.buffers):
-            tup = tuple(buf.popleft() for buf in self.buffers)
+            tup = tuple(memory.release(buf.popleft()) for buf in self.buffers)
             self.condition.notify_all()
             if tup and hasattr(tup[0], '__stream_merge__'):
                 tup = tup[0].__stream_merge__(*tup[1:])
@@ -605,14 +1005,14 @@ class merge(Stream):
 
     def update(self, x, who=None):
         L = self.buffers[self.children.index(who)]
-        L.append(x)
+        L.append(memory.hold(self, x))
         if len(L) == 1 and all(self.buffers):
             # in case of delayed instance, this is necessary
-            res = self.buffers[0].popleft()
+            res = memory.release(self.buffers[0].popleft())
             for buf in self.buffers[1:]:
                 # this is meant to allow data that has a "merge" feature
                 # TODO : to be improved (removed??)
-                buftmp = buf.popleft()
+                buftmp = memory.release(buf.popleft())
                 if hasattr(res, 'merge'):
                     # print("found merge attribute")
                     res = res.merge(buftmp)
@@ -687,13 +1087,22 @@ class collect(Stream):
         Stream.__init__(self, child)
 
     def update(self, x, who=None):
-        self.cache.append(x)
+        self.cache.append(memory.hold(self, x))
 
     def flush(self, _=None):
-        out = tuple(self.cache)
+        out = tuple(memory.release(h) for h in self.cache)
         self.emit(out)
         self.cache.clear()
 
+    def get_state(self):
+        return [memory.held_value(h) for h in self.cache]
+
+    def set_state(self, state):
+        for h in self.cache:
+            memory.release(h)
+        self.cache.clear()
+        self.cache.extend(memory.hold(self, x) for x in state)
+
 
 # dispatch on first arg
 # another option is to supply a wrapper function
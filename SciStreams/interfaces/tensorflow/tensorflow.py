@@ -1,10 +1,20 @@
 # stuff involving writing to data that will get sent to tensorflow
 from SciAnalysis.config import TFLAGS
 from SciAnalysis.tools import make_dir
+from contextlib import contextmanager
+from itertools import islice
 import os
+from queue import Queue, Full
+import threading
 
 import numpy as np
 
+try:
+    import fcntl
+except ImportError:
+    # no locking across processes (not on unix)
+    fcntl = None
+
 
 class MasterRecord:
     ''' This is the object that defines a set of records.'''
@@ -89,17 +99,17 @@ def label2bin(labels, dtype=np.uint8):
         machine to machine. Using np.save is endian friendly, but np.tofile is
         not.
     '''
-    nbytes_per_type = dtype().nbytes
-    nbits_per_type = nbytes_per_type*8
-
-    num_labels = len(labels)
-    nbytes = calc_labelbin_size(num_labels, nbytes_per_type)
+    nbytes_per_type = np.dtype(dtype).itemsize
 
-    result = np.zeros(nbytes, dtype=dtype)
-    for i, label in enumerate(labels):
-        result[i//nbits_per_type] |= (label > 0) << (i % nbits_per_type)
+    labels = np.asarray(labels) > 0
+    nelems = calc_labelbin_size(len(labels), nbytes_per_type)
 
-    return result
+    # the bits of the little endian bytes, least significant first
+    bits = _packbits_little(labels)
+    packed = np.zeros(nelems*nbytes_per_type, dtype=np.uint8)
+    packed[:len(bits)] = bits
+    little = np.dtype(dtype).newbyteorder('<')
+    return packed.view(little).astype(dtype)
 
 
 def bin2label(res, num_labels):
@@ -115,17 +125,29 @@ def bin2label(res, num_labels):
         num_labels : list
             the list of labels
     '''
-    dtype = res.dtype.type
-    nbytes_per_type = dtype().nbytes
-    nbits_per_type = nbytes_per_type*8
-    labels = np.zeros(num_labels, dtype=int)
+    res = np.asarray(res)
+    little = res.dtype.newbyteorder('<')
+    packed = res.astype(little).view(np.uint8)
+    bits = _unpackbits_little(packed, num_labels)
+    return bits.astype(int)
+
 
-    for i in range(num_labels):
-        labels[i] = ((res[i//nbits_per_type] &
-                      (1 << i % nbits_per_type)) >>
-                     (i % nbits_per_type)) > 0
+def _packbits_little(bits):
+    ''' np.packbits(bits, bitorder='little') of a 1D array (the bitorder
+        argument needs numpy >= 1.17).'''
+    bits = np.asarray(bits, dtype=np.uint8)
+    padded = np.zeros((len(bits) + 7)//8*8, dtype=np.uint8)
+    padded[:len(bits)] = bits
+    return np.packbits(padded.reshape(-1, 8)[:, ::-1], axis=-1).ravel()
 
-    return labels
+
+def _unpackbits_little(packed, count):
+    ''' np.unpackbits(packed, axis=-1, count=count, bitorder='little'), the
+        first count bits along the last axis, least significant first.'''
+    packed = np.asarray(packed, dtype=np.uint8)
+    bits = np.unpackbits(packed[..., None], axis=-1)[..., ::-1]
+    bits = bits.reshape(packed.shape[:-1] + (-1,))
+    return bits[..., :count]
 
 
 def store_result_tensorflow(result, dataset=None, dtype=np.uint32):
@@ -169,9 +191,8 @@ def store_result_tensorflow(result, dataset=None, dtype=np.uint32):
         we can use their record reader).  Do not run this across machines with
         different endianness (this storage is not meant for archiving)
 
-        There is no file locking mechanism here. Make sure this code running
-        does not have competing access or else this may result in inconsistent
-        behaviour.
+        Records are appended by a RecordWriter (see get_record_writer), which
+        locks the data set, so several processes can write to it.
 
         The data relies on a master file to describe it. Its format is:
             num recs, num batches per rec, image shape 1, image shape 2,
@@ -196,112 +217,187 @@ def store_result_tensorflow(result, dataset=None, dtype=np.uint32):
     # grab the image from StreamDoc
     kwargs = result['kwargs']
     image = kwargs['image']
+    labels = kwargs.get('labels', None)
 
-    if 'labels' in kwargs:
-        labels = kwargs['labels']
-        num_labels = len(labels)
-        labelbin = label2bin(labels, dtype=dtype)
-    else:
-        labels = None
-        num_labels = 0
-        labelbin = np.array([], dtype=dtype)
-
-    nbytes = dtype().nbytes
-    num_elems_label = calc_labelbin_size(num_labels, nbytes)
-
-    # check image is a numpy array
-    if not isinstance(image, np.ndarray):
-        image = np.array(image, dtype=dtype)
-
-    if image.ndim != 2:
-        errormsg = "Must be an image of 2 dimensions (not a stack)"
-        errormsg += "\n Received {} dimensions".format(image.ndim)
-        raise ValueError(errormsg)
+    writer = get_record_writer(dataset, dtype=dtype)
+    writer.append(image, labels=labels)
 
-    # force it to have the required data type
-    image = image.astype(dtype)
 
-    # make image and label data
-    data = np.concatenate((labelbin, image.ravel()))
-    expected_size = image.shape[0]*image.shape[1] + num_elems_label
-    if (len(data) != expected_size):
-        errormsg = "Data length doesn't match labels and image size\n"
-        errormsg += "Got {}\n".format(len(data))
-        errormsg += "Expected {}\n".format(expected_size)
-        raise ValueError(errormsg)
+class RecordWriter:
+    ''' Append records (image and labels) to the batch files of a data set.
 
-    elems_per_data = len(data)
+        Batch files are opened in append mode and records written at their
+        end, the file is never read back. The master header is kept in
+        memory and only saved (to a temporary file, then renamed) when a
+        new batch is started.
 
-    # TODO : add file lock
-    # TODO : make master file that saves different data sets
-    fpath = TFLAGS.data_dir + "/" + dataset
-    make_dir(fpath)
-
-    master_filename = fpath + "/master_file.txt"
-    # create master file if not present
-    if not os.path.isfile(master_filename):
-        # num recs, num batches per rec, image shape 1, image shape 2,
-        #      num labels
-        # TODO : add data type to master header
-        _save_master_file(master_filename, 0, TFLAGS.num_per_batch,
-                          image.shape, num_labels)
+        Writes are locked (a lock file, and a thread lock), so workers from
+        several processes can write to the same data set. The header is
+        read again each time the lock is taken, as another process may have
+        saved it.
 
-    master_record = _read_master_file(master_filename)
-    # res = np.loadtxt(master_filename, delimiter=" ", dtype=dtype)
+        Parameters
+        ----------
+        dataset : str
+            the data set name
 
-    numrecs = master_record.number_records
-    # numbatches = master_record.records_per_batch
-    # image_shape = master_record.image_shape
-    num_labels = master_record.number_labels
+        dtype : type, optional
+            the data type of the records
 
-    # elems_per_label = calc_labelbin_size(num_labels, dtype().nbytes)
+        fpath : str, optional
+            the directory of the data sets (default TFLAGS.data_dir)
 
-    if (num_labels == 0 and (labels is not None and len(labels) != 0)) \
-       or (labels is not None and (num_labels != len(labels))):
-        if labels is None:
-            actual_labels = 0
+        num_per_batch : int, optional
+            the number of records per batch file, for new data sets (default
+            TFLAGS.num_per_batch)
+    '''
+    def __init__(self, dataset, dtype=np.uint32, fpath=None,
+                 num_per_batch=None):
+        if fpath is None:
+            fpath = TFLAGS.data_dir
+        if num_per_batch is None:
+            num_per_batch = TFLAGS.num_per_batch
+        self.dtype = dtype
+        self.num_per_batch = num_per_batch
+        self.fpath = fpath + "/" + dataset
+        make_dir(self.fpath)
+        self.master_filename = self.fpath + "/master_file.txt"
+
+        self._thread_lock = threading.Lock()
+        self._lockfile = open(self.fpath + "/master_file.lock", "a")
+        # the master header (read again under the lock)
+        self.master_record = None
+        # the open batch file and its number
+        self._batch = None
+        self._batch_file = None
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            if fcntl is not None:
+                fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+
+    def _load_master(self):
+        ''' Load the master header (with the lock held, it may have been
+            saved by someone else). The file is small, it's always read
+            rather than guessing from its inode or time stamp whether it
+            changed.'''
+        try:
+            self.master_record = _read_master_file(self.master_filename)
+        except FileNotFoundError:
+            return
+        self.num_per_batch = self.master_record.records_per_batch
+
+    def _save_master(self, num_recs, image_shape, num_labels):
+        _save_master_file(self.master_filename, num_recs, self.num_per_batch,
+                          image_shape, num_labels)
+        self._load_master()
+
+    def _open_batch(self, batch):
+        if self._batch != batch:
+            if self._batch_file is not None:
+                self._batch_file.close()
+            filename = self.fpath + "/{:08d}.bin".format(batch)
+            self._batch_file = open(filename, "ab")
+            self._batch = batch
+        return self._batch_file
+
+    def append(self, image, labels=None):
+        ''' Append a record (a 2D image, and a list of labels).
+
+            Returns the (batch number, record number in the batch).
+        '''
+        dtype = self.dtype
+        if labels is not None and len(labels) != 0:
+            num_labels = len(labels)
+            labelbin = label2bin(labels, dtype=dtype)
         else:
-            actual_labels = len(labels)
+            num_labels = 0
+            labelbin = np.array([], dtype=dtype)
 
-        errormsg = "Number of labels doesn't match labels\n"
-        errormsg += "Expected {} but got {}".format(num_labels, actual_labels)
-        raise ValueError(errormsg)
+        # check image is a numpy array
+        if not isinstance(image, np.ndarray):
+            image = np.array(image, dtype=dtype)
 
-    curfilename = fpath + "/{:08d}.bin".format(numrecs)
-
-    # initial
-    if not os.path.isfile(curfilename):
-        arr = data
-    else:
-        # read curfile as raw array
-        # arr = np.fromfile(curfilename, dtype=dtype)
-        arr = _read_batch(numrecs, dataset=dataset, dtype=dtype)
-        array_size = len(arr)
-        if array_size % elems_per_data != 0:
-            errormsg = "Data mismatch\n"
-            errormsg += "array size : {}\n".format(array_size)
-            errormsg += "elems per data : {}\n".format(elems_per_data)
-            errormsg += "array size should be divisible by elems per data"
+        if image.ndim != 2:
+            errormsg = "Must be an image of 2 dimensions (not a stack)"
+            errormsg += "\n Received {} dimensions".format(image.ndim)
             raise ValueError(errormsg)
 
-        num_elements = array_size/elems_per_data
-
-        # if the number of elements has reached maximum batch size
-        if num_elements == TFLAGS.num_per_batch:
-            # update num recs and current file
-            numrecs += 1
-            _save_master_file(master_filename, numrecs, TFLAGS.num_per_batch,
-                              image.shape, num_labels)
-            curfilename = fpath + "/{:08d}.bin".format(numrecs)
-            # arr = np.fromfile(curfilename, dtype=dtype).reshape((-1,
-            # image_shape[0], image_shape[1]))
-            arr = data
-        else:
-            arr = np.concatenate((arr, data)).astype(dtype)
-
-    arr.tofile(curfilename)
-
-    # now save image as a batch into a file
+        # make image and label data, with the required data type
+        data = np.concatenate((labelbin, image.ravel().astype(dtype)))
+        data = data.astype(dtype).tobytes()
+
+        with self._locked():
+            self._load_master()
+            if self.master_record is None:
+                # num recs, num batches per rec, image shape 1,
+                # image shape 2, num labels
+                # TODO : add data type to master header
+                self._save_master(0, image.shape, num_labels)
+            master_record = self.master_record
+
+            if master_record.number_labels != num_labels:
+                errormsg = "Number of labels doesn't match labels\n"
+                errormsg += "Expected {} but got {}".format(
+                    master_record.number_labels, num_labels)
+                raise ValueError(errormsg)
+            if tuple(master_record.image_shape) != image.shape:
+                errormsg = "Image shape doesn't match the data set\n"
+                errormsg += "Expected {} but got {}".format(
+                    tuple(master_record.image_shape), image.shape)
+                raise ValueError(errormsg)
+
+            numrecs = master_record.number_records
+            f = self._open_batch(numrecs)
+            # the size of the file, it may have been written to by others
+            size = os.fstat(f.fileno()).st_size
+            if size % len(data) != 0:
+                errormsg = "Data mismatch\n"
+                errormsg += "file size : {}\n".format(size)
+                errormsg += "bytes per data : {}\n".format(len(data))
+                errormsg += "file size should be divisible by bytes per data"
+                raise ValueError(errormsg)
+
+            num_elements = size//len(data)
+            # if the number of elements has reached maximum batch size
+            if num_elements >= master_record.records_per_batch:
+                # update num recs and current file
+                numrecs += 1
+                self._save_master(numrecs, image.shape, num_labels)
+                f = self._open_batch(numrecs)
+                num_elements = 0
+
+            f.write(data)
+            f.flush()
+
+        return numrecs, num_elements
+
+    def close(self):
+        if self._batch_file is not None:
+            self._batch_file.close()
+            self._batch_file = None
+            self._batch = None
+        self._lockfile.close()
+
+
+# the record writers, by (directory, data type)
+_record_writers = dict()
+
+
+def get_record_writer(dataset, dtype=np.uint32, fpath=None):
+    ''' Get the RecordWriter of a data set (created if needed).'''
+    if fpath is None:
+        fpath = TFLAGS.data_dir
+    key = fpath + "/" + dataset, np.dtype(dtype)
+    if key not in _record_writers:
+        _record_writers[key] = RecordWriter(dataset, dtype=dtype, fpath=fpath)
+    return _record_writers[key]
 
 
 def read_result_tensorflow(recno, dataset=None, dtype=np.uint32):
@@ -333,22 +429,28 @@ def _read_record(record_number, dataset=None, dtype=np.uint32):
     img_shape = master_record.image_shape
     num_labels = master_record.number_labels
 
-    if record_number > number_records:
-        errormsg = "Error, only {} records available, ".format(number_records)
-        errormsg += "but asked for record # {}".format(record_number)
-        raise ValueError(errormsg)
-
     batch_number = record_number//records_per_batch
     batch_record = record_number % records_per_batch
 
-    arr = _read_batch(batch_number, dataset=dataset, dtype=dtype)
+    # number_records is the number of the last batch
+    if batch_number > number_records:
+        errormsg = "Error, only {} batches available, ".format(
+            number_records + 1)
+        errormsg += "but asked for record # {}".format(record_number)
+        raise ValueError(errormsg)
 
     # size in elements not bytes
     label_size = calc_labelbin_size(num_labels, dtype().nbytes)
     image_size = img_shape[0]*img_shape[1]
     record_size = image_size + label_size
 
-    record = arr[batch_record*record_size:(batch_record + 1)*record_size]
+    # map only the record
+    batch_filename = fpath + "/" + dataset + \
+        "/{:08d}.bin".format(batch_number)
+    record = np.memmap(batch_filename, dtype=dtype, mode='r',
+                       offset=batch_record*record_size*dtype().nbytes,
+                       shape=(record_size,))
+    record = np.array(record)
     labels = bin2label(record[:label_size], num_labels)
     image = record[label_size:].reshape(img_shape)
     record = Record(labels=labels, image=image)
@@ -356,24 +458,250 @@ def _read_record(record_number, dataset=None, dtype=np.uint32):
     return record
 
 
+class RecordReader:
+    ''' Read records of a data set, at random, or as shuffled mini batches.
+
+        Each batch file is memory mapped as a (records, record size) array,
+        the offsets of the records come from the master header. Only the
+        records asked for are read. This doesn't need TensorFlow.
+
+        Parameters
+        ----------
+        dataset : str
+            the data set name
+
+        dtype : type, optional
+            the data type of the records
+
+        fpath : str, optional
+            the directory of the data sets (default TFLAGS.data_dir)
+
+        Examples
+        --------
+        >>> reader = RecordReader("test")
+        >>> for images, labels in reader.batches(32, seed=0):
+        ...     train(images, labels)
+    '''
+    def __init__(self, dataset, dtype=np.uint32, fpath=None):
+        if fpath is None:
+            fpath = TFLAGS.data_dir
+        self.dtype = dtype
+        self.fpath = fpath + "/" + dataset
+        self._memmaps = dict()
+        self.refresh()
+
+    def refresh(self):
+        ''' Read the master header again, for records written since.'''
+        master_record = _read_master_file(self.fpath + "/master_file.txt")
+        self.num_batches = master_record.number_records + 1
+        self.records_per_batch = master_record.records_per_batch
+        self.image_shape = tuple(master_record.image_shape)
+        self.num_labels = master_record.number_labels
+        # size in elements not bytes
+        self.label_size = calc_labelbin_size(self.num_labels,
+                                             np.dtype(self.dtype).itemsize)
+        self.record_size = self.label_size + \
+            self.image_shape[0]*self.image_shape[1]
+        self._memmaps = dict()
+
+    def _batch_filename(self, batch_number):
+        return self.fpath + "/{:08d}.bin".format(batch_number)
+
+    def _memmap(self, batch_number):
+        ''' Map batch file, as a (records, record size) array.'''
+        mm = self._memmaps.get(batch_number)
+        if mm is None or batch_number == self.num_batches - 1:
+            # the last batch may still be written to
+            record_bytes = self.record_size*np.dtype(self.dtype).itemsize
+            nrecs = os.path.getsize(self._batch_filename(batch_number)) \
+                // record_bytes
+            if mm is not None and len(mm) == nrecs:
+                return mm
+            if nrecs == 0:
+                mm = np.empty((0, self.record_size), dtype=self.dtype)
+            else:
+                mm = np.memmap(self._batch_filename(batch_number),
+                               dtype=self.dtype, mode='r',
+                               shape=(nrecs, self.record_size))
+            self._memmaps[batch_number] = mm
+        return mm
+
+    def __len__(self):
+        ''' the number of records.'''
+        last = self.num_batches - 1
+        return last*self.records_per_batch + len(self._memmap(last))
+
+    def _read(self, indices):
+        ''' Read the raw records of indices, as a (N, record size) array.
+
+            Records are read batch file by batch file, in file order.
+        '''
+        indices = np.asarray(indices, dtype=int)
+        nrecords = len(self)
+        if len(indices) and (indices.min() < 0 or indices.max() >= nrecords):
+            raise IndexError("Record indices out of range "
+                             "(0 to {})".format(nrecords - 1))
+        batch_numbers = indices//self.records_per_batch
+        batch_records = indices % self.records_per_batch
+        records = np.empty((len(indices), self.record_size),
+                           dtype=self.dtype)
+        for batch_number in np.unique(batch_numbers):
+            w = np.where(batch_numbers == batch_number)[0]
+            order = np.argsort(batch_records[w])
+            mm = self._memmap(batch_number)
+            records[w[order]] = mm[batch_records[w][order]]
+        return records
+
+    def get(self, indices):
+        ''' Get records as stacked arrays.
+
+            Returns
+            -------
+            images : (N, image shape) np.ndarray
+            labels : (N, number of labels) np.ndarray of ints
+        '''
+        records = self._read(indices)
+        images = records[:, self.label_size:].reshape(
+            (len(records),) + self.image_shape)
+        labelbins = records[:, :self.label_size]
+        little = labelbins.dtype.newbyteorder('<')
+        packed = labelbins.astype(little).view(np.uint8)
+        labels = _unpackbits_little(packed, self.num_labels).astype(int)
+        return images, labels
+
+    def __getitem__(self, record_number):
+        images, labels = self.get([record_number])
+        return Record(labels=labels[0], image=images[0])
+
+    def _shuffled(self, buffer_size, rng):
+        ''' Yield the record indices, shuffled with a shuffle buffer.
+
+            Batch files are taken in a random order, and their records in
+            order, into a buffer from which records are drawn at random.
+        '''
+        nrecords = len(self)
+        buffer = list()
+        for batch_number in rng.permutation(self.num_batches):
+            start = batch_number*self.records_per_batch
+            stop = min(start + self.records_per_batch, nrecords)
+            for index in range(start, stop):
+                buffer.append(index)
+                if len(buffer) >= buffer_size:
+                    i = rng.randint(len(buffer))
+                    buffer[i], buffer[-1] = buffer[-1], buffer[i]
+                    yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def batches(self, batch_size, shuffle=True, buffer_size=1024, seed=None,
+                prefetch=2, drop_remainder=False):
+        ''' Iterate over the records as mini batches of (images, labels)
+            (see get).
+
+            Parameters
+            ----------
+            batch_size : int
+                the number of records per mini batch
+
+            shuffle : bool, optional
+                shuffle the records (else they're in order)
+
+            buffer_size : int, optional
+                the size of the shuffle buffer (in records). Larger mixes
+                records across more batch files.
+
+            seed : int, optional
+                the seed of the shuffling
+
+            prefetch : int, optional
+                the number of mini batches read ahead by a background thread
+                (0 reads in the calling thread)
+
+            drop_remainder : bool, optional
+                drop the last mini batch if smaller than batch_size
+        '''
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        if shuffle:
+            # RandomState rather than default_rng (numpy >= 1.17)
+            indices = self._shuffled(buffer_size,
+                                     np.random.RandomState(seed))
+        else:
+            indices = iter(range(len(self)))
+
+        def minibatches():
+            while True:
+                chunk = list(islice(indices, batch_size))
+                if not chunk or \
+                        (drop_remainder and len(chunk) < batch_size):
+                    return
+                yield self.get(chunk)
+
+        if prefetch > 0:
+            return _prefetch(minibatches(), prefetch)
+        return minibatches()
+
+
+def _prefetch(items, depth):
+    ''' Iterate over items, computed ahead by a background thread.
+
+        At most depth items are waiting. Exceptions are raised in the calling
+        thread.
+    '''
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def feed():
+        try:
+            for item in items:
+                while not stop.is_set():
+                    try:
+                        queue.put((item, None), timeout=.1)
+                        break
+                    except Full:
+                        pass
+                if stop.is_set():
+                    return
+            queue.put((done, None))
+        except Exception as e:
+            queue.put((done, e))
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, e = queue.get()
+            if e is not None:
+                raise e
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def _save_master_file(filename, num_recs, num_per_batch, image_shape,
                       num_labels):
     ''' Save the master file
-        overwrites previous
+        overwrites previous (atomically, readers see the old or new file)
 
         Format:
         num recs, num batches per rec, image shape 1, image shape 2,
             num labels
     '''
-    np.savetxt(filename,
-               [[num_recs, num_per_batch, image_shape[0], image_shape[1],
-                 num_labels]],
-               delimiter=" ", fmt=['%d', '%d', '%d', '%d', '%d'])
+    vals = [num_recs, num_per_batch, image_shape[0], image_shape[1],
+            num_labels]
+    tmpfile = filename + ".tmp"
+    with open(tmpfile, "w") as f:
+        f.write(" ".join("{:d}".format(int(val)) for val in vals) + "\n")
+    os.replace(tmpfile, filename)
 
 
 def _read_master_file(filename):
 
-    res = np.loadtxt(filename, delimiter=" ", dtype=int)
+    with open(filename) as f:
+        res = [int(val) for val in f.read().split()]
 
     master_record = MasterRecord()
     master_record.number_records = res[0]
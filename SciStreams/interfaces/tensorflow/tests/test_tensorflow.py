@@ -1,24 +1,21 @@
 import numpy as np
-import tempfile
 
 from SciAnalysis.tools import make_dir
 
 from SciAnalysis.interfaces.tensorflow.tensorflow \
         import store_result_tensorflow, read_result_tensorflow,\
-        get_filenames,\
+        get_filenames, RecordWriter, RecordReader,\
         label2bin, bin2label, calc_labelbin_size
 
 from SciAnalysis.config import TFLAGS
 
 
-def _test_store_result(image, labels=None):
+def _test_store_result(tmp_path, image, labels=None):
     result = dict()
     result['kwargs'] = {'image': image}
     if labels is not None:
         result['kwargs']['labels'] = labels
 
-    # temp path
-    tmp_path = tempfile.mktemp(prefix="mlpipeline")
     make_dir(tmp_path)
     TFLAGS.data_dir = tmp_path
     TFLAGS.num_per_batch = 3
@@ -59,11 +56,11 @@ def _test_store_result(image, labels=None):
     assert fnames[1] == tmp_path + "/test/{:08d}.bin".format(0)
 
 
-def test_store_results():
+def test_store_results(tmp_path):
     image = np.ones((100, 100))
-    _test_store_result(image, labels=None)
+    _test_store_result(str(tmp_path / "nolabels"), image, labels=None)
     labels = [True, True, False, False, True]
-    _test_store_result(image, labels=labels)
+    _test_store_result(str(tmp_path / "labels"), image, labels=labels)
 
 
 def test_label2bin():
@@ -100,3 +97,104 @@ def test_calc_labelbinsize():
     assert calc_labelbin_size(8, 1) == 1
     assert calc_labelbin_size(9, 1) == 2
     assert calc_labelbin_size(9, 2) == 1
+
+
+def test_label2bin_uint32():
+    labels = np.random.randint(0, 2, 45)
+    res = label2bin(labels, dtype=np.uint32)
+    assert res.dtype == np.uint32
+    assert len(res) == 2
+    # bit i of element i//32
+    assert res[1] == sum(int(v) << i for i, v in enumerate(labels[32:]))
+    assert (bin2label(res, len(labels)) == labels).all()
+
+
+def test_packbits_little():
+    from SciAnalysis.interfaces.tensorflow.tensorflow import \
+        _packbits_little, _unpackbits_little
+    bits = np.random.randint(0, 2, 21)
+    packed = _packbits_little(bits)
+    assert len(packed) == 3
+    assert packed[0] == sum(int(v) << i for i, v in enumerate(bits[:8]))
+    assert (_unpackbits_little(packed, 21) == bits).all()
+    rows = np.array([packed, packed[::-1]])
+    assert (_unpackbits_little(rows, 21)[0] == bits).all()
+    assert _unpackbits_little(rows, 21).shape == (2, 21)
+
+
+def test_RecordWriter_shared_header(tmp_path):
+    # two writers, each sees the header the other one saved
+    tmp_path = str(tmp_path)
+    writers = [RecordWriter("test", fpath=tmp_path, num_per_batch=2)
+               for i in range(2)]
+    for i in range(6):
+        writers[i % 2].append(np.full((4, 4), i))
+    for writer in writers:
+        writer.close()
+    reader = RecordReader("test", fpath=tmp_path)
+    assert reader.num_batches == 3
+    assert [reader[i].image[0, 0] for i in range(6)] == list(range(6))
+
+
+def _write_records(tmp_path, start):
+    writer = RecordWriter("test", fpath=tmp_path, num_per_batch=4)
+    for i in range(start, start + 5):
+        writer.append(np.full((10, 10), i), labels=[i % 2, 1])
+    writer.close()
+
+
+def test_RecordWriter_processes(tmp_path):
+    from multiprocessing import Process
+    tmp_path = str(tmp_path)
+    procs = [Process(target=_write_records, args=(tmp_path, start))
+             for start in [0, 5, 10]]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+    TFLAGS.data_dir = tmp_path
+    res = np.loadtxt(tmp_path + "/test/master_file.txt", dtype=int)
+    # 15 records, 4 per batch
+    assert res[0] == 3
+    images = sorted(read_result_tensorflow(i, dataset="test").image[0, 0]
+                    for i in range(15))
+    assert images == list(range(15))
+    record = read_result_tensorflow(14, dataset="test")
+    assert list(record.labels) == [record.image[0, 0] % 2, 1]
+
+
+def test_RecordReader(tmp_path):
+    tmp_path = str(tmp_path)
+    writer = RecordWriter("test", fpath=tmp_path, num_per_batch=4)
+    for i in range(10):
+        writer.append(np.full((5, 6), i), labels=[i % 2, 1, i % 3 == 0])
+
+    reader = RecordReader("test", fpath=tmp_path)
+    assert len(reader) == 10
+    record = reader[6]
+    assert (record.image == 6).all()
+    assert list(record.labels) == [0, 1, 1]
+    images, labels = reader.get([9, 0, 5])
+    assert images.shape == (3, 5, 6)
+    assert list(images[:, 0, 0]) == [9, 0, 5]
+    assert list(labels[:, 0]) == [1, 0, 1]
+
+    batches = list(reader.batches(4, seed=1, buffer_size=3))
+    assert [len(images) for images, labels in batches] == [4, 4, 2]
+    seen = np.concatenate([images[:, 0, 0] for images, labels in batches])
+    assert sorted(seen) == list(range(10))
+    # the same seed, the same order
+    again = np.concatenate([images[:, 0, 0] for images, labels
+                            in reader.batches(4, seed=1, buffer_size=3)])
+    assert list(seen) == list(again)
+
+    batches = reader.batches(3, shuffle=False, prefetch=0,
+                             drop_remainder=True)
+    assert [list(images[:, 0, 0]) for images, labels in batches] == \
+        [[0, 1, 2], [3, 4, 5], [6, 7, 8]]
+    # records written since are found
+    writer.append(np.full((5, 6), 10), labels=[0, 1, 0])
+    assert len(reader) == 11
+    assert (reader[10].image == 10).all()
+    writer.close()
@@ -1,5 +1,8 @@
 # doesn't need to be an object
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import os.path
+import threading
 
 import SciAnalysis.config as config
 _ROOTDIR = config.resultsroot
@@ -95,7 +98,70 @@ def _make_fname_from_attrs(attrs):
     return outfile
 
 
-def store_results_xml(results, outputs=None):
+# locks of the xml files (and their journal and index), by file name
+_xml_locks = dict()
+_xml_locks_lock = threading.Lock()
+# the xml files journaled to by this process, compacted at exit
+_journaled = set()
+# the xml files queued for compaction
+_compacting = set()
+_compactor = None
+
+
+def _xml_lock(outfile):
+    ''' Get the lock of an xml file.'''
+    with _xml_locks_lock:
+        if outfile not in _xml_locks:
+            _xml_locks[outfile] = threading.Lock()
+        return _xml_locks[outfile]
+
+
+def _journal_fname(outfile):
+    return outfile + ".journal"
+
+
+def _index_fname(outfile):
+    return outfile + ".index"
+
+
+def _make_protocol(results, outputs=None):
+    ''' Make the protocol element of the results.'''
+    from lxml import etree
+    import numpy as np
+    results_dict = results['kwargs']
+    attrs = results['attributes']
+
+    # TODO : instead of parsing (changing to str), walk through all elements in
+    # tree of dicts
+    attrs_parsed = parse_attrs_xml(attrs)
+    prot = etree.Element('protocol', **attrs_parsed)
+
+    # Saving to xml
+    if outputs is not None:
+        for output in outputs:
+            name = output
+            content = results_dict[name]
+            if name[0] == '_':
+                continue  # ignore hidden variables, like _start etc
+
+            if isinstance(content, dict):
+                content = dict([k, str(v)] for k, v in content.items())
+                etree.SubElement(prot, 'result', name=name, **content)
+
+            elif isinstance(content, list) or isinstance(content, np.ndarray):
+
+                res = etree.SubElement(prot, 'result', name=name, type='list')
+                for i, element in enumerate(content):
+                    etree.SubElement(res, 'element', index=str(i),
+                                     value=str(element))
+
+            else:
+                etree.SubElement(prot, 'result', name=name, value=str(content))
+    return prot
+
+
+def store_results_xml(results, outputs=None, journal=False,
+                      compact_size=None):
     '''
         Store the results from the corresponding protocol.
 
@@ -107,13 +173,20 @@ def store_results_xml(results, outputs=None):
         expects a experiment_cycle, experiment group and sample_savename
         path is ROOT/experiment_cycle/experiment_group/sample_savename.xml
 
+        journal : bool, optional
+            if True, the protocol is appended to a journal next to the xml
+            file (<file>.journal), rather than rewriting the whole xml file.
+            Journals are merged into the xml file by compact_xml: at exit,
+            or in the background once larger than compact_size bytes.
+
+        compact_size : int, optional
+            the journal size (in bytes) above which it's compacted
     '''
     # TODO : maybe add date folder too?
     # TODO : add detector as well?
     if 'kwargs' not in results:
         raise ValueError("kwargs not in the sciresults. " +
                          "(Is this a valid SciResult object?)")
-    results_dict = results['kwargs']
     if 'attributes' not in results:
         raise ValueError("attributes not in the sciresults. " +
                          "(Is this a valid SciResult object?)")
@@ -121,78 +194,229 @@ def store_results_xml(results, outputs=None):
     attrs = results['attributes']
     outfile = _make_fname_from_attrs(attrs)
 
-    from lxml import etree
     # just add to the sciresults so user knows it's been saved to xml
     results['attributes']['xml-outfile'] = outfile
 
+    prot = _make_protocol(results, outputs=outputs)
+    if journal:
+        size = _append_journal(outfile, prot)
+        _journaled.add(outfile)
+        if compact_size is not None and size > compact_size:
+            _queue_compaction(outfile)
+    else:
+        with _xml_lock(outfile):
+            root = _read_datafile(outfile, protocols=[prot])
+            _write_datafile(outfile, root)
+
+
+def _index_entry(prot, source, offset, length):
+    end_timestamp = prot.get('end_timestamp')
+    if end_timestamp is not None:
+        end_timestamp = float(end_timestamp)
+    return [prot.get('name'), end_timestamp, source, offset, length]
+
+
+def _append_journal(outfile, prot):
+    ''' Append a protocol to the journal of outfile, and to its index.
+
+        Each protocol is one line of the journal. Returns the journal size.
+        An xml file without an index (written before indexes) is compacted
+        first, so that the index lists its protocols too.
+    '''
+    from lxml import etree
+    import json
+    fragment = etree.tostring(prot) + b"\n"
+    with _xml_lock(outfile):
+        if os.path.isfile(outfile) and \
+                not os.path.isfile(_index_fname(outfile)):
+            _write_datafile(outfile, _read_datafile(outfile))
+        with open(_journal_fname(outfile), "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(fragment)
+        entry = _index_entry(prot, "journal", offset, len(fragment))
+        with open(_index_fname(outfile), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+    return offset + len(fragment)
+
+
+def _read_journal(outfile):
+    ''' Read the protocols of the journal of outfile.'''
+    from lxml import etree
+    journal = _journal_fname(outfile)
+    protocols = list()
+    if not os.path.isfile(journal):
+        return protocols
+    with open(journal, "rb") as f:
+        for line in f:
+            try:
+                protocols.append(etree.fromstring(line))
+            except etree.XMLSyntaxError:
+                # likely an interrupted write
+                print("xml : Warning, skipping a bad journal entry in " +
+                      "{}".format(journal))
+    return protocols
+
+
+def _read_datafile(outfile, protocols=[]):
+    ''' Read the DataFile of outfile, with the protocols of its journal (and
+        protocols appended).'''
+    from lxml import etree
     if os.path.isfile(outfile):
         # Result XML file already exists
         parser = etree.XMLParser(remove_blank_text=True)
         root = etree.parse(outfile, parser).getroot()
     else:
-        # Create new XML file
+        root = etree.Element('DataFile')
+    for prot in _read_journal(outfile) + list(protocols):
+        root.append(prot)
+    if root.get('name') is None:
         # TODO: Add characteristics of outfile
-        if 'sample_savename' in attrs:
-            sample_savename = attrs['sample_savename']
-        else:
-            sample_savename = "No sample savename"
-        root = etree.Element('DataFile', name=sample_savename)
+        sample_savename = "No sample savename"
+        if len(root) and root[0].get('sample_savename') is not None:
+            sample_savename = root[0].get('sample_savename')
+        root.set('name', sample_savename)
+    return root
 
-    # TODO : instead of parsing (changing to str), walk through all elements in
-    # tree of dicts
-    attrs_parsed = parse_attrs_xml(attrs)
-    prot = etree.SubElement(root, 'protocol', **attrs_parsed)
 
-    # Saving to xml
-    if outputs is not None:
-        for output in outputs:
-            name = output
-            content = results_dict[name]
-            if name[0] == '_':
-                continue  # ignore hidden variables, like _start etc
-            import numpy as np
+def _write_datafile(outfile, root):
+    ''' Write the DataFile root to outfile, and its index. This replaces the
+        journal.
 
-            if isinstance(content, dict):
-                content = dict([k, str(v)] for k, v in content.items())
-                etree.SubElement(prot, 'result', name=name, **content)
+        Files are written to temporary files, then renamed. Call with the
+        lock of outfile held.
+    '''
+    from lxml import etree
+    import json
+    # the opening and closing tags of the root
+    empty = etree.Element(root.tag, root.attrib)
+    empty.text = "\n"
+    head, tail = etree.tostring(empty).rsplit(b"</", 1)
+
+    index = list()
+    tmpfile = outfile + ".tmp"
+    with open(tmpfile, "wb") as f:
+        f.write(head)
+        for prot in root:
+            fragment = etree.tostring(prot, pretty_print=True,
+                                      with_tail=False)
+            if prot.tag == 'protocol':
+                index.append(_index_entry(prot, "xml", f.tell(),
+                                          len(fragment)))
+            f.write(fragment)
+        f.write(b"</" + tail + b"\n")
+    with open(_index_fname(outfile) + ".tmp", "w") as f:
+        for entry in index:
+            f.write(json.dumps(entry) + "\n")
+
+    os.replace(tmpfile, outfile)
+    os.replace(_index_fname(outfile) + ".tmp", _index_fname(outfile))
+    # an interruption here leaves protocols both in the xml file and the
+    # journal (duplicated), rather than losing them
+    if os.path.isfile(_journal_fname(outfile)):
+        os.remove(_journal_fname(outfile))
+
+
+def compact_xml(outfile):
+    ''' Merge the journal of an xml file into it (see store_results_xml).
+
+        The whole file is rewritten once, with an index of the offsets of the
+        protocols.
+    '''
+    _compacting.discard(outfile)
+    with _xml_lock(outfile):
+        if os.path.isfile(_journal_fname(outfile)) or \
+                not os.path.isfile(_index_fname(outfile)):
+            _write_datafile(outfile, _read_datafile(outfile))
+    _journaled.discard(outfile)
+    return outfile
 
-            elif isinstance(content, list) or isinstance(content, np.ndarray):
 
-                res = etree.SubElement(prot, 'result', name=name, type='list')
-                for i, element in enumerate(content):
-                    etree.SubElement(res, 'element', index=str(i),
-                                     value=str(element))
+def _queue_compaction(outfile):
+    ''' Compact outfile in the background.'''
+    global _compactor
+    if outfile in _compacting:
+        return
+    if _compactor is None:
+        _compactor = ThreadPoolExecutor(max_workers=1)
+    _compacting.add(outfile)
+    _compactor.submit(compact_xml, outfile)
 
-            else:
-                etree.SubElement(prot, 'result', name=name, value=str(content))
 
-    tree = etree.ElementTree(root)
-    tree.write(outfile, pretty_print=True)
+@atexit.register
+def compact_xml_journals():
+    ''' Wait for the background compactions, then compact the journals written
+        to by this process.'''
+    global _compactor
+    if _compactor is not None:
+        _compactor.shutdown()
+        _compactor = None
+    for outfile in list(_journaled):
+        compact_xml(outfile)
+
+
+def _find_protocol(infile, protocol):
+    ''' Find the latest protocol element from the index of infile.
+
+        Returns None when there's no (usable) index.
+    '''
+    from lxml import etree
+    import json
+    indexfile = _index_fname(infile)
+    if not os.path.isfile(indexfile):
+        return None
+    with _xml_lock(infile):
+        latest = None
+        with open(indexfile) as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry[0] != protocol:
+                    continue
+                # later entries win ties (the journal is after the xml file)
+                if latest is None or \
+                        (entry[1] or 0) >= (latest[1] or 0):
+                    latest = entry
+        if latest is None:
+            return None
+        name, end_timestamp, source, offset, length = latest
+        fname = infile if source == "xml" else _journal_fname(infile)
+        try:
+            with open(fname, "rb") as f:
+                f.seek(offset)
+                element = etree.fromstring(f.read(length))
+        except (OSError, etree.XMLSyntaxError):
+            element = None
+    if element is None or element.tag != 'protocol' or \
+            element.get('name') != protocol:
+        print("xml : Warning, stale index {}, ignoring".format(indexfile))
+        return None
+    return element
 
 
 def get_result(infile, protocol):
     '''Extracts a list of results for the given protocol, from the specified
-    xml file. The most recent run of the protocol is used.'''
-    # NOTE : Not tested yet
+    xml file. The most recent run of the protocol is used.
+
+    If the file has an index (see store_results_xml), only the protocol is
+    read, else the whole file (and its journal) is parsed.'''
     import numpy as np
-    from lxml import etree
 
-    parser = etree.XMLParser(remove_blank_text=True)
-    root = etree.parse(infile, parser).getroot()
+    protocol_element = _find_protocol(infile, protocol)
+    if protocol_element is None:
+        root = _read_datafile(infile)
 
-    # Get the latest protocol
-    element = root
-    children = [child for child in element
-                if child.tag == 'protocol' and child.get('name') == protocol]
-    children_v = [float(child.get('end_timestamp'))
-                  for child in element
-                  if child.tag == 'protocol' and child.get('name') == protocol]
+        # Get the latest protocol
+        element = root
+        children = [child for child in element
+                    if child.tag == 'protocol' and
+                    child.get('name') == protocol]
+        children_v = [float(child.get('end_timestamp'))
+                      for child in children]
 
-    idx = np.argmax(children_v)
-    protocol = children[idx]
+        idx = np.argmax(children_v)
+        protocol_element = children[idx]
 
     # In this protocol, get all the results (in order)
-    element = protocol
+    element = protocol_element
     children = [child for child in element if child.tag == 'result']
     children_v = [child.get('name')
                   for child in element if child.tag == 'result']
@@ -0,0 +1,243 @@
+''' Reprocess the scans of a time range, in parallel.
+
+    The headers of the range are grouped into independent units (stitch
+    groups, see stitch_groups), which are processed by worker processes.
+    A range starting in the middle of a stitch group is extended back to
+    the start of the group.
+    Each worker imports run_stream_live, so it has its own pipeline
+    instance.
+
+    >>> summary = run_backfill(start_time, stop_time, workers=8)
+'''
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import time
+
+from SciAnalysis.interfaces.databroker import databroker as source_databroker
+
+
+def stitch_groups(headers):
+    ''' Group headers into independent units.
+
+        A scan stitched back (stitchback is True) is stitched to the previous
+        scans, so a group is a scan which isn't stitched back followed by the
+        consecutive scans which are.
+
+        headers : headers (or start documents), oldest first
+
+        Returns a list of lists of uids
+
+        Notes
+        -----
+        If the first header is stitched back, the scans it's stitched to
+        aren't in headers, so its group is stitched from the middle of the
+        series (a warning is printed). See extend_back.
+    '''
+    groups = list()
+    for header in headers:
+        start = _start(header)
+        if start.get('stitchback', False) is not True or not groups:
+            if not groups and start.get('stitchback', False) is True:
+                print("Backfill : Warning, {} is ".format(start['uid']) +
+                      "stitched back to scans before the range, its "
+                      "stitch group starts in the middle")
+            groups.append(list())
+        groups[-1].append(start['uid'])
+    return groups
+
+
+def _start(header):
+    return header['start'] if 'start' in header else header
+
+
+def extend_back(db, headers, lookback=24*3600):
+    ''' Add the headers before headers (oldest first) which are in the
+        stitch group of the first one, so that it isn't stitched from the
+        middle. They're looked for at most lookback seconds earlier.
+
+        Returns the headers, oldest first.
+    '''
+    if not headers or _start(headers[0]).get('stitchback', False) \
+            is not True:
+        return headers
+    stop_time = _start(headers[0])['time']
+    earlier = db(start_time=stop_time - lookback, stop_time=stop_time)
+    uids = set(_start(header)['uid'] for header in headers)
+    earlier = sorted((header for header in earlier
+                      if _start(header)['uid'] not in uids),
+                     key=source_databroker._header_key)
+    # back to the last scan which isn't stitched back
+    for i in range(len(earlier) - 1, -1, -1):
+        if _start(earlier[i]).get('stitchback', False) is not True:
+            return earlier[i:] + headers
+    return headers
+
+
+def _flush_outputs():
+    ''' Wait for the background writes of the pipeline (the worker processes
+        don't run the atexit functions).'''
+    from SciAnalysis.interfaces.file import file as source_file
+    from SciAnalysis.interfaces.plotting_mpl import plotting_mpl
+    from SciAnalysis.interfaces.xml import xml as source_xml
+    if source_file._file_write_queue is not None:
+        source_file._file_write_queue.flush()
+    if plotting_mpl._render_pool is not None:
+        plotting_mpl._render_pool.flush()
+    source_xml.compact_xml_journals()
+
+
+def _output_errors():
+    ''' The (file name, error) of the writes and plots which failed since
+        the last call (the error lists of the queues are emptied), and the
+        number of results the databroker writers failed to save.'''
+    from SciAnalysis.interfaces.file import file as source_file
+    from SciAnalysis.interfaces.plotting_mpl import plotting_mpl
+    errors = list()
+    for queue in (source_file._file_write_queue, plotting_mpl._render_pool):
+        if queue is not None:
+            errors.extend((outfile, repr(e)) for outfile, e in queue.errors)
+            del queue.errors[:]
+    nfailed = 0
+    for writer in source_databroker._databroker_writers.values():
+        writer.flush()
+        nfailed += writer.nfailed
+        writer.nfailed = 0
+    return errors, nfailed
+
+
+def _init_worker(result_store):
+    ''' Use the result store of dirname result_store (if not None).'''
+    if result_store is not None:
+        from SciAnalysis.interfaces.streams import set_result_store
+        from SciAnalysis.interfaces.resultstore import ResultStore
+        set_result_store(ResultStore(result_store))
+
+
+def process_group(dbname, uids):
+    ''' Process a group of uids through the pipeline (in a worker).
+
+        Returns the (number of scans processed, list of (uid, error) of the
+        scans that failed, result store hits and misses per stream).
+
+        Scans fail if the pipeline raises, or if a function of the pipeline
+        failed on them (see StreamDoc.failure_log). The outputs which
+        couldn't be written are failures too, as (file name, error) (or
+        ("databroker", error)).
+    '''
+    # the pipeline is made when imported, once per worker
+    from SciAnalysis.startup import run_stream_live
+    from SciAnalysis.interfaces import streams
+    from SciAnalysis.interfaces.StreamDoc import failure_log
+    failure_log.clear()
+    failures = list()
+    found = set()
+    nprocessed = 0
+    fields = [run_stream_live.detector_key]
+    for sdoc in source_databroker.pullfromuids(dbname, uids,
+                                               read_ahead_depth=2,
+                                               read_ahead_fields=fields):
+        uid = sdoc['attributes'].get('uid')
+        found.add(uid)
+        try:
+            run_stream_live.sin_sdoc.emit(sdoc)
+            nprocessed += 1
+        except Exception as e:
+            failures.append((uid, repr(e)))
+    failures.extend((uid, "not found") for uid in uids if uid not in found)
+    run_stream_live.flush_pipeline()
+    _flush_outputs()
+    # the first failure of each scan (later ones usually follow from it)
+    failed = set(uid for uid, error in failures)
+    for uid, funcname, error in list(failure_log):
+        if uid not in failed:
+            failed.add(uid)
+            failures.append((uid, "{} : {}".format(funcname, error)))
+            if uid in found:
+                nprocessed -= 1
+    errors, nfailed = _output_errors()
+    failures.extend(errors)
+    if nfailed:
+        failures.append(("databroker", "{} results not saved".format(nfailed)))
+    stats = dict()
+    if streams._result_store is not None:
+        stats = dict(streams._result_store.stats)
+        streams._result_store.stats.clear()
+    return nprocessed, failures, stats
+
+
+def run_backfill(start_time, stop_time, dbname="cms:data", workers=4,
+                 result_store=None, headers=None, process=process_group,
+                 mp_context="spawn"):
+    ''' Reprocess the scans from start_time to stop_time (timestamps).
+
+        Stitch groups are processed in parallel, by workers processes.
+        Progress is printed as groups are done.
+
+        result_store : the directory of a result store (see resultstore.py)
+            used by the workers
+        headers : the headers to process (default, the headers of the time
+            range in dbname, extended back to the start of the first stitch
+            group, see extend_back)
+        process : the function processing a group, process(dbname, uids)
+
+        Returns a summary dict: the number of groups, scans, scans processed,
+        elapsed time, throughput (scans/s), the (uid, error) failures and the
+        result store [hits, misses] per stream.
+    '''
+    if workers < 1:
+        raise ValueError("Need at least one worker")
+    if headers is None:
+        from SciAnalysis.interfaces.databroker.databases import databases
+        db = databases[dbname]
+        headers = db(start_time=start_time, stop_time=stop_time)
+        headers = sorted(headers, key=source_databroker._header_key)
+        headers = extend_back(db, headers)
+    headers = sorted(headers, key=source_databroker._header_key)
+    groups = stitch_groups(headers)
+    nscans = sum(len(group) for group in groups)
+    print("Backfill : {} scans in {} groups, ".format(nscans, len(groups)) +
+          "{} workers".format(workers))
+
+    t0 = time.time()
+    nprocessed = 0
+    ndone = 0
+    failures = list()
+    stats = dict()
+    context = multiprocessing.get_context(mp_context)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=_init_worker,
+                             initargs=(result_store,)) as executor:
+        futures = {executor.submit(process, dbname, group): group
+                   for group in groups}
+        for future in as_completed(futures):
+            group = futures[future]
+            try:
+                nproc, group_failures, group_stats = future.result()
+            except Exception as e:
+                # the worker died
+                nproc, group_stats = 0, dict()
+                group_failures = [(uid, repr(e)) for uid in group]
+            nprocessed += nproc
+            failures.extend(group_failures)
+            for name, (hits, misses) in group_stats.items():
+                total = stats.setdefault(name, [0, 0])
+                total[0] += hits
+                total[1] += misses
+            ndone += len(group)
+            elapsed = time.time() - t0
+            print("Backfill : {}/{} scans, ".format(ndone, nscans) +
+                  "{:.2f} scans/s, ".format(ndone/max(elapsed, 1e-9)) +
+                  "{} failed".format(len(failures)))
+
+    elapsed = time.time() - t0
+    summary = dict(groups=len(groups), scans=nscans, processed=nprocessed,
+                   failed=len(failures), failures=failures, elapsed=elapsed,
+                   throughput=nscans/max(elapsed, 1e-9), stats=stats)
+    print("Backfill done : {processed}/{scans} scans processed in "
+          "{elapsed:.1f} s ({throughput:.2f} scans/s), "
+          "{failed} failed".format(**summary))
+    for uid, error in failures:
+        print("    {} : {}".format(uid, error))
+    for name, (hits, misses) in stats.items():
+        print("    {} : {} reused, {} computed".format(name, hits, misses))
+    return summary
@@ -1,7 +1,6 @@
 # test a XS run
-import time
-from time import sleep
 import os
+from functools import partial
 import numpy as np
 import matplotlib
 matplotlib.use("Agg")  # noqa
@@ -22,15 +21,16 @@ from SciAnalysis.interfaces.xml import xml as source_xml
 # Streams include stuff
 from SciAnalysis.interfaces.StreamDoc import StreamDoc, Arguments
 from SciAnalysis.interfaces.streams import Stream
+from SciAnalysis.interfaces.memory import ManagedDeque  # noqa
 # Analyses
 from SciAnalysis.analyses.XSAnalysis.Data import \
         MasterMask, MaskGenerator, Obstruction
 from SciAnalysis.analyses.XSAnalysis.Streams import CalibrationStream,\
     CircularAverageStream, ImageStitchingStream, ThumbStream, QPHIMapStream
+from SciAnalysis.analyses.XSAnalysis.Streams import stitch_group_key  # noqa
+from SciAnalysis.analyses.XSAnalysis.Streams import close_stitch  # noqa
 # from SciAnalysis.analyses.XSAnalysis.CustomStreams import SqFitStream
 
-# get databases (not necessary)
-from SciAnalysis.interfaces.databroker.databases import databases
 detector_key = "pilatus300_image"
 
 
@@ -213,10 +213,13 @@ globaldict = dict()
 
 # Stream setup, datbroker data comes here (a string uid)
 sin = Stream()
+# or already assembled StreamDocs come here (from a document stream)
+sin_sdoc = Stream()
 # TODO : run asynchronously?
 
 s_event = sin\
-        .map(source_databroker.pullfromuid, dbname='cms:data', raw=True)
+        .map(source_databroker.pullfromuid, dbname='cms:data', raw=True)\
+        .union(sin_sdoc)
 
 s_event = s_event.map((check_stitchback), raw=True)
 
@@ -273,19 +276,24 @@ exposure_mask = exposure_mask\
 
 exposure_mask = exposure_mask.select((0, 'mask'))
 
-sin_imgstitch, sout_imgstitch = ImageStitchingStream(return_intermediate=True)
+img_masked = image\
+        .merge(mask_stream.select(('mask', None))).map(lambda a, b: a*b)
+img_mask_origin = img_masked.select((0, 'image'))\
+        .merge(exposure_mask.select(('mask', 'mask')),
+               origin.select((0, 'origin')), stitch)
+
+# a replica per stitch group, the groups are stitched in parallel. A group
+# is closed (its stitch emitted) when the next one starts, or on flush.
+sout_imgstitch = img_mask_origin\
+        .partition_by(stitch_group_key, 4,
+                      partial(ImageStitchingStream, return_intermediate=True),
+                      close=close_stitch)
 
 sout_imgstitch_log = sout_imgstitch.select(('image', None))\
         .map(safelog10).select((0, 'image'))
 sout_imgstitch_log = sout_imgstitch_log\
         .map((add_attributes), stream_name="ImgStitchLog", raw=True)
 
-img_masked = image\
-        .merge(mask_stream.select(('mask', None))).map(lambda a, b: a*b)
-img_mask_origin = img_masked.select((0, 'image'))\
-        .merge(exposure_mask.select(('mask', 'mask')),
-               origin.select((0, 'origin')), stitch)
-img_mask_origin.map(sin_imgstitch.emit, raw=True)
 
 sin_thumb, sout_thumb = ThumbStream(blur=1, resize=2)
 image.map(sin_thumb.emit, raw=True)
@@ -309,56 +317,61 @@ image.merge(mask_stream, origin.select((0, 'origin')))\
 
 
 # save to plots
-resultsqueue = deque(maxlen=1000)
+# resultsqueue keeps the results (or futures) of the outputs. They hold no
+# arrays (a future's data is on the dask workers), so it's bounded by maxlen
+# only, not by the memory manager
+resultsqueue = ManagedDeque(maxlen=1000, stream_name="resultsqueue")
 sout_circavg.map((source_plotting.store_results),
                  lines=[('sqx', 'sqy')],
                  scale='loglog', xlabel="$q\,(\mathrm{\AA}^{-1})$",
-                 ylabel="I(q)", raw=True)\
+                 ylabel="I(q)", background=True, raw=True)\
         .map(client.compute, raw=True).map(resultsqueue.append, raw=True)
 sout_imgstitch\
-        .map((source_plotting.store_results),
-             images=['image'], hideaxes=True,
-             raw=True)\
+        .map((source_plotting.store_results_image),
+             images=['image'], raw=True)\
         .map(client.compute, raw=True).map(resultsqueue.append, raw=True)
 
 sout_imgstitch_log\
-        .map((source_plotting.store_results), images=['image'],
-             hideaxes=True, raw=True)\
+        .map((source_plotting.store_results_image), images=['image'],
+             raw=True)\
         .map(client.compute, raw=True)\
         .map(resultsqueue.append, raw=True)
 sout_thumb\
-        .map((source_plotting.store_results), images=['thumb'],
-             hideaxes=True, raw=True)\
+        .map((source_plotting.store_results_image), images=['thumb'],
+             raw=True)\
         .map(client.compute, raw=True)\
         .map(resultsqueue.append, raw=True)
 sout_thumb.select(('thumb', None)).map(safelog10).select((0, 'thumb'))\
         .map((add_attributes), stream_name="ThumbLog", raw=True)\
-        .map((source_plotting.store_results), images=['thumb'],
-             hideaxes=True, raw=True)\
+        .map((source_plotting.store_results_image), images=['thumb'],
+             raw=True)\
         .map(client.compute, raw=True).map(resultsqueue.append, raw=True)
 
-sqphi_out.map(source_plotting.store_results, raw=True,
+sqphi_out.map(source_plotting.store_results, background=True, raw=True,
               images=['sqphi'], xlabel="$\phi$",
               ylabel="$q$", vmin=0, vmax=100)\
         .map(resultsqueue.append, raw=True)
 sout_img_pca\
         .map(source_plotting.store_results,
-             images=['components'], raw=True)\
+             images=['components'], background=True, raw=True)\
         .map(client.compute, raw=True)\
         .map(resultsqueue.append, raw=True)
 
 # save to file system
 sout_thumb\
         .map((source_file.store_results_file),
-             {'writer': 'npy', 'keys': ['thumb']}, raw=True)\
+             {'writer': 'npy', 'keys': ['thumb']}, background=True,
+             raw=True)\
         .map(client.compute, raw=True).map(resultsqueue.append, raw=True)
 sout_circavg\
         .map((source_file.store_results_file),
-             {'writer': 'npy', 'keys': ['sqx', 'sqy']}, raw=True)\
+             {'writer': 'npy', 'keys': ['sqx', 'sqy']}, background=True,
+             raw=True)\
         .map(client.compute).map(resultsqueue.append, raw=True)
 
 # save to xml
-sout_circavg.map((source_xml.store_results_xml), outputs=None, raw=True)\
+sout_circavg.map((source_xml.store_results_xml), outputs=None,
+                 journal=True, compact_size=2**20, raw=True)\
         .map(client.compute).map(resultsqueue.append, raw=True)
 
 # TODO : make databroker not save numpy arrays by default i flonger than a
@@ -377,45 +390,92 @@ sout_circavg.map((source_xml.store_results_xml), outputs=None, raw=True)\
 
 # Emitting data
 
+def _emit_sdoc(sdoc):
+    ''' Emit a StreamDoc into the pipeline, reporting errors.'''
+    uid = sdoc['attributes'].get('uid')
+    print("Loading task for uid : {}".format(uid))
+    try:
+        sin_sdoc.emit(sdoc)
+    except KeyError:
+        print("Got a keyerror (no image likely), ignoring")
+    except ValueError as e:
+        print("got ValueError: {}".format(e))
+    except FileNotFoundError:
+        print("File not found error for uid : {}".format(uid))
+    except AttributeError:
+        print("Attribute Error (probably the " +
+              "metadata is slightly different)")
+
+
+def flush_pipeline():
+    ''' Wait for the elements being processed in threads (the stitches),
+        the last stitch group is closed.'''
+    sout_imgstitch.flush()
+
+
+def start_run_zmq(address, prefix=b'', dbname="cms:data"):
+    ''' Start a live run of the pipeline, fed by a RunEngine document
+        stream over 0MQ.
+
+        Each run is processed as soon as its stop document is received
+        (no polling of databroker).
+
+        address : the address of the 0MQ proxy out port
+            (for ex: "tcp://localhost:5578")
+        prefix : only process messages with this prefix
+        dbname : the database the external data is registered in
+    '''
+    from SciAnalysis.interfaces.databroker.documents \
+        import DocumentListener
+    listener = DocumentListener(address, _emit_sdoc, prefix=prefix,
+                                dbname=dbname)
+    print("Listening for documents on {}".format(address))
+    try:
+        listener.run()
+    finally:
+        listener.close()
+
+
 def start_run(start_time, dbname="cms:data",
-              noqbins=None):
-    ''' Start a live run of pipeline.'''
-
-    last_uid = None
-    cddb = databases[dbname]
-    while True:
-        hdrs = cddb(start_time=start_time)
-        # need to reverse the headers in the correct order
-        hdrs = list(hdrs)
-        hdrs.reverse()
-
-        for hdr in hdrs:
-            uid = hdr['start']['uid']
-
-            # always skip the last uid
-            if uid == last_uid:
-                continue
-
-            print("Loading task for uid : {}".format(uid))
-
-            try:
-                sin.emit(uid)
-                sleep(.1)
-            except KeyError:
-                print("Got a keyerror (no image likely), ignoring")
-            except ValueError as e:
-                print("got ValueError: {}".format(e))
-            except FileNotFoundError:
-                print("File not found error for uid : {}".format(uid))
-            except AttributeError:
-                print("Attribute Error (probably the " +
-                      "metadata is slightly different)")
-
-        # get the latest time, add 1 second to not overlap it
-        last_uid = hdr['start']['uid']
-        last_time = hdr['start']['time']
-        t1 = time.localtime(last_time)
-        start_time = time.strftime("%Y-%m-%d %H:%M:%S", t1)
-        # at the end, update time stamp for latest time
-        print("Reached end, waiting 1 sec for more data...")
-        sleep(1)
+              noqbins=None, page_size=100, read_ahead_depth=4,
+              checkpoint_dir=None, checkpoint_every=10):
+    ''' Start a live run of pipeline.
+
+        Headers from start_time on are processed in order, a page at a time
+        (catch-up), then new headers are polled for every second.
+
+        The next read_ahead_depth headers and their images are loaded in the
+        background while the pipeline runs on the current one (0 to load
+        them only when needed).
+
+        checkpoint_dir : if not None, the state of the pipeline (stitches,
+            partitions) is saved there every checkpoint_every scans (see
+            checkpoint.py). If it has a checkpoint, the state is restored and
+            the run resumes after the last scan processed (start_time is
+            ignored).
+    '''
+    checkpointer = None
+    seen = ()
+    if checkpoint_dir is not None:
+        from SciAnalysis.interfaces.checkpoint import Checkpointer
+        checkpointer = Checkpointer(checkpoint_dir, [sin, sin_sdoc],
+                                    every=checkpoint_every)
+        last = checkpointer.restore()
+        if last is not None and last['time'] is not None:
+            start_time = last['time']
+            seen = [last['uid']]
+    cursor = source_databroker.HeaderCursor(dbname, start_time=start_time,
+                                            page_size=page_size, seen=seen)
+    try:
+        # only the images are read ahead, other fields are read when used
+        for sdoc in cursor.sdocs(wait=1, read_ahead_depth=read_ahead_depth,
+                                 read_ahead_fields=[detector_key]):
+            if checkpointer is not None:
+                checkpointer.started(sdoc)
+            _emit_sdoc(sdoc)
+            if checkpointer is not None:
+                checkpointer.processed(sdoc)
+    finally:
+        # saved only between elements
+        if checkpointer is not None:
+            checkpointer.close()
@@ -45,3 +45,55 @@ def test_stream_accumulate():
     sout.emit(StreamDoc(args=[3]))
 
     print(L)
+
+
+def test_stream_map_lazy():
+    ''' Lazy values are loaded only by the functions that use them.'''
+    from SciAnalysis.interfaces.StreamDoc import LazyValue
+    from dask.base import tokenize
+
+    loaded = list()
+
+    class LazyImage(LazyValue):
+        def __init__(self, name):
+            self.name = name
+
+        def load(self):
+            loaded.append(self.name)
+            return 10
+
+        def token(self):
+            return self.name
+
+    s = Stream()
+    L = list()
+    s.map(lambda x: x['attributes'], raw=True).map(L.append, raw=True)
+    s.select(('image', None)).map(lambda image: image + 1)\
+        .map(lambda x: x.get_return(), raw=True).map(L.append, raw=True)
+
+    sdoc = StreamDoc(kwargs=dict(image=LazyImage("a")),
+                     attributes=dict(name="john"))
+    s.emit(sdoc)
+    assert L == [dict(name="john"), 11]
+    assert loaded == ["a"]
+
+    # tokenizing does not load the value
+    tokenize(sdoc)
+    assert loaded == ["a"]
+    assert tokenize(sdoc) != tokenize(StreamDoc(kwargs=dict(
+        image=LazyImage("b"))))
+
+
+def test_failure_log():
+    ''' Failures are kept in the statistics, and logged with the uid.'''
+    from SciAnalysis.interfaces.StreamDoc import failure_log
+
+    def badfunc(arg):
+        raise ValueError("bad arg")
+
+    s = Stream()
+    L = s.map(badfunc).sink_to_list()
+    failure_log.clear()
+    s.emit(StreamDoc(args=[1], attributes=dict(uid="abc")))
+    assert L[0]['statistics']['status'] == "Failure"
+    assert list(failure_log) == [("abc", "badfunc", "bad arg")]
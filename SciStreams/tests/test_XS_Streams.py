@@ -2,6 +2,9 @@
 from SciAnalysis.interfaces.StreamDoc import StreamDoc
 from SciAnalysis.analyses.XSAnalysis.Streams import ImageStitchingStream,\
     CalibrationStream, CircularAverageStream
+from SciAnalysis.analyses.XSAnalysis.Streams import stitch_group_key, \
+    close_stitch
+from SciAnalysis.interfaces.streams import Stream
 
 from SciAnalysis.analyses.XSAnalysis.tools import roundbydigits
 
@@ -150,6 +153,49 @@ def test_ImageStitch():
                                                        2., 2., 1., 1., 1., 1.,
                                                        1., 1.]))
 
+def test_ImageStitch_partition_by():
+    ''' test stitch groups stitched in parallel replicas, like in one
+        stream.'''
+    sin = Stream()
+    sout = sin.partition_by(stitch_group_key, 2, ImageStitchingStream,
+                            close=close_stitch)
+    L = sout.sink_to_list()
+    # the stitches of one stream (the last one triggered by a scan)
+    sin1, sout1 = ImageStitchingStream()
+    L1 = sout1.sink_to_list()
+
+    mask = np.ones((10, 10))
+    img = np.ones_like(mask, dtype=float)
+    img[2:4] = 2
+    # (origin, stitchback) of the scans: a group of 3, 1, then 2
+    scans = [([2, 3], False), ([4, 3], True), ([6, 3], True),
+             ([2, 10], False),
+             ([2, 3], False), ([2, 7], True)]
+    sdocs = [StreamDoc(kwargs=dict(mask=mask, image=np.roll(img, i, axis=0),
+                                   origin=origin, stitchback=stitchback),
+                       attributes=dict(uid="uid{}".format(i)))
+             for i, (origin, stitchback) in enumerate(scans)]
+    for sdoc in sdocs:
+        sin.emit(sdoc)
+        sin1.emit(sdoc)
+    sin1.emit(close_stitch(sdocs[-1]))
+    assert len(L1) == 2
+
+    # wait, without closing the last group
+    sout.flush(close=False)
+    # the first stitch is complete
+    assert len(L) == 1
+    assert list(sout.replicas) == ["uid4"]
+
+    # the last group is closed
+    sout.flush()
+    assert len(L) == 2
+    for sdoc, sdoc1 in zip(L, L1):
+        assert_array_equal(sdoc['kwargs']['image'], sdoc1['kwargs']['image'])
+        assert_array_equal(sdoc['kwargs']['mask'], sdoc1['kwargs']['mask'])
+    assert sout.replicas == dict()
+
+
 def test_roundbydigits():
     '''test the round by digits function.'''
     res = roundbydigits(123.421421, digits=6)
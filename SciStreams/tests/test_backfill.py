@@ -0,0 +1,57 @@
+# test the parallel reprocessing of a time range
+from SciAnalysis.startup.backfill import stitch_groups, run_backfill, \
+    extend_back
+
+
+def _make_starts():
+    stitchbacks = [False, True, True, False, False, True, True]
+    return [dict(uid="uid{}".format(i), time=float(i), stitchback=stitchback)
+            for i, stitchback in enumerate(stitchbacks)]
+
+
+def test_stitch_groups():
+    starts = _make_starts()
+    assert stitch_groups(starts) == [["uid0", "uid1", "uid2"], ["uid3"],
+                                     ["uid4", "uid5", "uid6"]]
+    # a group can start stitched back (the start of the range)
+    assert stitch_groups(starts[1:3]) == [["uid1", "uid2"]]
+
+
+class _FakeDB:
+    def __init__(self, headers):
+        self.headers = headers
+
+    def __call__(self, start_time=None, stop_time=None):
+        return [header for header in self.headers[::-1]
+                if start_time <= header['start']['time'] < stop_time]
+
+
+def test_extend_back():
+    headers = [dict(start=start) for start in _make_starts()]
+    db = _FakeDB(headers)
+    # from the middle of the last group, back to its start
+    res = extend_back(db, headers[5:])
+    assert [h['start']['uid'] for h in res] == ["uid4", "uid5", "uid6"]
+    assert extend_back(db, headers[3:]) == headers[3:]
+    # not found within lookback
+    assert extend_back(db, headers[5:], lookback=.5) == headers[5:]
+
+
+def _process(dbname, uids):
+    if "uid3" in uids:
+        raise RuntimeError("crashed")
+    failures = [(uid, "bad") for uid in uids if uid == "uid6"]
+    return len(uids) - len(failures), failures, dict(Thumb=[1, 0])
+
+
+def test_run_backfill():
+    # newest first, like databroker
+    headers = [dict(start=start) for start in _make_starts()[::-1]]
+    summary = run_backfill(0, 20, workers=2, headers=headers,
+                           process=_process, mp_context="fork")
+    assert summary['groups'] == 3
+    assert summary['scans'] == 7
+    assert summary['processed'] == 5
+    assert sorted(summary['failures']) == \
+        [("uid3", "RuntimeError('crashed')"), ("uid6", "bad")]
+    assert summary['stats'] == dict(Thumb=[2, 0])
@@ -0,0 +1,59 @@
+# test the local metadata catalog
+import os
+
+import pytest
+
+from SciAnalysis.interfaces.databroker.catalog import Catalog
+
+
+def _make_start_docs():
+    docs = list()
+    for i, sample in enumerate(["AgBH_5m", "AgBH_3m", "PS_film", "ps_film"]):
+        docs.append(dict(uid="uid{}".format(i), time=100. + i, scan_id=10 + i,
+                         sample_savename=sample, detector_name="pilatus300",
+                         experiment_alias_directory="/data/2017_1/exp",
+                         other_field="not indexed"))
+    return docs
+
+
+def test_Catalog_search():
+    catalog = Catalog(":memory:")
+    catalog.add(_make_start_docs())
+    assert len(catalog) == 4
+    assert catalog.last_time() == 103.
+
+    assert catalog.search(sample_savename="AgBH") == ["uid0", "uid1"]
+    # case sensitive, like databroker.search
+    assert catalog.search(sample_savename="PS") == ["uid2"]
+    assert catalog.search(scan_id=11) == ["uid1"]
+    assert catalog.search(start_time=101, stop_time=102) == ["uid1", "uid2"]
+    assert catalog.search(detector_name="pilatus", limit=1) == ["uid0"]
+    assert catalog.search(sample_savename="AgBH", start_time=101) == ["uid1"]
+
+    if catalog.fts is not None:
+        assert catalog.search(text="film") == ["uid2", "uid3"]
+        assert catalog.search(text="sample_savename:AgBH*",
+                              stop_time=100) == ["uid0"]
+
+    with pytest.raises(ValueError):
+        catalog.search(other_field="not")
+
+
+def test_Catalog_update(tmp_path):
+    filename = os.path.join(str(tmp_path),
+                            "catalog.sqlite")
+    catalog = Catalog(filename)
+    docs = _make_start_docs()
+    catalog.add(docs)
+    # adding a header again updates it
+    docs[0]['sample_savename'] = "AgBH_renamed"
+    catalog.add(docs[0])
+    catalog.close()
+
+    catalog = Catalog(filename)
+    assert len(catalog) == 4
+    assert catalog.search(sample_savename="renamed") == ["uid0"]
+    if catalog.fts is not None:
+        assert catalog.search(text="AgBH_renamed") == ["uid0"]
+        assert catalog.search(text="AgBH_5m") == []
+    catalog.close()
@@ -0,0 +1,114 @@
+# test the checkpoint and restore of the pipeline state
+import os
+
+import numpy as np
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.streams import Stream
+from SciAnalysis.interfaces.checkpoint import Checkpointer, stateful_nodes
+
+
+def _summer():
+    sin = Stream()
+    return sin, sin.accumulate(lambda acc, x: acc + x['kwargs']['image'],
+                               start=0, raw=True)
+
+
+def _make_pipeline():
+    sin = Stream()
+    # a subgraph fed through emit, like the pipeline's streams
+    sin_sum = Stream()
+    sin.map(sin_sum.emit, raw=True)
+    L_sum = sin_sum.accumulate(lambda acc, x: acc + x['kwargs']['image'],
+                               start=0, raw=True).sink_to_list()
+    L_part = sin.partition(3).sink_to_list()
+    L_win = sin.sliding_window(2).sink_to_list()
+    sout_key = sin.partition_by(lambda x: x['attributes']['sample'], 2,
+                                _summer)
+    L_key = sout_key.sink_to_list()
+    return sin, (L_sum, L_part, L_win, L_key, sout_key)
+
+
+def _make_sdoc(i):
+    return StreamDoc(kwargs=dict(image=np.ones((3, 3))*i),
+                     attributes=dict(uid="uid{}".format(i), time=100. + i,
+                                     sample="sample{}".format(i % 3)))
+
+
+def test_Checkpointer(tmp_path):
+    dirname = str(tmp_path)
+    sin, outputs = _make_pipeline()
+    names = list(stateful_nodes([sin]))
+    assert [name.split("_", 1)[1] for name in names] == \
+        ['scan', 'partition', 'sliding_window', 'partition_by']
+
+    checkpointer = Checkpointer(dirname, [sin], every=4)
+    assert checkpointer.restore() is None
+    for i in range(5):
+        sin.emit(_make_sdoc(i))
+        checkpointer.processed(_make_sdoc(i))
+    # saved after the 4th
+    for i in range(4):
+        sin.emit(_make_sdoc(i + 5))
+        checkpointer.processed(_make_sdoc(i + 5))
+    checkpointer.save()
+    checkpointer.save()
+    assert len([f for f in os.listdir(dirname) if f.startswith("snap")]) == 2
+
+    # restart, the same pipeline
+    sin2, outputs2 = _make_pipeline()
+    last = Checkpointer(dirname, [sin2]).restore()
+    assert last == dict(uid="uid8", time=108.)
+    for i in range(9, 12):
+        sin.emit(_make_sdoc(i))
+        sin2.emit(_make_sdoc(i))
+    L_sum, L_part, L_win, L_key, sout_key = outputs
+    L_sum2, L_part2, L_win2, L_key2, sout_key2 = outputs2
+    sout_key.flush()
+    sout_key2.flush()
+    assert (L_sum2[-1] == L_sum[-1]).all()
+    assert L_sum2[-1][0, 0] == sum(range(12))
+    assert [x['attributes']['uid'] for x in L_part2[0]] == \
+        ["uid9", "uid10", "uid11"]
+    assert [x['attributes']['uid'] for x in L_win2[0]] == ["uid8", "uid9"]
+    # the sums per sample went on
+    assert sorted(x[0, 0] for x in L_key2) == \
+        sorted(x[0, 0] for x in L_key[-3:])
+
+
+def test_Checkpointer_interrupted(tmp_path):
+    # interrupted while processing an element, the last snapshot is kept
+    def _fail(x):
+        if x['attributes']['uid'] == "uid3":
+            raise KeyboardInterrupt
+        return x
+
+    def _make():
+        sin = Stream()
+        L = sin.accumulate(lambda acc, x: acc + x['kwargs']['image'],
+                           start=0, raw=True).sink_to_list()
+        sin.map(_fail, raw=True)
+        return sin, L
+
+    sin, L = _make()
+    checkpointer = Checkpointer(str(tmp_path), [sin], every=2)
+    try:
+        for i in range(5):
+            sdoc = _make_sdoc(i)
+            checkpointer.started(sdoc)
+            sin.emit(sdoc)
+            checkpointer.processed(sdoc)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        assert checkpointer.close() is None
+    # uid3 was added to the sum, it's not in the snapshot
+    assert L[-1][0, 0] == 6
+
+    sin2, L2 = _make()
+    assert Checkpointer(str(tmp_path), [sin2]).restore()['uid'] == "uid1"
+    sin2.emit(_make_sdoc(2))
+    assert L2[-1][0, 0] == 3
+    # at an element boundary, saved
+    checkpointer = Checkpointer(str(tmp_path), [sin2])
+    assert checkpointer.close() is not None
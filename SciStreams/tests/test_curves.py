@@ -0,0 +1,51 @@
+# test the columnar curve store
+
+import numpy as np
+from numpy.testing import assert_array_equal, assert_allclose
+import pytest
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.file.curves import CurveStore
+
+
+def _make_curve(i, sample="AgBH"):
+    sqx = np.linspace(0, 1, 21)
+    attrs = dict(uid="uid{}".format(i), sample_savename=sample, scan_id=i,
+                 time=100. + i, detector_name="pilatus300")
+    return StreamDoc(kwargs=dict(sqx=sqx, sqy=sqx*i, sqyerr=sqx*0 + i),
+                     attributes=attrs)
+
+
+def test_CurveStore(tmp_path):
+    dirname = str(tmp_path)
+    qgrid = np.linspace(.1, 1.1, 11)
+    store = CurveStore(dirname, qgrid=qgrid)
+    for i in range(6):
+        assert store.append(_make_curve(i, "AgBH" if i < 4 else "PS")) == i
+    assert len(store) == 6
+
+    sqy = store.get()
+    assert sqy.shape == (6, 11)
+    # interpolated on the grid, NaN out of the curve range
+    assert_allclose(sqy[2, :-1], qgrid[:-1]*2, rtol=1e-6)
+    assert np.isnan(sqy[:, -1]).all()
+    assert_array_equal(store.get([5, 1], field='sqyerr')[:, 0], [5, 1])
+
+    rows = store.query(sample_savename="AgBH", start_time=101)
+    assert rows == [1, 2, 3]
+    assert store.query(scan_ids=[4, 0]) == [0, 4]
+    assert store.query(uids=["uid5"]) == [5]
+    meta = store.metadata([3])[0]
+    assert meta['uid'] == "uid3"
+    assert meta['detector_name'] == "pilatus300"
+    assert store.get(slice(2, 4)).shape == (2, 11)
+    store.close()
+
+    # reopened, the grid is kept and curves can be added
+    with pytest.raises(ValueError):
+        CurveStore(dirname, qgrid=qgrid*2)
+    store = CurveStore(dirname)
+    assert len(store) == 6
+    store.append(_make_curve(6))
+    assert_allclose(store.get([6])[0, :-1], qgrid[:-1]*6, rtol=1e-6)
+    store.close()
@@ -0,0 +1,413 @@
+# test the databroker interface tools that don't need a database
+import threading
+import time
+
+import pytest
+
+from SciAnalysis.interfaces.databroker.databroker import read_ahead
+
+
+def test_read_ahead():
+    def load(x):
+        # later items load faster, order should still be kept
+        time.sleep(.01*(10 - x))
+        return x**2
+
+    assert list(read_ahead(range(10), load, depth=4)) == \
+        [x**2 for x in range(10)]
+
+    # None results are skipped
+    res = read_ahead(range(6), lambda x: x if x % 2 else None, depth=2)
+    assert list(res) == [1, 3, 5]
+
+    with pytest.raises(ValueError):
+        list(read_ahead(range(3), load, depth=0))
+
+
+def test_read_ahead_bounded():
+    lock = threading.Lock()
+    loaded = list()
+
+    def load(x):
+        with lock:
+            loaded.append(x)
+        return x
+
+    res = read_ahead(range(100), load, depth=3)
+    assert next(res) == 0
+    time.sleep(.2)
+    # the current item, plus at most depth loaded ahead
+    assert len(loaded) <= 4
+    res.close()
+
+
+def test_read_ahead_errors():
+    def load(x):
+        if x == 2:
+            raise FileNotFoundError(x)
+        return x
+
+    res = read_ahead(range(5), load, depth=2)
+    assert next(res) == 0
+    assert next(res) == 1
+    with pytest.raises(FileNotFoundError):
+        next(res)
+
+
+class _FakeMDS:
+    def __init__(self):
+        self.docs = list()
+
+    def insert(self, name, doc):
+        time.sleep(.01)
+        self.docs.append((name, doc))
+
+
+class _FakeDB:
+    def __init__(self):
+        self.mds = _FakeMDS()
+        self.fs = None
+
+
+def test_DatabrokerWriter(monkeypatch):
+    import sys
+    import types
+    from SciAnalysis.interfaces.StreamDoc import StreamDoc
+    from SciAnalysis.interfaces.databroker.databroker import \
+        DatabrokerWriter, safe_parse_databroker
+
+    db = _FakeDB()
+    databases = types.ModuleType("databases")
+    databases.databases = {"test:analysis": db}
+    monkeypatch.setitem(sys.modules,
+                        "SciAnalysis.interfaces.databroker.databases",
+                        databases)
+
+    writer = DatabrokerWriter("test:analysis", maxsize=4, batch_size=3)
+    for i in range(10):
+        sdoc = StreamDoc(kwargs=dict(value=i, _hidden=1),
+                         attributes=dict(sample_name="a"))
+        writer.submit(sdoc)
+    writer.flush()
+    metrics = writer.metrics()
+    assert metrics['written'] == 10
+    assert metrics['failed'] == 0
+    assert metrics['backlog'] == 0
+    assert metrics['latency_max'] >= metrics['latency_mean'] > 0
+    writer.close()
+
+    assert len(db.mds.docs) == 40
+    # each run's documents are inserted in order, runs in submitted order
+    starts = [doc for name, doc in db.mds.docs if name == 'start']
+    events = [doc for name, doc in db.mds.docs if name == 'event']
+    assert [ev['data'] for ev in events] == \
+        [dict(value=safe_parse_databroker(i)) for i in range(10)]
+    for start in starts:
+        names = [name for name, doc in db.mds.docs
+                 if doc['uid'] == start['uid'] or
+                 doc.get('run_start') == start['uid']]
+        assert names == ['start', 'descriptor', 'stop']
+    assert starts[0]['sample_name'] == "a"
+
+
+class _FlakyMDS(_FakeMDS):
+    ''' fails the first insert of the event of the second run.'''
+    def __init__(self):
+        super().__init__()
+        self.nevents = 0
+
+    def insert(self, name, doc):
+        if name == 'event':
+            self.nevents += 1
+            if self.nevents == 2:
+                raise ConnectionError("database went away")
+        super().insert(name, doc)
+
+
+def test_DatabrokerWriter_retry(monkeypatch):
+    import sys
+    import types
+    from SciAnalysis.interfaces.StreamDoc import StreamDoc
+    from SciAnalysis.interfaces.databroker.databroker import \
+        DatabrokerWriter
+
+    db = _FakeDB()
+    db.mds = _FlakyMDS()
+    databases = types.ModuleType("databases")
+    databases.databases = {"test:analysis": db}
+    monkeypatch.setitem(sys.modules,
+                        "SciAnalysis.interfaces.databroker.databases",
+                        databases)
+
+    writer = DatabrokerWriter("test:analysis", batch_size=4,
+                              retry_interval=.01)
+    for i in range(3):
+        writer.submit(StreamDoc(kwargs=dict(value=i)))
+    writer.close()
+    assert writer.metrics()['written'] == 3
+    assert writer.metrics()['failed'] == 0
+    # the run that failed part way was completed, without duplicates
+    names = [name for name, doc in db.mds.docs]
+    assert sorted(names) == sorted(['start', 'descriptor', 'event',
+                                    'stop']*3)
+    assert len(set(doc['uid'] for name, doc in db.mds.docs)) == 12
+
+
+class _FakeFS:
+    def __init__(self):
+        self.nretrieved = 0
+
+    def retrieve(self, datum_id):
+        import numpy as np
+        self.nretrieved += 1
+        return np.ones((4, 4))*int(datum_id)
+
+
+def test_DatumRef(monkeypatch):
+    import sys
+    import types
+    from SciAnalysis.interfaces.databroker.databroker import DatumRef, \
+        _retrieve_datum
+
+    db = _FakeDB()
+    db.fs = _FakeFS()
+    databases = types.ModuleType("databases")
+    databases.databases = {"test:data": db}
+    monkeypatch.setitem(sys.modules,
+                        "SciAnalysis.interfaces.databroker.databases",
+                        databases)
+    _retrieve_datum.cache_clear()
+
+    img = DatumRef("3", "test:data").load()
+    assert (img == 3).all()
+    # the cached array is shared, so can't be changed in place
+    with pytest.raises(ValueError):
+        img *= 2
+    assert (DatumRef("3", "test:data").load() == 3).all()
+    assert db.fs.nretrieved == 1
+    _retrieve_datum.cache_clear()
+
+
+def test_safe_parse_databroker():
+    import json
+    import numpy as np
+    from numpy.testing import assert_array_equal
+    from SciAnalysis.interfaces.databroker.databroker import \
+        safe_parse_databroker, decode_databroker, INLINE_ARRAY_MAX_SIZE
+
+    small = np.arange(12, dtype=np.int16).reshape((3, 4))
+    res = decode_databroker(safe_parse_databroker(small))
+    assert res.dtype == np.int16
+    assert_array_equal(res, small)
+
+    # large arrays are summarized, not truncated
+    large = np.arange(INLINE_ARRAY_MAX_SIZE + 1, dtype=float)
+    val = dict(large=large, small=small, scalar=np.float32(1.5), name="a")
+    res = json.loads(safe_parse_databroker(val))
+    assert res['large']['__summary__'] == \
+        dict(shape=[len(large)], dtype='<f8', min=0., max=len(large) - 1.,
+             mean=large.mean())
+    assert res['scalar'] == 1.5
+    assert res['name'] == "a"
+    assert_array_equal(decode_databroker(res)['small'], small)
+
+
+def test_safe_parse_databroker_complex_object():
+    import numpy as np
+    from numpy.testing import assert_array_equal
+    from SciAnalysis.interfaces.databroker.databroker import \
+        safe_parse_databroker, decode_databroker
+
+    cplx = (np.arange(6) + 1j*np.arange(6)[::-1]).reshape((2, 3))
+    cplx = cplx.astype(np.complex64)
+    res = decode_databroker(safe_parse_databroker(cplx))
+    assert res.dtype == np.complex64
+    assert_array_equal(res, cplx)
+
+    obj = np.empty((2, 2), dtype=object)
+    obj[0, 0], obj[0, 1] = "a", 1
+    obj[1, 0], obj[1, 1] = np.arange(3), [1, 2]
+    res = decode_databroker(safe_parse_databroker(obj))
+    assert res.shape == (2, 2)
+    assert res[0, 0] == "a" and res[0, 1] == 1
+    assert_array_equal(res[1, 0], np.arange(3))
+    assert res[1, 1] == [1, 2]
+
+
+def test_make_documents_large_arrays():
+    import numpy as np
+    from SciAnalysis.interfaces.StreamDoc import StreamDoc
+    from SciAnalysis.interfaces.databroker.databroker import \
+        _make_documents, INLINE_ARRAY_MAX_SIZE, AUTO_EXTERNAL_WRITER
+
+    large = np.ones(INLINE_ARRAY_MAX_SIZE + 1)
+    sdoc = StreamDoc(kwargs=dict(large=large, small=np.ones(3),
+                                 image=np.ones((100, 100))))
+    docs, external = _make_documents(sdoc, dict(image='npy'))
+    assert sorted((key, writer_key) for key, writer_key, val in external) == \
+        [('image', 'npy'), ('large', AUTO_EXTERNAL_WRITER)]
+    data_keys = docs['descriptor']['data_keys']
+    assert data_keys['large']['external'] == "FILESTORE:"
+    assert data_keys['large']['summary']['mean'] == 1.
+    assert 'external' not in data_keys['small']
+    assert 'small' in docs['event']['data']
+
+
+class _FakeHeaderDB:
+    ''' Headers (just start documents) queried by time range or uids.'''
+    def __init__(self):
+        self.headers = list()
+        self.queries = list()
+
+    def add(self, uid, t):
+        self.headers.append(dict(start=dict(uid=uid, time=t)))
+
+    def __call__(self, start_time=None, stop_time=None, uid=None):
+        self.queries.append((start_time, stop_time))
+        headers = self.headers
+        if start_time is not None:
+            headers = [h for h in headers if h['start']['time'] >= start_time]
+        if stop_time is not None:
+            headers = [h for h in headers if h['start']['time'] <= stop_time]
+        if uid is not None:
+            headers = [h for h in headers if h['start']['uid'] in uid['$in']]
+        # newest first, like databroker
+        return sorted(headers, key=lambda h: -h['start']['time'])
+
+
+def _fake_header_db(monkeypatch):
+    import sys
+    import types
+    from SciAnalysis.interfaces.StreamDoc import StreamDoc
+    from SciAnalysis.interfaces.databroker import databroker
+
+    db = _FakeHeaderDB()
+    databases = types.ModuleType("databases")
+    databases.databases = {"test:data": db}
+    monkeypatch.setitem(sys.modules,
+                        "SciAnalysis.interfaces.databroker.databases",
+                        databases)
+    # StreamDocs of just the start documents
+    monkeypatch.setattr(databroker, "_safe_Header2StreamDoc",
+                        lambda header, dbname, **kwargs:
+                        StreamDoc(attributes=header['start']))
+    return db
+
+
+def _uids(headers):
+    return [header['start']['uid'] for header in headers]
+
+
+def _sdoc_uids(sdocs):
+    return [sdoc['attributes']['uid'] for sdoc in sdocs]
+
+
+def test_HeaderCursor(monkeypatch):
+    from SciAnalysis.interfaces.databroker.databroker import HeaderCursor
+
+    db = _fake_header_db(monkeypatch)
+    for i, t in enumerate([1, 2, 2, 2, 3, 5]):
+        db.add("u{}".format(i), t)
+    db.add("old", 0)
+
+    cursor = HeaderCursor("test:data", start_time=1, page_size=2,
+                          page_span=None)
+    assert cursor._after_watermark(db.headers[0])
+    assert not cursor._after_watermark(db.headers[-1])
+    pages = list()
+    while True:
+        page = cursor.next_page()
+        if not page:
+            break
+        pages.append(_uids(page))
+    # oldest first, ties ordered by uid, page_size at a time
+    assert pages == [["u0", "u1"], ["u2", "u3"], ["u4", "u5"]]
+    assert cursor.time == 5
+    assert not cursor._after_watermark(db.headers[5])
+
+    # new headers at the watermark time aren't missed, nor repeated
+    db.add("a0", 5)
+    db.add("u6", 6)
+    assert _sdoc_uids(cursor.sdocs()) == ["a0", "u6"]
+    assert cursor.next_page() == []
+
+    # resume after uids already processed
+    cursor = HeaderCursor("test:data", start_time=2, seen=["u1", "u2"],
+                          page_span=None)
+    assert _uids(cursor.next_page()) == ["u3", "u4", "a0", "u5", "u6"]
+
+
+def test_HeaderCursor_page_span(monkeypatch):
+    import time
+    from SciAnalysis.interfaces.databroker.databroker import HeaderCursor
+
+    db = _fake_header_db(monkeypatch)
+    t0 = time.time() - 100
+    for i, t in enumerate([0, 5, 35, 36]):
+        db.add("u{}".format(i), t0 + t)
+    cursor = HeaderCursor("test:data", start_time=t0, page_span=10)
+    # the database is queried 10 s at a time, the empty ranges are skipped
+    assert _uids(cursor.next_page()) == ["u0", "u1"]
+    assert _uids(cursor.next_page()) == ["u2"]
+    assert _uids(cursor.next_page()) == ["u3"]
+    assert [(start - t0, stop - t0) for start, stop in db.queries] == \
+        [(0, 10), (5, 15), (15, 25), (25, 35), (35, 45)]
+    db.queries.clear()
+    # caught up, the last query is open ended
+    assert cursor.next_page() == []
+    assert db.queries[-1][1] is None
+    # the old empty ranges aren't queried again
+    db.queries.clear()
+    assert cursor.next_page() == []
+    assert db.queries[0][0] > t0 + 36
+
+
+def test_pullfromuids(monkeypatch):
+    from SciAnalysis.interfaces.databroker.databroker import pullfromuids
+
+    db = _fake_header_db(monkeypatch)
+    for i, t in enumerate([1, 2, 3]):
+        db.add("u{}".format(i), t)
+    # in the order asked for, with one query, missing uids skipped
+    assert _sdoc_uids(pullfromuids("test:data", ["u2", "nope", "u0"])) == \
+        ["u2", "u0"]
+    assert len(db.queries) == 1
+    assert _sdoc_uids(pullfromuids("test:data", ["u2", "u0", "u1"],
+                                   read_ahead_depth=2)) == ["u2", "u0", "u1"]
+
+
+def test_read_ahead_fields(monkeypatch):
+    from SciAnalysis.interfaces.StreamDoc import StreamDoc
+    from SciAnalysis.interfaces.databroker import databroker
+    from SciAnalysis.interfaces.databroker.databroker import DatumRef, \
+        _retrieve_datum
+
+    db = _fake_header_db(monkeypatch)
+    db.fs = _FakeFS()
+    for i in range(3):
+        db.add("u{}".format(i), i)
+
+    def header2sdoc(header, dbname, **kwargs):
+        i = int(header['start']['uid'][1:])
+        return StreamDoc(kwargs=dict(image=DatumRef(str(i), dbname),
+                                     other=DatumRef(str(10 + i), dbname)))
+    monkeypatch.setattr(databroker, "_safe_Header2StreamDoc", header2sdoc)
+    _retrieve_datum.cache_clear()
+
+    sdocs = list(databroker.pullfromuids("test:data", ["u0", "u1", "u2"],
+                                         read_ahead_depth=2,
+                                         read_ahead_fields=["image"]))
+    # the StreamDocs stay lazy, only the images were loaded (cached)
+    assert all(isinstance(sdoc['kwargs']['image'], DatumRef)
+               for sdoc in sdocs)
+    assert db.fs.nretrieved == 3
+    assert (sdocs[1]['kwargs']['image'].load() == 1).all()
+    assert db.fs.nretrieved == 3
+    _retrieve_datum.cache_clear()
+
+
+def test_write_external_unknown_writer():
+    from SciAnalysis.interfaces.databroker.databroker import _write_external
+    docs = dict(event=dict(data=dict(image=None)))
+    _write_external(None, docs, [("image", "nosuchwriter", [1, 2])], dict())
+    assert docs['event']['data']['image'] == 'Error'
@@ -0,0 +1,103 @@
+# test the live document ingest
+import json
+import threading
+import time
+
+from SciAnalysis.interfaces.databroker.documents import RunAssembler,\
+    DocumentListener
+from SciAnalysis.interfaces.streams import Stream
+
+
+def _make_run(uid, value):
+    ''' documents of a one event run.'''
+    start = dict(uid=uid, time=time.time(), sample_savename="sample")
+    descriptor = dict(uid=uid + "-desc", run_start=uid,
+                      data_keys=dict(value=dict(dtype='number'),
+                                     image=dict(dtype='array',
+                                                external='FILESTORE:')))
+    event = dict(uid=uid + "-ev", descriptor=uid + "-desc", seq_num=1,
+                 data=dict(value=value, image="datum-" + uid))
+    stop = dict(uid=uid + "-stop", run_start=uid, exit_status='success')
+    return [('start', start), ('descriptor', descriptor), ('event', event),
+            ('stop', stop)]
+
+
+def test_RunAssembler():
+    assembler = RunAssembler()
+    run1 = _make_run("a", 1)
+    run2 = _make_run("b", 2)
+    # interleaved runs, only emitted on stop
+    results = list()
+    for (name1, doc1), (name2, doc2) in zip(run1, run2):
+        results.append(assembler.update(name1, doc1))
+        results.append(assembler.update(name2, doc2))
+    assert results[:-2] == [None]*6
+    sdoc_a, sdoc_b = results[-2:]
+    assert sdoc_a['attributes']['uid'] == "a"
+    assert sdoc_a['attributes']['data_uid'] == "a"
+    assert sdoc_a['kwargs']['value'] == 1
+    # no database given, datum ids are left as is
+    assert sdoc_a['kwargs']['image'] == "datum-a"
+    assert sdoc_b['kwargs']['value'] == 2
+    assert len(assembler) == 0
+
+    # a stop for a run we never saw the start of is ignored
+    assert assembler.update(*run1[-1]) is None
+
+
+def test_RunAssembler_stale_runs():
+    assembler = RunAssembler(max_runs=2, max_age=None)
+    # runs without stop documents
+    for uid in "abc":
+        for name, doc in _make_run(uid, 1)[:-1]:
+            assembler.update(name, doc)
+    assert len(assembler) == 2
+    assert assembler.ndropped == 1
+    assert assembler.update(*_make_run("a", 1)[-1]) is None
+    sdoc = assembler.update(*_make_run("c", 1)[-1])
+    assert sdoc['attributes']['uid'] == "c"
+
+    assembler = RunAssembler(max_age=.1)
+    assembler.update(*_make_run("a", 1)[0])
+    time.sleep(.2)
+    assembler.update(*_make_run("b", 1)[0])
+    assert len(assembler) == 1
+    assert assembler.ndropped == 1
+
+
+def test_DocumentListener():
+    import zmq
+
+    context = zmq.Context()
+    publisher = context.socket(zmq.PUB)
+    port = publisher.bind_to_random_port("tcp://127.0.0.1")
+
+    sin = Stream()
+    L = list()
+    sin.map(lambda x: x['kwargs']['value'], raw=True).sink(L.append)
+
+    listener = DocumentListener("tcp://127.0.0.1:{}".format(port), sin.emit,
+                                prefix=b'cms')
+
+    def publish():
+        # give the subscriber time to connect
+        time.sleep(.5)
+        for i, uid in enumerate(["a", "b", "c"]):
+            for name, doc in _make_run(uid, i):
+                publisher.send(b' '.join([b'cms', name.encode(),
+                                          json.dumps(doc).encode()]))
+        # other prefixes are not listened to
+        for name, doc in _make_run("d", 3):
+            publisher.send(b' '.join([b'chx', name.encode(),
+                                      json.dumps(doc).encode()]))
+
+    thread = threading.Thread(target=publish)
+    thread.start()
+    nruns = listener.run(timeout=2)
+    thread.join()
+    listener.close()
+    publisher.close()
+    context.term()
+
+    assert nruns == 3
+    assert L == [0, 1, 2]
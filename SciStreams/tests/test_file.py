@@ -0,0 +1,90 @@
+# test the file interface
+import os
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.file import file as source_file
+
+
+def _make_sdoc(i):
+    attrs = dict(experiment_alias_directory="/exp", detector_name="pilatus300",
+                 sample_savename="sample", stream_name="circavg", scan_id=i)
+    return StreamDoc(kwargs=dict(sqx=np.arange(10.), sqy=np.arange(10.)*i),
+                     attributes=attrs)
+
+
+def test_store_results_file(tmp_path, monkeypatch):
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(source_file, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(source_file, "_ROOTMAP", None)
+    writers = [dict(writer='npy', keys=['sqx', 'sqy']),
+               dict(writer='dat', keys=['sqx', 'sqy'])]
+    source_file.store_results_file(_make_sdoc(1), writers=writers)
+
+    outdir = rootdir + "/saxs/circavg/files"
+    assert sorted(os.listdir(outdir)) == ["sample_1.dat", "sample_1.npz"]
+    res = np.load(outdir + "/sample_1.npz")
+    assert_array_equal(res['sqy'], np.arange(10.))
+    assert outdir in source_file._known_dirs
+
+
+def test_FileWriteQueue(tmp_path, monkeypatch):
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(source_file, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(source_file, "_ROOTMAP", None)
+    writers = dict(writer='npy', keys=['sqx', 'sqy'])
+
+    queue = source_file.get_file_write_queue()
+    for i in range(20):
+        source_file.store_results_file(_make_sdoc(i), writers=writers,
+                                       background=True)
+    queue.flush()
+    assert len(queue) == 0
+    assert queue.errors == []
+    outdir = rootdir + "/saxs/circavg/files"
+    # no temporary files left
+    assert sorted(os.listdir(outdir)) == \
+        sorted("sample_{}.npz".format(i) for i in range(20))
+    assert_array_equal(np.load(outdir + "/sample_3.npz")['sqy'],
+                       np.arange(10.)*3)
+
+    # errors are kept, and don't stop the queue
+    queue = source_file.FileWriteQueue(max_workers=2, maxsize=2)
+    queue.submit(source_file.writers_dict['dat'], outdir + "/bad", "notdict")
+    queue.submit(source_file.writers_dict['npy'], outdir + "/good",
+                 dict(a=np.ones(3)))
+    queue.close()
+    assert [fname for fname, e in queue.errors] == [outdir + "/bad"]
+    assert os.path.exists(outdir + "/good.npz")
+
+
+def test_hdf5writer(tmp_path, monkeypatch):
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(source_file, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(source_file, "_ROOTMAP", None)
+    writers = dict(writer='hdf5', keys=['sqx', 'sqy'])
+
+    queue = source_file.FileWriteQueue(max_workers=4)
+    for i in range(10):
+        queue.submit(*source_file._prepare_writes(_make_sdoc(i), writers)[0])
+    queue.close()
+    assert queue.errors == []
+    # written again, replaced
+    sdoc = _make_sdoc(3)
+    sdoc['kwargs']['sqy'] = -np.ones(5)
+    source_file.store_results_file(sdoc, writers=writers)
+
+    outdir = rootdir + "/saxs/circavg/files"
+    # one file per sample
+    assert os.listdir(outdir) == ["sample.h5"]
+    attrs = _make_sdoc(0)['attributes']
+    res = source_file.load_results_file(attrs)
+    assert sorted(res.keys(), key=int) == [str(i) for i in range(10)]
+    assert_array_equal(res['2']['sqy'], np.arange(10.)*2)
+    res = source_file.load_results_file(attrs, scan_ids=[3, 11],
+                                        keys=['sqy'])
+    assert list(res.keys()) == ['3']
+    assert list(res['3'].keys()) == ['sqy']
+    assert_array_equal(res['3']['sqy'], -np.ones(5))
@@ -0,0 +1,286 @@
+# test the custom databroker handlers
+import os
+
+import numpy as np
+import h5py
+import pytest
+from PIL import Image
+
+from numpy.testing import assert_array_equal
+
+from SciAnalysis.interfaces.databroker.handlers_custom import EigerImages,\
+    EigerImages2, HDF5FilePool, hdf5_pool, _lz4_decompress,\
+    MemmapTiffHandler, tiff_memmap_layout, HDF5RowsHandler
+from SciAnalysis.interfaces.databroker.handlers_custom import _decode_chunk, \
+    _H5Z_BSHUF
+from SciAnalysis.interfaces.databroker.writers_custom import HDF5RowsWriter
+
+
+def _make_eiger_files(tmpdir, nframes=(7, 5), shape=(6, 4), chunk_rows=3,
+                      **compression):
+    ''' Write a fake Eiger master file with its data files, in tmpdir.
+
+        Returns the master file path and the full stack of frames.
+    '''
+    tmpdir = str(tmpdir)
+    os.makedirs(tmpdir, exist_ok=True)
+    prefix = "sample_1_"
+    frames = list()
+    master_filepath = os.path.join(tmpdir, prefix + "master.h5")
+    with h5py.File(master_filepath, "w") as f:
+        data = f.create_group("entry/data")
+        for i, n in enumerate(nframes):
+            key = "data_{:06d}".format(i + 1)
+            filename = prefix + key + ".h5"
+            stack = np.arange(n*shape[0]*shape[1], dtype=np.uint32)
+            stack = stack.reshape((n,) + shape) + 1000*i
+            frames.append(stack)
+            with h5py.File(os.path.join(tmpdir, filename), "w") as fdata:
+                fdata.create_dataset("entry/data/data", data=stack,
+                                     chunks=(chunk_rows,) + shape,
+                                     **compression)
+            data[key] = h5py.ExternalLink(filename, "/entry/data/data")
+
+        ddet = f.create_group("entry/instrument/detector")
+        ddetS = ddet.create_group("detectorSpecific")
+        f["entry/instrument/beam/incident_wavelength"] = 1.
+        for key in ['x_pixel_size', 'y_pixel_size', 'threshold_energy',
+                    'detector_distance', 'beam_center_x', 'beam_center_y',
+                    'sensor_thickness', 'count_time', 'frame_time']:
+            ddet[key] = 1.
+        ddetS['photon_energy'] = 1.
+        ddetS['nimages'] = sum(nframes)
+        ddetS['software_version'] = np.bytes_('1.5.0')
+        ddetS['data_collection_date'] = np.bytes_('today')
+        ddetS['x_pixels_in_detector'] = shape[1]
+        ddetS['y_pixels_in_detector'] = shape[0]
+        ddetS['flatfield'] = np.ones(shape)
+        ddetS['pixel_mask'] = np.zeros(shape, dtype=np.uint32)
+
+    return master_filepath, np.concatenate(frames)
+
+
+def test_EigerImages_get_frame(tmp_path):
+    master_filepath, frames = _make_eiger_files(tmp_path)
+    imgs = EigerImages(master_filepath)
+    assert len(imgs) == len(frames)
+    for i in range(len(frames)):
+        assert_array_equal(imgs.get_frame(i), frames[i])
+    # frames are copies, the chunk cache should not be modified
+    img = imgs.get_frame(0)
+    img[:] = 0
+    assert_array_equal(imgs.get_frame(0), frames[0])
+    assert imgs.get_pixel_mask().shape == frames.shape[1:]
+    imgs.close()
+
+
+def test_EigerImages_get_frames(tmp_path):
+    master_filepath, frames = _make_eiger_files(tmp_path)
+    imgs = EigerImages(master_filepath)
+    # across chunk and file boundaries, with and without cached chunks
+    for start, stop in [(0, 12), (1, 5), (2, 9), (6, 8), (0, 3), (11, 12),
+                        (4, 4)]:
+        assert_array_equal(imgs.get_frames(start, stop), frames[start:stop])
+    imgs.close()
+
+    imgs = EigerImages2(master_filepath, imgthresh=20)
+    res = imgs.get_frames(0, 12)
+    assert_array_equal(res, frames*(frames < 20))
+    assert_array_equal(imgs.get_frame(1), frames[1]*(frames[1] < 20))
+    imgs.close()
+
+
+def test_HDF5FilePool(tmp_path):
+    master_filepath, frames = _make_eiger_files(tmp_path)
+    datadir = os.path.dirname(master_filepath)
+    filenames = [os.path.join(datadir, fname)
+                 for fname in sorted(os.listdir(datadir))]
+    pool = HDF5FilePool(maxsize=1)
+    with pool.borrow(filenames[0]) as f0:
+        # borrowed handles are not closed when going over the limit
+        with pool.borrow(filenames[1]) as f1:
+            assert len(pool) == 2
+        assert len(pool) == 1
+        assert f0.id.valid
+        assert not f1.id.valid
+    with pool.borrow(filenames[0]) as f:
+        assert f is f0
+    pool.close()
+    assert len(pool) == 0
+
+    # the master file is opened once and then reused
+    hdf5_pool.close()
+    imgs = EigerImages(master_filepath)
+    imgs.get_frame(0)
+    imgs.get_flatfield()
+    assert master_filepath in hdf5_pool._handles
+    imgs.close()
+
+
+def test_EigerImages_decompress_threads(tmp_path):
+    master_filepath, frames = _make_eiger_files(tmp_path / "gzip",
+                                                compression='gzip',
+                                                shuffle=True)
+    imgs = EigerImages(master_filepath, decompress_threads=4)
+    assert_array_equal(imgs.get_frames(0, 12), frames)
+    assert_array_equal(imgs.get_frames(2, 10), frames[2:10])
+    for i in range(len(frames)):
+        assert_array_equal(imgs.get_frame(i), frames[i])
+    imgs.close()
+
+    master_filepath, frames = _make_eiger_files(tmp_path / "raw")
+    imgs = EigerImages2(master_filepath, imgthresh=20, decompress_threads=2)
+    assert_array_equal(imgs.get_frames(1, 11),
+                       frames[1:11]*(frames[1:11] < 20))
+    imgs.close()
+
+
+def test_lz4_decompress():
+    import struct
+    import lz4.block
+
+    data = np.arange(1000, dtype=np.uint32).tobytes()
+    block_size = 1024
+    raw = struct.pack('>qi', len(data), block_size)
+    for i in range(0, len(data), block_size):
+        block = data[i:i + block_size]
+        if i == 0:
+            # a block stored uncompressed
+            compressed = block
+        else:
+            compressed = lz4.block.compress(block, store_size=False)
+        raw += struct.pack('>i', len(compressed)) + compressed
+    assert bytes(_lz4_decompress(raw)) == data
+
+
+# a 16x16 uint32 frame ((arange(256) % 37)*3) written by h5py with the
+# bitshuffle filter and LZ4 compression (the Eiger format), read back with
+# read_direct_chunk
+_BSHUF_LZ4_CHUNK = (
+    "AAAAAAAABAAAACAAAAAA7OCqqqqqSlVVVVWpqqqqKgkAEKUTAFBUVVVVlQkA8ARmZmZmxszM"
+    "zMyYmZmZGTMzMzNjEwAAEgD/mIyZmZmZtLS0tJSWlpaW0tLS0lJaWlpaSktLS0tpaWlpKS0t"
+    "LS04xzjHGOcY5xjjHOMcY5xjnGOMc4xzjHGOcY4xzjHOMcAHP/gA+OAHHwAf/OAD4IMffAB8"
+    "8IMPgA9+8AHwwQ8+APg/AB8A/wfgA+D/AHwA/B+AD4D/A/AB8H8APgD+D8AAAMD/HwAA+P8D"
+    "AAD/fwAA4P8PAAD8/wEAgP8/AADw/wAAAgD///8JUAAAAAAA")
+
+
+def test_decode_chunk_bitshuffle_lz4():
+    import base64
+    pytest.importorskip("bitshuffle")
+    raw = base64.b64decode(_BSHUF_LZ4_CHUNK)
+    # filter values as stored by the bitshuffle hdf5 plugin
+    filters = [(_H5Z_BSHUF, (0, 5, 4, 0, 2))]
+    res = _decode_chunk(raw, 0, filters, np.uint32)
+    assert_array_equal(res, (np.arange(256, dtype=np.uint32) % 37)*3)
+    # the filter is skipped if flagged in the filter mask
+    assert len(_decode_chunk(raw, 1, filters, np.uint8)) == len(raw)
+
+
+def test_MemmapTiffHandler(tmp_path):
+    tmpdir = str(tmp_path)
+    images = list()
+    for i in range(4):
+        image = np.arange(619*487, dtype=np.int32).reshape((619, 487)) - i
+        Image.fromarray(image).save(tmpdir + "/img_{:04d}.tiff".format(i))
+        images.append(image)
+
+    offset, dtype, shape = tiff_memmap_layout(tmpdir + "/img_0000.tiff")
+    assert dtype == np.int32
+    assert shape == (619, 487)
+
+    handler = MemmapTiffHandler(tmpdir, "%s/%s_%4.4d.tiff", "img")
+    res = handler(2)
+    assert isinstance(res, np.memmap)
+    assert res.dtype == np.int32
+    assert not res.flags.writeable
+    assert_array_equal(res, images[2])
+
+    handler = MemmapTiffHandler(tmpdir, "%s/%s_%4.4d.tiff", "img",
+                                frame_per_point=2)
+    assert_array_equal(handler(1), np.array(images[2:]))
+
+    # compressed images can't be memory mapped, they're read instead
+    fname = tmpdir + "/compressed_0000.tiff"
+    Image.fromarray(images[0]).save(fname, compression="tiff_adobe_deflate")
+    assert tiff_memmap_layout(fname) is None
+    handler = MemmapTiffHandler(tmpdir, "%s/%s_%4.4d.tiff", "compressed")
+    assert_array_equal(handler(0), images[0])
+
+
+class _FakeFS:
+    ''' keeps the filestore records in memory.'''
+    def __init__(self):
+        self.resources = list()
+        self.datums = dict()
+
+    def insert_resource(self, spec, fpath, resource_kwargs={}):
+        self.resources.append(fpath)
+        return fpath
+
+    def insert_datum(self, resource, datum_id, datum_kwargs):
+        self.datums[datum_id] = resource, datum_kwargs
+
+
+def test_HDF5RowsWriter(tmp_path):
+    fs = _FakeFS()
+    root = str(tmp_path)
+    writer = HDF5RowsWriter(fs, root=root)
+    curves = [np.random.random(100) for i in range(5)]
+    images = [np.random.random((10, 10)) for i in range(3)]
+    ids = list()
+    for curve in curves:
+        ids.append(writer.write(curve, subpath="/2017/01/01", key="sqy"))
+    image_ids = [writer.write(image, subpath="/2017/01/01", key="image")
+                 for image in images]
+    # one file (resource) per key, day and shape
+    writer.write(curves[0][:10], subpath="/2017/01/01", key="sqy")
+    writer.write(curves[0], subpath="/2017/01/02", key="sqy")
+    assert len(fs.resources) == 4
+
+    # readable while still being written to
+    fpath, kwargs = fs.datums[ids[0]]
+    handler = HDF5RowsHandler(fpath)
+    assert_array_equal(handler(**kwargs), curves[0])
+    ids.append(writer.write(curves[0]*2, subpath="/2017/01/01", key="sqy"))
+    fpath, kwargs = fs.datums[ids[-1]]
+    assert_array_equal(handler(**kwargs), curves[0]*2)
+    rows = [fs.datums[datum_id][1]['row'] for datum_id in ids[3::-1]]
+    assert_array_equal(handler.get_rows(rows + rows[:1]),
+                       np.array(curves[3::-1] + curves[3:4]))
+    writer.close()
+    handler.close()
+
+    fpath, kwargs = fs.datums[image_ids[1]]
+    handler = HDF5RowsHandler(fpath)
+    assert_array_equal(handler(**kwargs), images[1])
+    assert handler.get_file_list([kwargs]) == [fpath]
+    handler.close()
+
+
+def test_HDF5RowsWriter_threads(tmp_path):
+    import threading
+    fs = _FakeFS()
+    root = str(tmp_path)
+    writer = HDF5RowsWriter(fs, root=root)
+    ids = dict()
+
+    def write(i):
+        for j in range(10):
+            val = np.full(50, i*100 + j, dtype=float)
+            ids[i*100 + j] = writer.write(val, subpath="/2017/01/01",
+                                          key="sqy")
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+    # each value got its own row
+    rows = [fs.datums[datum_id][1]['row'] for datum_id in ids.values()]
+    assert sorted(rows) == list(range(40))
+    fpath, kwargs = fs.datums[ids[0]]
+    handler = HDF5RowsHandler(fpath)
+    for val, datum_id in ids.items():
+        assert (handler(**fs.datums[datum_id][1]) == val).all()
+    handler.close()
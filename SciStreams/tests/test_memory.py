@@ -0,0 +1,95 @@
+# test the memory manager of stream buffers
+import os
+
+import numpy as np
+import pytest
+
+from SciAnalysis.interfaces import memory
+from SciAnalysis.interfaces.memory import MemoryManager, ManagedDeque, nbytes
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.streams import Stream
+
+
+def _sdoc(i):
+    return StreamDoc(kwargs=dict(image=np.full((100, 100), i, dtype=float),
+                                 small=np.arange(3)),
+                     attributes=dict(seq_num=i))
+
+
+def test_MemoryManager(tmp_path):
+    spilldir = str(tmp_path)
+    manager = MemoryManager(200000, spilldir=spilldir, min_nbytes=1000)
+
+    class node:
+        stream_name = "node"
+
+    sdocs = [_sdoc(i) for i in range(4)]
+    assert nbytes(sdocs[0]) == 80000 + sdocs[0]['kwargs']['small'].nbytes
+    held = [manager.hold(node, sdoc) for sdoc in sdocs]
+    # the two oldest images were spilled
+    assert manager.nbytes <= 200000
+    assert manager.nspilled == 2
+    assert manager.usage['node'][1] == 160000
+    # the spilled elements aren't looked at again
+    assert list(manager._resident) == held[2:]
+    spilled = [h.value['kwargs']['image'] for h in held[:2]]
+    assert all(isinstance(val, memory.SpilledArray) for val in spilled)
+    # the original StreamDocs aren't changed
+    assert sdocs[0]['kwargs']['image'].shape == (100, 100)
+
+    # loaded when accessed, then the least recently used is spilled
+    value = manager.get(held[0])
+    assert isinstance(value, StreamDoc)
+    assert (value['kwargs']['image'] == 0).all()
+    assert value['attributes'] == dict(seq_num=0)
+    assert isinstance(held[2].value['kwargs']['image'], memory.SpilledArray)
+    assert list(manager._resident) == [held[3], held[0]]
+
+    for i, h in enumerate(held):
+        assert (manager.release(h)['kwargs']['image'] == i).all()
+    assert len(manager) == 0
+    assert manager.nbytes == 0
+    assert manager.usage['node'] == [0, 0]
+    # the spilled files are removed when loaded
+    assert os.listdir(manager.dirname) == []
+    manager.close()
+    assert os.listdir(spilldir) == []
+
+    with pytest.raises(ValueError):
+        MemoryManager(1000, policy='random')
+
+
+def test_streams_memory_budget(monkeypatch):
+    manager = MemoryManager(100000, min_nbytes=1000)
+    monkeypatch.setattr(memory, "_memory_manager", manager)
+
+    s1 = Stream()
+    s2 = Stream()
+    zipped = s1.zip(s2).sink_to_list()
+    windows = s1.sliding_window(3).sink_to_list()
+    for i in range(5):
+        s1.emit(_sdoc(i))
+    assert manager.nbytes <= 100000 + 80000
+    assert manager.nspilled > 0
+    # elements come out of the buffers with their images
+    for i in range(5):
+        s2.emit(_sdoc(10 + i))
+    assert len(zipped) == 5
+    for i, (a, b) in enumerate(zipped):
+        assert (a['kwargs']['image'] == i).all()
+        assert (b['kwargs']['image'] == 10 + i).all()
+    assert len(windows) == 3
+    for i, window in enumerate(windows):
+        assert [sdoc['attributes']['seq_num'] for sdoc in window] == \
+            [i, i + 1, i + 2]
+        assert all((sdoc['kwargs']['image'] == sdoc['attributes']['seq_num'])
+                   .all() for sdoc in window)
+    # only the last window is still held
+    assert len(manager) == 3
+
+    cache = ManagedDeque(maxlen=2, stream_name="cache")
+    for i in range(3):
+        cache.append(_sdoc(i))
+    assert [sdoc['attributes']['seq_num'] for sdoc in cache] == [1, 2]
+    assert 'cache' in manager.usage
+    manager.close()
@@ -0,0 +1,160 @@
+# test the matplotlib plotting interface
+import os
+import subprocess
+import sys
+import threading
+
+import numpy as np
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.plotting_mpl import plotting_mpl
+from SciAnalysis.interfaces.plotting_mpl.plotting_mpl import FigureRenderer, \
+    RenderPool, _plotted_data
+
+
+def test_FigureRenderer(tmp_path):
+    outdir = str(tmp_path)
+    renderer = FigureRenderer()
+    opts = dict(lines=[('sqx', 'sqy')], scale='loglog', xlabel="q")
+    sqx = np.linspace(.01, 1, 100)
+    renderer.render(outdir + "/a.png", dict(sqx=sqx, sqy=sqx**-2), opts)
+    fig, artists = list(renderer._figures.values())[0]
+    renderer.render(outdir + "/b.png", dict(sqx=sqx, sqy=sqx**-3), opts)
+    # same layout, the figure and lines are reused
+    assert len(renderer._figures) == 1
+    line = artists['lines'][0][1]
+    assert np.allclose(line.get_ydata(), sqx**-3)
+
+    image = np.random.random((20, 30))*100
+    renderer.render(outdir + "/c.png", dict(image=image),
+                    dict(images=['image'], hideaxes=True))
+    renderer.render(outdir + "/d.png", dict(image=image*2),
+                    dict(images=['image'], hideaxes=True))
+    # a new image shape is a new layout
+    renderer.render(outdir + "/e.png", dict(image=image[:10]),
+                    dict(images=['image'], hideaxes=True))
+    assert len(renderer._figures) == 3
+    renderer.render(outdir + "/f.png", dict(image=np.ones((5, 4, 4))),
+                    dict(images=['image']))
+    assert sorted(os.listdir(outdir)) == \
+        ["a.png", "b.png", "c.png", "d.png", "e.png", "f.png"]
+
+
+def test_store_results_threads(tmp_path, monkeypatch):
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(plotting_mpl, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(plotting_mpl, "_ROOTMAP", None)
+
+    def plot(i):
+        attrs = dict(experiment_alias_directory="/exp", scan_id=i,
+                     detector_name="pilatus300", sample_savename="sample")
+        sdoc = StreamDoc(kwargs=dict(image=np.random.random((10, 10))),
+                         attributes=attrs)
+        plotting_mpl.store_results(sdoc, images=['image'])
+
+    threads = [threading.Thread(target=plot, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    outdir = rootdir + "/saxs/unnamed_analysis/plots"
+    assert len(os.listdir(outdir)) == 8
+
+
+def test_RenderPool(tmp_path):
+    outdir = str(tmp_path)
+    pool = RenderPool(processes=2, maxsize=2)
+    for i in range(6):
+        pool.submit(outdir + "/{}.png".format(i),
+                    dict(image=np.random.random((10, 10))),
+                    dict(images=['image']))
+    # can't be rendered
+    pool.submit(outdir + "/bad.png", dict(image="notanimage"),
+                dict(lines=['image']))
+    pool.close()
+    assert len(pool) == 0
+    assert [fname for fname, e in pool.errors] == [outdir + "/bad.png"]
+    assert len(os.listdir(outdir)) == 6
+
+
+def test_plotted_data():
+    data = dict(image=1, x=2, y=3, z=4, unused=5)
+    plot_opts = dict(images=['image', 'missing'], lines=[('x', 'y'), 'z'],
+                     title='a')
+    assert _plotted_data(data, plot_opts) == dict(image=1, x=2, y=3, z=4)
+
+
+# spawn a worker with run_pipeline.py as the main script, like the
+# RenderPool of the pipeline, and check what it imported
+_SPAWN_CHECK = '''
+import sys
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+sys.modules['__main__'].__file__ = {!r}
+context = multiprocessing.get_context('spawn')
+with ProcessPoolExecutor(1, mp_context=context) as executor:
+    print(executor.submit(eval, "sorted(__import__('sys').modules)").result())
+'''
+
+
+def test_spawned_worker_imports():
+    script = os.path.join(os.path.dirname(__file__), "..", "..",
+                          "run_pipeline.py")
+    out = subprocess.check_output(
+        [sys.executable, "-c", _SPAWN_CHECK.format(os.path.abspath(script))])
+    modules = eval(out.decode())
+    assert '__mp_main__' in modules
+    assert 'SciAnalysis.startup.run_stream_live' not in modules
+    assert 'SciAnalysis.globals' not in modules
+
+
+def test_write_image(tmp_path):
+    from PIL import Image
+    from SciAnalysis.interfaces.plotting_mpl.images import write_image, \
+        get_lut, find_clims, colorize
+
+    lut = get_lut('cmap_vge')
+    assert lut.shape == (256, 3)
+    assert lut.dtype == np.uint8
+
+    image = np.arange(10000, dtype=float).reshape((100, 100))
+    image[0, 0] = np.nan
+    vmin, vmax = find_clims(image)
+    assert 90 < vmin < 110
+    assert 9890 < vmax < 9910
+    rgb = colorize(image, vmin=0, vmax=9999, cmap='viridis')
+    assert rgb.shape == (100, 100, 3)
+    assert (rgb[0, 0] == get_lut('viridis')[0]).all()
+    assert (rgb[-1, -1] == get_lut('viridis')[-1]).all()
+    # nan get the lowest color, inf are clipped
+    rgb = colorize(np.array([np.nan, -np.inf, np.inf]), vmin=0, vmax=1)
+    assert (rgb == get_lut('viridis')[[0, 0, -1]]).all()
+
+    outdir = str(tmp_path)
+    write_image(outdir + "/img.png", image, colorbar=True)
+    res = np.array(Image.open(outdir + "/img.png").convert("RGB"))
+    assert res.shape == (100, 125, 3)
+    # the highest value is on top of the colorbar
+    assert (res[0, -1] == res[-1, 99]).all()
+    write_image(outdir + "/img.jpg", image)
+    assert Image.open(outdir + "/img.jpg").format == "JPEG"
+    # no usable values
+    write_image(outdir + "/zeros.png", np.zeros((10, 10)))
+
+
+def test_store_results_image(tmp_path, monkeypatch):
+    from PIL import Image
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(plotting_mpl, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(plotting_mpl, "_ROOTMAP", None)
+    attrs = dict(experiment_alias_directory="/exp", scan_id=1,
+                 detector_name="pilatus300", sample_savename="sample",
+                 stream_name="thumb")
+    sdoc = StreamDoc(kwargs=dict(thumb=np.random.random((10, 10))),
+                     attributes=attrs)
+    plotting_mpl.store_results_image(sdoc, images=['thumb'], hideaxes=True)
+    outdir = rootdir + "/saxs/thumb/plots"
+    assert os.listdir(outdir) == ["sample_1.png"]
+    # with a colorbar by default
+    img = Image.open(outdir + "/sample_1.png")
+    assert img.size == (35, 10)
@@ -0,0 +1,104 @@
+# test the result store of map nodes
+from functools import partial
+import threading
+
+import numpy as np
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.streams import Stream, set_result_store
+from SciAnalysis.interfaces.resultstore import ResultStore, func_token
+
+calls = list()
+
+
+def _blur(image, sigma=1):
+    calls.append('blur')
+    return image*sigma
+
+
+def _crop(image, n=2):
+    calls.append('crop')
+    return image[:n]
+
+
+def _fail(image, fail=True):
+    calls.append('fail')
+    if fail:
+        raise ValueError("bad image")
+    return image
+
+
+def _run(store, sigma=1):
+    sin = Stream()
+    sout = sin.map(_blur, sigma=sigma).map(_crop)
+    L = sout.sink_to_list()
+    set_result_store(store)
+    try:
+        for i in range(3):
+            sin.emit(StreamDoc(args=[np.arange(4.) + i],
+                               attributes=dict(stream_name="Thumb")))
+    finally:
+        set_result_store(None)
+    return [sdoc['args'][0] for sdoc in L]
+
+
+def test_ResultStore(tmp_path):
+    store = ResultStore(str(tmp_path))
+    res = _run(store)
+    assert calls == ['blur', 'crop']*3
+    assert store.stats["Thumb"] == [0, 6]
+
+    # nothing changed, all reused
+    del calls[:]
+    assert all((a == b).all() for a, b in zip(_run(store), res))
+    assert calls == []
+    assert store.stats["Thumb"] == [6, 6]
+
+    # a new parameter, the nodes from there on are run
+    del calls[:]
+    store = ResultStore(store.dirname)
+    res = _run(store, sigma=2)
+    assert calls == ['blur', 'crop']*3
+    assert (res[1] == [2, 4]).all()
+    assert "Thumb" in store.report()
+
+    # nodes calling methods are always run
+    assert func_token(calls.append) is None
+    assert func_token(_blur) == func_token(_blur)
+    assert func_token(_blur) != func_token(_crop)
+
+
+def _make_scale(factor):
+    def scale(image):
+        return image*factor
+    return scale
+
+
+def test_func_token_closures():
+    # closures and partials over values dask tokenizes are identified by them
+    assert func_token(_make_scale(2)) == func_token(_make_scale(2))
+    assert func_token(_make_scale(2)) != func_token(_make_scale(3))
+    assert func_token(partial(_blur, sigma=2)) == \
+        func_token(partial(_blur, sigma=2))
+    # a lock has no deterministic token (it can't be pickled), so these
+    # would get a new key each time : they're always run
+    lock = threading.Lock()
+    assert func_token(_make_scale(lock)) is None
+    assert func_token(partial(_blur, sigma=lock)) is None
+
+
+def test_ResultStore_failures(tmp_path):
+    # failed results aren't stored, the node is run again
+    store = ResultStore(str(tmp_path))
+    sin = Stream()
+    L = sin.map(_fail).sink_to_list()
+    set_result_store(store)
+    del calls[:]
+    try:
+        for i in range(2):
+            sin.emit(StreamDoc(args=[np.arange(4.)]))
+    finally:
+        set_result_store(None)
+    assert calls == ['fail']*2
+    assert L[0]['statistics']['status'] == "Failure"
+    assert store.stats["_fail"] == [0, 2]
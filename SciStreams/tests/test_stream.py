@@ -1,7 +1,8 @@
 # tests the stream library
 from nose.tools import assert_raises
 from SciAnalysis.interfaces.streams import Stream, stream_map,\
-    stream_accumulate
+    stream_accumulate, same_group
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
 
 
 def test_stream_map():
@@ -191,3 +192,117 @@ def test_stream_validate():
     s.emit(dict(a=1))
 
     assert L[0]['a'] == 1
+
+
+def test_stream_partition_by():
+    ''' test that each key keeps its own state.'''
+    def summer():
+        sin = Stream()
+        sout = sin.accumulate(lambda acc, x: (x[0], acc[1] + x[1]),
+                              start=(None, 0), raw=True)
+        return sin, sout
+
+    for threaded in [False, True]:
+        s = Stream()
+        sout = s.partition_by(lambda x: x[0], 3, summer, threaded=threaded)
+        L = sout.sink_to_list()
+        keys = ['a', 'b', 'c', 'd']
+        for i in range(40):
+            s.emit((keys[i % 4], 1))
+        sout.flush()
+        assert len(L) == 40
+        for key in keys:
+            # the running count per key, in order
+            assert [x[1] for x in L if x[0] == key] == list(range(1, 11))
+
+    # no key, sent in turn
+    s = Stream()
+    sout = s.partition_by(lambda x: None, 2, summer, threaded=False)
+    L = sout.sink_to_list()
+    for i in range(4):
+        s.emit(('a', i))
+    assert [x[1] for x in L] == [0, 1, 2, 4]
+    assert len(sout.replicas) == 2
+
+    # groups of consecutive elements, closed when the next one starts
+    def key(x):
+        # (key, value, starts a group)
+        return x[0] if x[2] else same_group
+
+    s = Stream()
+    sout = s.partition_by(key, 2, summer, close=lambda x: (x[0], 0))
+    L = sout.sink_to_list()
+    for x in [('a', 1, True), ('a', 2, False), ('b', 1, True),
+              ('b', 1, False), ('b', 1, False)]:
+        s.emit(x)
+    sout.flush(close=False)
+    # a was closed (its sum emitted again)
+    assert sorted(L) == [('a', 1), ('a', 3), ('a', 3), ('b', 1), ('b', 2),
+                         ('b', 3)]
+    assert list(sout.replicas) == ['b']
+    sout.flush()
+    assert len(L) == 7
+    assert L[-1] == ('b', 3)
+    assert sout.replicas == dict()
+
+    # idle replicas are removed
+    s = Stream()
+    sout = s.partition_by(lambda x: x[0], 2, summer, threaded=False,
+                          max_idle=0)
+    L = sout.sink_to_list()
+    s.emit(('a', 1))
+    s.emit(('a', 1))
+    assert L == [('a', 1), ('a', 1)]
+    assert sout.replicas == dict()
+
+    # errors are counted, the last ones kept
+    def failer():
+        sin = Stream()
+        return sin, sin.map(lambda x: 1/x, raw=True)
+
+    s = Stream()
+    sout = s.partition_by(lambda x: x, 2, failer)
+    for i in range(3):
+        s.emit(0)
+    sout.flush()
+    assert sout.nerrors == 3
+    assert len(sout.errors) == 3
+
+
+def test_stream_reorder():
+    import time
+    s = Stream()
+    sout = s.reorder(max_pending=2)
+    L = sout.map(lambda x: x['seq_num'], raw=True).sink_to_list()
+    for seq in [1, 0, 2, 4, 5, 6, 3, 8]:
+        s.emit(dict(seq_num=seq))
+    # 3 was skipped (3 elements pending), then dropped
+    assert L == [0, 1, 2, 4, 5, 6]
+    assert sout.skipped == [3]
+    sout.flush()
+    assert L == [0, 1, 2, 4, 5, 6, 8]
+    assert sout.skipped == [3, 7]
+
+    # StreamDocs, with a timeout
+    s = Stream()
+    sout = s.reorder(timeout=.05, start=10)
+    L = sout.map(lambda x: x['attributes']['seq_num'], raw=True)\
+        .sink_to_list()
+    for seq in [11, 10, 13]:
+        s.emit(StreamDoc(attributes=dict(seq_num=seq)))
+    assert L == [10, 11]
+    time.sleep(.3)
+    assert L == [10, 11, 13]
+    assert sout.skipped == [12]
+
+    # one checker thread, however many elements wait
+    import threading
+    s = Stream()
+    nthreads = threading.active_count()
+    sout = s.reorder(timeout=.05, key=lambda x: x)
+    L = sout.sink_to_list()
+    for seq in range(50, 0, -2):
+        s.emit(seq)
+    assert threading.active_count() <= nthreads + 1
+    time.sleep(.3)
+    assert L == list(range(2, 51, 2))
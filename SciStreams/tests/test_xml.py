@@ -0,0 +1,74 @@
+# test the xml interface
+import os
+
+import numpy as np
+
+from SciAnalysis.interfaces.StreamDoc import StreamDoc
+from SciAnalysis.interfaces.xml import xml as source_xml
+
+
+def _make_sdoc(i, name="circavg"):
+    attrs = dict(experiment_alias_directory="/exp", detector_name="pilatus300",
+                 sample_savename="sample", stream_name="circavg", scan_id=1,
+                 name=name, end_timestamp=100. + i)
+    return StreamDoc(kwargs=dict(npeaks=i, sqy=np.arange(3.)*i),
+                     attributes=attrs)
+
+
+def test_store_results_xml(tmp_path, monkeypatch):
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(source_xml, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(source_xml, "_ROOTMAP", None)
+    outfile = rootdir + "/saxs/circavg/xml/sample_1.xml"
+
+    source_xml.store_results_xml(_make_sdoc(1), outputs=['npeaks', 'sqy'])
+    for i in [3, 2]:
+        source_xml.store_results_xml(_make_sdoc(i), outputs=['npeaks', 'sqy'],
+                                     journal=True)
+    source_xml.store_results_xml(_make_sdoc(5, name="other"),
+                                 outputs=['npeaks'], journal=True)
+    assert os.path.isfile(outfile + ".journal")
+    # the latest is found in the journal, from the index
+    res = source_xml.get_result(outfile, "circavg")
+    assert res == dict(npeaks=3., sqy_0=0., sqy_1=3., sqy_2=6.)
+
+    source_xml.compact_xml(outfile)
+    assert not os.path.isfile(outfile + ".journal")
+    assert source_xml.get_result(outfile, "circavg")['npeaks'] == 3.
+    assert source_xml.get_result(outfile, "other")['npeaks'] == 5.
+
+    from lxml import etree
+    root = etree.parse(outfile).getroot()
+    assert root.get('name') == "sample"
+    timestamps = [float(p.get('end_timestamp')) for p in root]
+    assert timestamps == [101, 103, 102, 105]
+
+    # without the index, the whole file is parsed
+    os.remove(outfile + ".index")
+    assert source_xml.get_result(outfile, "circavg")['npeaks'] == 3.
+    # and it's indexed before the first append to the journal
+    source_xml.store_results_xml(_make_sdoc(4), outputs=['npeaks'],
+                                 journal=True)
+    assert os.path.isfile(outfile + ".index")
+    assert source_xml.get_result(outfile, "circavg")['npeaks'] == 4.
+    source_xml.compact_xml_journals()
+    assert len(etree.parse(outfile).getroot()) == 5
+
+
+def test_store_results_xml_unindexed(tmp_path, monkeypatch):
+    # an xml file written without an index, with a protocol newer than the
+    # one journaled next
+    rootdir = str(tmp_path)
+    monkeypatch.setattr(source_xml, "_ROOTDIR", rootdir)
+    monkeypatch.setattr(source_xml, "_ROOTMAP", None)
+    outfile = rootdir + "/saxs/circavg/xml/sample_1.xml"
+
+    source_xml.store_results_xml(_make_sdoc(10), outputs=['npeaks'])
+    os.remove(outfile + ".index")
+    source_xml.store_results_xml(_make_sdoc(4), outputs=['npeaks'],
+                                 journal=True)
+    source_xml.store_results_xml(_make_sdoc(5, name="other"),
+                                 outputs=['npeaks'], journal=True)
+    assert source_xml.get_result(outfile, "circavg")['npeaks'] == 10.
+    assert source_xml.get_result(outfile, "other")['npeaks'] == 5.
+    source_xml.compact_xml_journals()
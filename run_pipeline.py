@@ -1,7 +1,7 @@
 import argparse
 import re
+import sys
 import time
-from SciAnalysis.startup import run_stream_live
 
 VERSION = "0.1"
 
@@ -30,13 +30,77 @@ def check_time(strtime):
 
 
 if __name__ == '__main__':
+    # imported here : it builds the pipeline (and starts the dask client),
+    # the render processes are spawned and re-import this module
+    from SciAnalysis.startup import run_stream_live
+
     print("CMS pipeline, version {}".format(VERSION))
 
     parser = argparse.ArgumentParser(description='Start the pipeline')
     parser.add_argument('-t0', '--start_time', dest='start_time', type=str)
     # help="The start time for the pipeline " +
     # "(default is 24 hrs prior to now)")
+    parser.add_argument('--zmq', dest='zmq_address', type=str,
+                        help="Listen to a RunEngine document stream at this "
+                        "0MQ address instead of polling databroker")
+    parser.add_argument('--zmq-prefix', dest='zmq_prefix', type=str,
+                        default='')
+    parser.add_argument('--sync-catalog', dest='sync_catalog',
+                        action='store_true',
+                        help="Keep the local metadata catalog up to date "
+                        "instead of running the pipeline")
+    parser.add_argument('--backfill', dest='backfill', type=str, nargs=2,
+                        metavar=('START', 'STOP'),
+                        help="Reprocess the scans from START to STOP in "
+                        "parallel, then exit")
+    parser.add_argument('--workers', dest='workers', type=int, default=4,
+                        help="The number of worker processes for --backfill")
+    parser.add_argument('--checkpoint', dest='checkpoint_dir', type=str,
+                        help="Save the pipeline state to this directory, "
+                        "and resume from it on restart")
+    parser.add_argument('--result-store', dest='result_store', type=str,
+                        help="Reuse the results of unchanged nodes from "
+                        "this directory (and store new ones)")
+    parser.add_argument('--memory-budget', dest='memory_budget', type=float,
+                        help="The memory (in GB) the buffers of the "
+                        "pipeline may use, the rest is spilled to disk")
+    parser.add_argument('--spill-dir', dest='spill_dir', type=str,
+                        help="The directory buffers are spilled to "
+                        "(default, the temporary directory)")
     args = parser.parse_args()
+    if args.memory_budget is not None:
+        import atexit
+        from SciAnalysis.interfaces.memory import MemoryManager, \
+            set_memory_manager
+        memory_manager = MemoryManager(int(args.memory_budget*2**30),
+                                       spilldir=args.spill_dir)
+        set_memory_manager(memory_manager)
+        atexit.register(lambda: print(memory_manager.report()))
+    if args.result_store is not None:
+        import atexit
+        from SciAnalysis.interfaces.streams import set_result_store
+        from SciAnalysis.interfaces.resultstore import ResultStore
+        result_store = ResultStore(args.result_store)
+        set_result_store(result_store)
+        atexit.register(lambda: print(result_store.report()))
+    if args.sync_catalog:
+        from SciAnalysis.interfaces.databroker.catalog import Catalog
+        catalog = Catalog()
+        start_time = None
+        if args.start_time is not None:
+            start_time = check_time(args.start_time)
+        print("Syncing catalog {}...".format(catalog.filename))
+        catalog.sync("cms:data", start_time=start_time, wait=1)
+    if args.backfill is not None:
+        from SciAnalysis.startup.backfill import run_backfill
+        start_time, stop_time = [check_time(t) for t in args.backfill]
+        summary = run_backfill(start_time, stop_time, workers=args.workers,
+                               result_store=args.result_store)
+        sys.exit(1 if summary['failed'] else 0)
+    if args.zmq_address is not None:
+        run_stream_live.start_run_zmq(args.zmq_address,
+                                      prefix=args.zmq_prefix.encode())
+        sys.exit(0)
     if args.start_time is not None:
         # will raise a ValueError
         start_time = check_time(args.start_time)
@@ -47,4 +111,4 @@ if __name__ == '__main__':
     print("Searching for results " +
           "from {} onwards...".format(time.ctime(start_time)))
     # run pipeline
-    run_stream_live.start_run(start_time)
+    run_stream_live.start_run(start_time, checkpoint_dir=args.checkpoint_dir)